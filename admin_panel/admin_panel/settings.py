@@ -4,8 +4,10 @@ Django settings for admin_panel project.
 Современная админ-панель с Unfold темой для управления PostgreSQL базой.
 """
 
+import json
 import os
 from pathlib import Path
+from celery.schedules import crontab
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения из .env файла
@@ -57,6 +59,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Замеры SQL и времени (включается QUERY_INSTRUMENTATION_ENABLED)
+    'core.middleware.QueryInstrumentationMiddleware',
 ]
 
 ROOT_URLCONF = 'admin_panel.urls'
@@ -97,6 +101,24 @@ DATABASES = {
     }
 }
 
+# Реплика для аналитики: дашборд, списки админки, статистические задачи Celery
+# (core/db_router.py). Без DB_REPLICA_HOST всё читается с primary.
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'USER': os.getenv('DB_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv('DB_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+    }
+
+DATABASE_ROUTERS = ['core.db_router.ReplicaRouter']
+
+# Допустимое отставание реплики (сек) и как часто его проверять; больше — читаем с primary
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '30'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '10'))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -140,7 +162,6 @@ REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 # Асинхронные задачи и рассылки
 # ============================================================================
 CELERY_BROKER_URL = REDIS_URL
-CELERY_RESULT_BACKEND = 'django-db'  # Хранение результатов в PostgreSQL
 CELERY_CACHE_BACKEND = 'default'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
@@ -149,14 +170,80 @@ CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 60 * 60  # 1 час максимум на задачу
 
+# Результаты задач
+# ⚠️ Не пишем результаты в основной PostgreSQL: массовые рассылки
+# превращались в тысячи INSERT в django_celery_results_taskresult.
+# По умолчанию результат не сохраняется вообще (fire-and-forget),
+# задачи, чей результат нужен (прогресс рассылки), явно включают
+# ignore_result=False и хранятся в Redis с коротким TTL.
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', REDIS_URL)
+CELERY_RESULT_EXPIRES = int(os.getenv('CELERY_RESULT_EXPIRES', str(60 * 60 * 6)))  # 6 часов
+CELERY_TASK_IGNORE_RESULT = True
+
+# Сколько дней хранить старые записи django_celery_results (legacy)
+TASK_RESULTS_RETENTION_DAYS = int(os.getenv('TASK_RESULTS_RETENTION_DAYS', '3'))
+
 # Celery Beat - периодические задачи
 CELERY_BEAT_SCHEDULE = {
     'check-scheduled-broadcasts': {
         'task': 'core.tasks.scheduled_broadcast_check',
         'schedule': 60.0,  # каждую минуту
     },
+    'update-segment-user-counts': {
+        'task': 'core.tasks.update_segment_user_counts',
+        'schedule': 900.0,  # каждые 15 минут
+    },
+    'refresh-user-features': {
+        'task': 'core.tasks.update_user_features',
+        'schedule': 300.0,  # каждые 5 минут, инкрементально
+    },
+    'rebuild-user-features': {
+        'task': 'core.tasks.update_user_features',
+        'schedule': crontab(hour=3, minute=30),
+        'kwargs': {'full': True},
+    },
+    'refresh-segment-members': {
+        'task': 'core.tasks.refresh_all_segment_members',
+        'schedule': 300.0,  # каждые 5 минут
+    },
+    'refresh-daily-metrics': {
+        'task': 'core.tasks.update_daily_metrics',
+        'schedule': 300.0,  # каждые 5 минут, сегодняшний день
+    },
+    'rebuild-daily-metrics': {
+        'task': 'core.tasks.update_daily_metrics',
+        'schedule': crontab(hour=0, minute=20),  # после полуночи по Москве
+        'kwargs': {'days': 3},
+    },
+    'update-activity-sketches': {
+        'task': 'core.tasks.update_activity_sketches',
+        'schedule': 60.0,  # каждую минуту, инкрементально
+    },
+    'recompute-habit-streaks': {
+        'task': 'core.tasks.recompute_habit_streaks',
+        'schedule': crontab(hour=4, minute=30),  # ежедневно в 04:30
+    },
+    'purge-task-results': {
+        'task': 'core.tasks.purge_task_results',
+        'schedule': crontab(hour=4, minute=0),  # ежедневно в 04:00
+    },
 }
 
+# Материализованный состав сегментов старше этого (сек) не используется для рассылок
+SEGMENT_MEMBERS_MAX_AGE = int(os.getenv('SEGMENT_MEMBERS_MAX_AGE', str(15 * 60)))
+
+# Сколько дней хранить битмап получателей рассылки (для составных сегментов)
+BROADCAST_DELIVERY_BITMAP_TTL_DAYS = int(os.getenv('BROADCAST_DELIVERY_BITMAP_TTL_DAYS', '180'))
+
+# Превью размера сегмента в админке:
+# до SEGMENT_PREVIEW_EXACT_BELOW строк в users — точный COUNT сразу,
+# иначе оценка по выборке ~SEGMENT_PREVIEW_SAMPLE_ROWS строк и точный COUNT в фоне
+SEGMENT_PREVIEW_EXACT_BELOW = int(os.getenv('SEGMENT_PREVIEW_EXACT_BELOW', '50000'))
+SEGMENT_PREVIEW_SAMPLE_ROWS = int(os.getenv('SEGMENT_PREVIEW_SAMPLE_ROWS', '20000'))
+SEGMENT_PREVIEW_CACHE_TTL = int(os.getenv('SEGMENT_PREVIEW_CACHE_TTL', '300'))
+# Сколько секунд переиспользовать оценку, пока форма ждёт точный COUNT
+SEGMENT_PREVIEW_ESTIMATE_TTL = int(os.getenv('SEGMENT_PREVIEW_ESTIMATE_TTL', '60'))
+
 # Rate limiting для Telegram API
 # Telegram: 30 сообщений в секунду для ботов
 # Используем 25/сек для безопасности
@@ -173,6 +260,42 @@ CACHES = {
     }
 }
 
+# Кэш блоков дашборда (core/dashboard_cache.py)
+DASHBOARD_CACHE_ENABLED = os.getenv('DASHBOARD_CACHE_ENABLED', 'True').lower() in ('true', '1', 'yes')
+DASHBOARD_CACHE_TTLS = {
+    'pulse': int(os.getenv('DASHBOARD_CACHE_TTL_PULSE', '60')),
+    'details': int(os.getenv('DASHBOARD_CACHE_TTL_DETAILS', '60')),
+    'perf': int(os.getenv('DASHBOARD_CACHE_TTL_PERF', '60')),
+    'money': int(os.getenv('DASHBOARD_CACHE_TTL_MONEY', '300')),
+    'habits': int(os.getenv('DASHBOARD_CACHE_TTL_HABITS', '300')),
+    'ai': int(os.getenv('DASHBOARD_CACHE_TTL_AI', '600')),
+    'charts': int(os.getenv('DASHBOARD_CACHE_TTL_CHARTS', '600')),
+    'retention': int(os.getenv('DASHBOARD_CACHE_TTL_RETENTION', '3600')),
+    'cohorts': int(os.getenv('DASHBOARD_CACHE_TTL_COHORTS', '3600')),
+    'funnel': int(os.getenv('DASHBOARD_CACHE_TTL_FUNNEL', '3600')),
+}
+# Сколько держать блокировку пересчёта и сколько ждать чужой пересчёт (секунды)
+DASHBOARD_CACHE_LOCK_TIMEOUT = int(os.getenv('DASHBOARD_CACHE_LOCK_TIMEOUT', '120'))
+DASHBOARD_CACHE_LOCK_WAIT = int(os.getenv('DASHBOARD_CACHE_LOCK_WAIT', '30'))
+# Уникальные пользователи (DAU/WAU/MAU): HyperLogLog-скетчи в Redis по дням;
+# True — точный DISTINCT в SQL (медленно на больших таблицах)
+DASHBOARD_EXACT_UNIQUES = os.getenv('DASHBOARD_EXACT_UNIQUES', 'False').lower() in ('true', '1', 'yes')
+ACTIVITY_SKETCH_TTL_DAYS = int(os.getenv('ACTIVITY_SKETCH_TTL_DAYS', '400'))
+# Этапы воронки после регистрации (JSON), пусто — по умолчанию из core/dashboard.py:
+# [{"name": "Первая привычка", "metric": "habits", "min": 1}, ...]
+# metric: entries, voice_entries, habits, habit_completions, payments
+DASHBOARD_FUNNEL_STAGES = json.loads(os.getenv('DASHBOARD_FUNNEL_STAGES', '[]'))
+# Параллельный расчёт блоков: потоков (1 — последовательно) и таймаут блока (сек).
+# Каждый поток держит своё соединение с БД: один запрос дашборда занимает до
+# WORKERS соединений на процесс, и WORKERS × процессов gunicorn должно
+# укладываться в max_connections PostgreSQL вместе с бэкендом и Celery
+DASHBOARD_PARALLEL_WORKERS = int(os.getenv('DASHBOARD_PARALLEL_WORKERS', '4'))
+DASHBOARD_BLOCK_TIMEOUT = float(os.getenv('DASHBOARD_BLOCK_TIMEOUT', '20'))
+
+# Замеры SQL (число запросов, время в БД) по страницам админки и блокам дашборда,
+# отчёт «самые медленные» в Redis (core/instrumentation.py)
+QUERY_INSTRUMENTATION_ENABLED = os.getenv('QUERY_INSTRUMENTATION_ENABLED', 'False').lower() in ('true', '1', 'yes')
+
 # ============================================================================
 # UNFOLD CONFIGURATION
 # Настройка современной темы админ-панели
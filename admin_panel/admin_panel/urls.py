@@ -10,6 +10,7 @@ from django.conf.urls.static import static
 from core.views import (
     DashboardView, 
     dashboard_api, 
+    dashboard_block_api,
     broadcast_progress_api,
     broadcasts_page,
     broadcasts_api_list,
@@ -20,12 +21,14 @@ from core.views import (
     broadcasts_api_upload_image,
     broadcasts_api_get,
     broadcasts_api_update,
+    segment_preview_api,
 )
 
 urlpatterns = [
     # Dashboard
     path('admin/dashboard/', DashboardView.as_view(), name='dashboard'),
     path('api/dashboard/', dashboard_api, name='dashboard_api'),
+    path('api/dashboard/block/<str:block>/', dashboard_block_api, name='dashboard_block_api'),
     
     # Broadcasts - отдельная страница
     path('admin/broadcasts/', broadcasts_page, name='broadcasts'),
@@ -39,6 +42,9 @@ urlpatterns = [
     path('admin/broadcasts/api/upload-image/', broadcasts_api_upload_image, name='broadcasts_api_upload_image'),
     path('api/broadcast/<str:broadcast_id>/progress/', broadcast_progress_api, name='broadcast_progress'),
     
+    # Segments
+    path('admin/segments/api/preview/', segment_preview_api, name='segment_preview_api'),
+    
     # Admin
     path('admin/', admin.site.urls),
     path('', lambda r: redirect('/admin/')),
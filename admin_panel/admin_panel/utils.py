@@ -2,6 +2,7 @@
 Утилиты для Django Admin Panel
 """
 import os
+from functools import lru_cache
 
 
 def environment_callback(request):
@@ -12,3 +13,15 @@ def environment_callback(request):
     if os.getenv('DJANGO_DEBUG', 'True').lower() in ('true', '1', 'yes'):
         return ["Development", "warning"]
     return ["Production", "danger"]
+
+
+@lru_cache(maxsize=1)
+def get_redis():
+    """
+    Клиент Redis для операций, которых нет в Django cache API
+    (битмапы сегментов, HyperLogLog). Один пул соединений на процесс.
+    """
+    import redis
+    from django.conf import settings
+
+    return redis.Redis.from_url(settings.REDIS_URL)
@@ -7,11 +7,12 @@
 - Какие действия (actions) доступны
 """
 
+from django import forms
 from django.contrib import admin, messages
 from unfold.admin import ModelAdmin
 from unfold.decorators import display
 
-from .models import User, JournalEntry, Transaction, Subscription, Broadcast, UsageLog, AppConfig, UserSegment, TrafficSource, Habit, HabitCompletion
+from .models import User, JournalEntry, Transaction, Subscription, Broadcast, UsageLog, AppConfig, UserSegment, SegmentStaticMember, TrafficSource, Habit, HabitCompletion
 from .actions import (
     send_broadcast_action, 
     send_welcome_message,
@@ -21,10 +22,28 @@ from .actions import (
     block_users,
     unblock_users,
 )
+from .db_router import use_replica
+
+
+class ReplicaChangeListMixin:
+    """
+    Список объектов (GET) читается с реплики — тяжёлые выборки и счётчики
+    не конкурируют с API за primary. POST (actions) и формы остаются на primary.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with use_replica():
+            response = super().changelist_view(request, extra_context)
+            # TemplateResponse рендерится лениво — выполняем запросы внутри use_replica()
+            if hasattr(response, 'render'):
+                response.render()
+        return response
 
 
 @admin.register(User)
-class UserAdmin(ModelAdmin):
+class UserAdmin(ReplicaChangeListMixin, ModelAdmin):
     """
     Админ-класс для управления пользователями.
     Наследуется от unfold.admin.ModelAdmin для красивого UI.
@@ -180,7 +199,7 @@ class UserAdmin(ModelAdmin):
 
 
 @admin.register(JournalEntry)
-class JournalEntryAdmin(ModelAdmin):
+class JournalEntryAdmin(ReplicaChangeListMixin, ModelAdmin):
     """
     Админ-класс для управления записями дневника.
     """
@@ -279,7 +298,7 @@ class JournalEntryAdmin(ModelAdmin):
 
 
 @admin.register(Transaction)
-class TransactionAdmin(ModelAdmin):
+class TransactionAdmin(ReplicaChangeListMixin, ModelAdmin):
     """Админ-класс для транзакций."""
     
     list_display = [
@@ -324,7 +343,7 @@ class TransactionAdmin(ModelAdmin):
 
 
 @admin.register(Subscription)
-class SubscriptionAdmin(ModelAdmin):
+class SubscriptionAdmin(ReplicaChangeListMixin, ModelAdmin):
     """Админ-класс для подписок."""
     
     list_display = [
@@ -571,7 +590,7 @@ class BroadcastAdmin(DjangoModelAdmin):
 
 
 @admin.register(UsageLog)
-class UsageLogAdmin(ModelAdmin):
+class UsageLogAdmin(ReplicaChangeListMixin, ModelAdmin):
     """Админ-класс для логов использования AI."""
     
     list_display = [
@@ -672,12 +691,64 @@ class AppConfigAdmin(ModelAdmin):
         return value[:50] + '...' if len(value) > 50 else value
 
 
+class UserSegmentForm(forms.ModelForm):
+    """Форма сегмента с проверкой filter_rules и set_expression."""
+    
+    class Meta:
+        model = UserSegment
+        fields = '__all__'
+    
+    def clean_filter_rules(self):
+        from .segments import SegmentRuleError, compile_segment_rules
+        
+        filter_rules = self.cleaned_data.get('filter_rules')
+        if filter_rules:
+            try:
+                compile_segment_rules(filter_rules)
+            except SegmentRuleError as e:
+                raise forms.ValidationError(str(e))
+        return filter_rules
+    
+    def clean(self):
+        from .bitmaps import validate_set_expression
+        from .segments import SegmentRuleError
+        
+        cleaned_data = super().clean()
+        if cleaned_data.get('segment_type') != 'composite':
+            return cleaned_data
+        
+        expression = cleaned_data.get('set_expression')
+        if not expression:
+            self.add_error('set_expression', 'Для составного сегмента нужно выражение над сегментами')
+            return cleaned_data
+        
+        slug = cleaned_data.get('slug') or self.instance.slug
+        try:
+            validate_set_expression(expression, parents=(slug,))
+        except SegmentRuleError as e:
+            self.add_error('set_expression', str(e))
+        return cleaned_data
+
+
+class StaticMembersImportForm(forms.Form):
+    """Загрузка CSV со списком участников статического сегмента."""
+    
+    csv_file = forms.FileField(label='CSV файл', help_text='Первая колонка: UUID пользователя или telegram_id')
+    replace = forms.BooleanField(
+        label='Заменить текущий список',
+        required=False,
+        help_text='Иначе участники из файла добавляются к существующим',
+    )
+
+
 @admin.register(UserSegment)
 class UserSegmentAdmin(ModelAdmin):
     """
     Админ-класс для управления сегментами пользователей.
     """
     
+    form = UserSegmentForm
+    
     list_display = [
         'name',
         'slug',
@@ -702,6 +773,8 @@ class UserSegmentAdmin(ModelAdmin):
         'id',
         'cached_user_count',
         'cache_updated_at',
+        'members_refreshed_at',
+        'static_members_link',
         'date_created',
         'date_updated',
     ]
@@ -731,14 +804,26 @@ class UserSegmentAdmin(ModelAdmin):
         }),
         ('Правила (для динамических)', {
             'fields': ('filter_rules',),
-            'description': 'JSON-правила фильтрации. Примеры: {"subscription_tier": ["premium"]}, {"date_created": {"gte": "-7 days"}}'
+            'description': 'JSON-правила фильтрации. Примеры: {"subscription_tier": {"in": ["premium"]}}, '
+                           '{"date_created": {"gte": "-7 days"}}, '
+                           '{"or": [{"total_entries_count": {"gte": 10}}, {"entries__is_voice": {"eq": true}}]}, '
+                           '{"not": {"habits": {"exists": true}}}. '
+                           'Поведенческие признаки: entries_7d, entries_30d, last_entry_at, active_habits, '
+                           'max_habit_streak, last_payment_at, payments_30d, ai_spend_usd, ai_spend_30d_usd'
         }),
         ('Статический список (для static)', {
-            'fields': ('static_user_ids',),
-            'description': 'Список UUID пользователей для статических сегментов'
+            'fields': ('static_members_link',),
+            'description': 'Участники хранятся отдельной таблицей: просмотр постранично, импорт из CSV '
+                           '(первая колонка — UUID или telegram_id)'
+        }),
+        ('Комбинация сегментов (для composite)', {
+            'fields': ('set_expression',),
+            'description': 'Операции над сегментами (битмапы в Redis). Примеры: {"intersect": ["premium", "active_writers"]}, '
+                           '{"union": ["premium", "voice_users"]}, '
+                           '{"exclude": [{"intersect": ["premium", "active_writers"]}, {"broadcast": "<uuid рассылки>"}]}'
         }),
         ('Статистика', {
-            'fields': ('cached_user_count', 'cache_updated_at'),
+            'fields': ('cached_user_count', 'cache_updated_at', 'members_refreshed_at'),
             'classes': ('collapse',),
         }),
         ('Метаданные', {
@@ -753,9 +838,95 @@ class UserSegmentAdmin(ModelAdmin):
             'system': '⚙️ Системный',
             'dynamic': '🔄 Динамический',
             'static': '📌 Статический',
+            'composite': '🧩 Составной',
         }
         return type_icons.get(obj.segment_type, obj.segment_type)
     
+    @display(description="Участники")
+    def static_members_link(self, obj):
+        from django.urls import reverse
+        from django.utils.html import format_html
+        
+        if not obj or not obj.pk:
+            return "—"
+        members_url = reverse('admin:core_segmentstaticmember_changelist') + f'?segment__id__exact={obj.pk}'
+        if not self._static_import_allowed(obj):
+            return format_html('<a href="{}">👥 Список участников</a>', members_url)
+        import_url = reverse('admin:core_usersegment_import_static', args=[obj.pk])
+        return format_html(
+            '<a href="{}">👥 Список участников</a> &nbsp;·&nbsp; <a href="{}">📥 Импорт из CSV</a>',
+            members_url,
+            import_url,
+        )
+    
+    @staticmethod
+    def _static_import_allowed(segment):
+        """
+        CSV-импорт — только в обычный статический сегмент. Тип и правила
+        импорт не меняет: системные, динамические и составные сегменты,
+        а также статические с filter_rules (правила важнее списка,
+        см. segment_filter_q) сначала правятся в форме сегмента.
+        """
+        return not segment.is_system and segment.segment_type == 'static' and not segment.filter_rules
+    
+    def get_urls(self):
+        from django.urls import path
+        
+        urls = super().get_urls()
+        custom_urls = [
+            path(
+                '<path:object_id>/import-static/',
+                self.admin_site.admin_view(self.import_static_view),
+                name='core_usersegment_import_static',
+            ),
+        ]
+        return custom_urls + urls
+    
+    def import_static_view(self, request, object_id):
+        """Импорт участников статического сегмента из CSV (COPY в Postgres)."""
+        from django.core.exceptions import PermissionDenied
+        from django.db import DataError
+        from django.http import HttpResponseRedirect
+        from django.shortcuts import get_object_or_404
+        from django.template.response import TemplateResponse
+        from django.urls import reverse
+        from .segments import import_static_members
+        
+        segment = get_object_or_404(UserSegment, pk=object_id)
+        if not self.has_change_permission(request, segment) or not self._static_import_allowed(segment):
+            raise PermissionDenied
+        
+        form = StaticMembersImportForm(request.POST or None, request.FILES or None)
+        stats = None
+        if request.method == 'POST' and form.is_valid():
+            try:
+                stats = import_static_members(
+                    segment,
+                    form.cleaned_data['csv_file'].file,
+                    replace=form.cleaned_data['replace'],
+                )
+            except DataError:
+                # Не UTF-8 или битый CSV — COPY его не принимает
+                form.add_error('csv_file', 'Не удалось прочитать файл: нужен CSV в кодировке UTF-8')
+        
+        if stats is not None:
+            self.message_user(
+                request,
+                f"📥 Строк: {stats['rows']}, найдено пользователей: {stats['matched']}, "
+                f"добавлено: {stats['added']}, удалено: {stats['removed']}",
+                messages.SUCCESS,
+            )
+            return HttpResponseRedirect(reverse('admin:core_usersegment_change', args=[segment.pk]))
+        
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'original': segment,
+            'form': form,
+            'title': f'Импорт участников: {segment.name}',
+        }
+        return TemplateResponse(request, 'admin/core/usersegment/import_static.html', context)
+    
     def has_delete_permission(self, request, obj=None):
         """Системные сегменты нельзя удалять."""
         if obj and obj.is_system:
@@ -770,8 +941,50 @@ class UserSegmentAdmin(ModelAdmin):
         return readonly
 
 
+@admin.register(SegmentStaticMember)
+class SegmentStaticMemberAdmin(ReplicaChangeListMixin, ModelAdmin):
+    """
+    Участники статических сегментов.
+    Постраничный просмотр вместо массива UUID на странице сегмента.
+    """
+    
+    list_display = [
+        'user',
+        'display_telegram_id',
+        'segment',
+        'date_added',
+    ]
+    
+    search_fields = [
+        'user__telegram_id',
+        'user__username',
+    ]
+    
+    list_filter = [
+        'segment',
+    ]
+    
+    autocomplete_fields = ['user']
+    list_select_related = ['user', 'segment']
+    readonly_fields = ['date_added']
+    
+    ordering = ['-date_added']
+    list_per_page = 100
+    # Без COUNT(*) по всей таблице на каждой странице
+    show_full_result_count = False
+    
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'segment':
+            kwargs['queryset'] = UserSegment.objects.filter(segment_type='static')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+    
+    @display(description="Telegram ID")
+    def display_telegram_id(self, obj):
+        return obj.user.telegram_id
+
+
 @admin.register(TrafficSource)
-class TrafficSourceAdmin(ModelAdmin):
+class TrafficSourceAdmin(ReplicaChangeListMixin, ModelAdmin):
     """
     Админ-класс для управления источниками трафика.
     """
@@ -912,7 +1125,7 @@ class TrafficSourceAdmin(ModelAdmin):
 # ============================================================================
 
 @admin.register(Habit)
-class HabitAdmin(ModelAdmin):
+class HabitAdmin(ReplicaChangeListMixin, ModelAdmin):
     """Админ-класс для управления привычками."""
     
     list_display = [
@@ -980,7 +1193,7 @@ class HabitAdmin(ModelAdmin):
 
 
 @admin.register(HabitCompletion)
-class HabitCompletionAdmin(ModelAdmin):
+class HabitCompletionAdmin(ReplicaChangeListMixin, ModelAdmin):
     """Админ-класс для выполнений привычек."""
     
     list_display = [
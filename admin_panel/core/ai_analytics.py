@@ -0,0 +1,215 @@
+"""
+Аналитика AI-запросов (app.usage_logs): стоимость, токены и задержка
+по сервису и модели, самые дорогие пользователи.
+
+Короткие периоды (до RAW_MAX_DAYS дней) считаются по usage_logs одним
+запросом с GROUPING SETS: строки по моделям и общий итог, перцентили —
+точные (percentile_cont). Длинные — по суточному rollup app.daily_ai_metrics:
+суммы складываются, перцентили оцениваются по объединённой гистограмме
+задержек (линейная интерполяция внутри корзины).
+"""
+
+from typing import Any, Dict, List
+
+from django.db.models import Count, F, Max, Sum
+
+from .db_router import reporting_connection
+from .models import DailyAIMetric, UsageLog, User
+from .rollups import LATENCY_BUCKETS_MS
+
+
+# Периоды длиннее — из daily_ai_metrics
+RAW_MAX_DAYS = 31
+
+LATENCY_PERCENTILES = (0.5, 0.95, 0.99)
+
+TOP_SPENDERS_LIMIT = 10
+
+RAW_BREAKDOWN_SQL = """
+    SELECT
+        GROUPING(service_type, model_name) AS is_total,
+        service_type::text,
+        model_name,
+        COUNT(*),
+        COALESCE(SUM(input_tokens), 0),
+        COALESCE(SUM(output_tokens), 0),
+        COALESCE(SUM(cost_usd), 0),
+        AVG(latency_ms),
+        percentile_cont(%(percentiles)s::float8[]) WITHIN GROUP (ORDER BY latency_ms)
+    FROM app.usage_logs
+    WHERE date_created >= %(start)s AND date_created < %(end)s
+    GROUP BY GROUPING SETS ((service_type, model_name), ())
+"""
+
+ROLLUP_SUM_FIELDS = ('requests_sum', 'input_sum', 'output_sum', 'cost_sum', 'latency_count_sum', 'latency_ms_sum')
+
+ROLLUP_HISTOGRAM_SQL = """
+    SELECT m.service_type, m.model_name, h.bucket::int, SUM(h.requests::bigint)
+    FROM app.daily_ai_metrics m
+    CROSS JOIN LATERAL jsonb_each_text(m.latency_histogram) AS h(bucket, requests)
+    WHERE m.day BETWEEN %(first_day)s AND %(last_day)s
+    GROUP BY 1, 2, 3
+"""
+
+
+def _row(service_type, model_name, requests, input_tokens, output_tokens, cost_usd, avg_latency, percentiles):
+    return {
+        'service_type': service_type,
+        'model_name': model_name,
+        'requests': requests,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'tokens': input_tokens + output_tokens,
+        'cost_usd': round(float(cost_usd), 4),
+        'avg_latency_ms': round(avg_latency) if avg_latency is not None else None,
+        'p50_ms': percentiles[0],
+        'p95_ms': percentiles[1],
+        'p99_ms': percentiles[2],
+    }
+
+
+def histogram_percentile(histogram: Dict[int, int], quantile: float, max_ms=None):
+    """
+    Оценка перцентиля задержки по гистограмме {корзина width_bucket: запросов}.
+    Внутри корзины значение интерполируется линейно; верхняя граница последней
+    корзины — максимальная задержка.
+    """
+    count = sum(histogram.values())
+    if not count:
+        return None
+
+    target = quantile * count
+    seen = 0
+    for bucket in sorted(histogram):
+        requests = histogram[bucket]
+        if seen + requests >= target:
+            lower = LATENCY_BUCKETS_MS[bucket - 1] if bucket > 0 else 0
+            if bucket < len(LATENCY_BUCKETS_MS):
+                upper = LATENCY_BUCKETS_MS[bucket]
+            else:
+                upper = max(max_ms or lower, lower)
+            value = lower + (upper - lower) * (target - seen) / requests
+            return round(min(value, max_ms) if max_ms is not None else value)
+        seen += requests
+    return max_ms
+
+
+def _raw_breakdown(start, end):
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(RAW_BREAKDOWN_SQL, {
+            'start': start,
+            'end': end,
+            'percentiles': list(LATENCY_PERCENTILES),
+        })
+        rows = cursor.fetchall()
+
+    models = []
+    total = None
+    for is_total, service_type, model_name, requests, input_tokens, output_tokens, cost, avg_latency, percentiles in rows:
+        percentiles = [round(value) if value is not None else None for value in (percentiles or [None] * 3)]
+        row = _row(service_type, model_name, requests, input_tokens, output_tokens, cost, avg_latency, percentiles)
+        if is_total:
+            total = row
+        else:
+            models.append(row)
+    return models, total
+
+
+def _rollup_breakdown(first_day, last_day):
+    aggregates = list(DailyAIMetric.objects.filter(
+        day__range=(first_day, last_day)
+    ).values('service_type', 'model_name').annotate(
+        requests_sum=Sum('requests'),
+        input_sum=Sum('input_tokens'),
+        output_sum=Sum('output_tokens'),
+        cost_sum=Sum('cost_usd'),
+        latency_count_sum=Sum('latency_count'),
+        latency_ms_sum=Sum('latency_sum_ms'),
+        latency_max=Max('latency_max_ms'),
+    ))
+
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(ROLLUP_HISTOGRAM_SQL, {'first_day': first_day, 'last_day': last_day})
+        histogram_rows = cursor.fetchall()
+
+    histograms: Dict[Any, Dict[int, int]] = {}
+    for service_type, model_name, bucket, requests in histogram_rows:
+        for key in ((service_type, model_name), None):
+            merged = histograms.setdefault(key, {})
+            merged[bucket] = merged.get(bucket, 0) + requests
+
+    def build(service_type, model_name, values, histogram):
+        percentiles = [histogram_percentile(histogram, q, values['latency_max']) for q in LATENCY_PERCENTILES]
+        avg_latency = values['latency_ms_sum'] / values['latency_count_sum'] if values['latency_count_sum'] else None
+        return _row(
+            service_type, model_name, values['requests_sum'], values['input_sum'], values['output_sum'],
+            values['cost_sum'], avg_latency, percentiles,
+        )
+
+    models = [
+        build(item['service_type'], item['model_name'], item, histograms.get((item['service_type'], item['model_name']), {}))
+        for item in aggregates
+    ]
+    totals = {name: sum(item[name] or 0 for item in aggregates) for name in ROLLUP_SUM_FIELDS}
+    totals['latency_max'] = max(
+        (item['latency_max'] for item in aggregates if item['latency_max'] is not None),
+        default=None,
+    )
+
+    return models, build(None, None, totals, histograms.get(None, {}))
+
+
+def get_top_spenders(start, end, limit: int = TOP_SPENDERS_LIMIT) -> List[Dict[str, Any]]:
+    """Пользователи с наибольшими AI-расходами за период."""
+    spenders = list(
+        UsageLog.objects.filter(
+            date_created__gte=start,
+            date_created__lt=end,
+        ).values('user_id').annotate(
+            requests=Count('id'),
+            tokens=Sum(F('input_tokens') + F('output_tokens')),
+            cost=Sum('cost_usd'),
+        ).order_by('-cost')[:limit]
+    )
+    users = User.objects.in_bulk([row['user_id'] for row in spenders])
+
+    return [
+        {
+            'user': str(users.get(row['user_id'], row['user_id'])),
+            'requests': row['requests'],
+            'tokens': row['tokens'] or 0,
+            'cost_usd': round(float(row['cost'] or 0), 4),
+        }
+        for row in spenders
+    ]
+
+
+def get_ai_analytics(start, end, first_day, last_day) -> Dict[str, Any]:
+    """
+    AI-аналитика за период [start, end) (дни first_day..last_day — для rollup).
+
+    Returns:
+        {source: 'raw' | 'rollup', models: [...], total: {...}, top_spenders: [...]}
+        Строка модели: service_type, model_name, requests, tokens, cost_usd,
+        cost_share (%), avg_latency_ms, p50_ms, p95_ms, p99_ms.
+    """
+    if (last_day - first_day).days + 1 > RAW_MAX_DAYS:
+        source = 'rollup'
+        models, total = _rollup_breakdown(first_day, last_day)
+    else:
+        source = 'raw'
+        models, total = _raw_breakdown(start, end)
+
+    if total is None:
+        total = _row(None, None, 0, 0, 0, 0, None, [None] * 3)
+
+    models.sort(key=lambda row: row['cost_usd'], reverse=True)
+    for row in models:
+        row['cost_share'] = round(row['cost_usd'] / total['cost_usd'] * 100, 1) if total['cost_usd'] else 0
+
+    return {
+        'source': source,
+        'models': models,
+        'total': total,
+        'top_spenders': get_top_spenders(start, end),
+    }
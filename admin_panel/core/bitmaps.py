@@ -0,0 +1,331 @@
+"""
+Битмапы сегментов в Redis и составные сегменты.
+
+Каждый пользователь получает плотный номер (app.user_bitmap_index.idx),
+состав сегмента хранится в Redis строкой-битмапом: бит idx = 1, если
+пользователь в сегменте. Пересечение / объединение / разность считаются
+BITOP на стороне Redis за микросекунды, без подзапросов и UUID-массивов.
+
+Источники битмапов:
+- обычные сегменты — из segment_members (после refresh_segment_members)
+- рассылки — кому сообщение доставлено (record_broadcast_delivery)
+
+Формат set_expression составного сегмента:
+    "premium"                              — сегмент по slug
+    {"broadcast": "<uuid>"}                — получившие рассылку
+    {"union": [expr, ...]}
+    {"intersect": [expr, ...]}
+    {"exclude": [base, expr, ...]}         — base минус остальные
+
+Пример: "premium ∩ active_writers − получившие рассылку X"
+    {"exclude": [{"intersect": ["premium", "active_writers"]}, {"broadcast": "..."}]}
+"""
+
+import uuid
+from typing import Any, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from admin_panel.utils import get_redis
+
+from .segments import SegmentRuleError
+
+
+SET_OPERATORS = ('union', 'intersect', 'exclude')
+
+# Временные ключи промежуточных BITOP
+TEMP_KEY_TTL = 60
+
+# Биты байта в порядке Redis (бит 0 — старший бит первого байта)
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+
+def segment_bitmap_key(segment_id) -> str:
+    return f'segment_bitmap:{segment_id}'
+
+
+def broadcast_bitmap_key(broadcast_id) -> str:
+    return f'broadcast_delivered:{broadcast_id}'
+
+
+def encode_bitmap(indexes: Iterable[int]) -> bytes:
+    """Список номеров → битмап в формате Redis."""
+    indexes = list(indexes)
+    if not indexes:
+        return b''
+    data = bytearray((max(indexes) >> 3) + 1)
+    for idx in indexes:
+        data[idx >> 3] |= 0x80 >> (idx & 7)
+    return bytes(data)
+
+
+def decode_bitmap(data: Optional[bytes]) -> List[int]:
+    """Битмап в формате Redis → отсортированный список номеров."""
+    result = []
+    if not data:
+        return result
+    for byte_index, byte in enumerate(data):
+        if byte:
+            base = byte_index << 3
+            result.extend(base + bit for bit in _BYTE_BITS[byte])
+    return result
+
+
+# ============================================================================
+# ИНДЕКС ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================================
+
+def ensure_bitmap_index() -> int:
+    """Выдаёт номера пользователям, у которых их ещё нет. Возвращает число новых."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO app.user_bitmap_index (user_id)
+            SELECT u.id FROM app.users u
+            WHERE NOT EXISTS (SELECT 1 FROM app.user_bitmap_index b WHERE b.user_id = u.id)
+            ORDER BY u.date_created
+            ON CONFLICT (user_id) DO NOTHING
+        """)
+        return cursor.rowcount
+
+
+def _fetch_indexes(sql: str, params: list) -> List[int]:
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+# ============================================================================
+# БИТМАПЫ ИСТОЧНИКОВ
+# ============================================================================
+
+def store_segment_bitmap(segment) -> int:
+    """
+    Перестраивает битмап сегмента из segment_members.
+    Возвращает число пользователей в битмапе.
+    """
+    indexes = _fetch_indexes("""
+        SELECT b.idx
+        FROM app.segment_members m
+        JOIN app.user_bitmap_index b ON b.user_id = m.user_id
+        WHERE m.segment_id = %s
+    """, [segment.id])
+
+    redis = get_redis()
+    key = segment_bitmap_key(segment.id)
+    if indexes:
+        redis.set(key, encode_bitmap(indexes))
+    else:
+        redis.delete(key)
+    return len(indexes)
+
+
+def record_broadcast_delivery(broadcast_id, telegram_ids: List[int]) -> int:
+    """
+    Отмечает в битмапе рассылки пользователей, которым сообщение доставлено.
+    Вызывается один раз в конце execute_broadcast.
+    """
+    if not telegram_ids:
+        return 0
+
+    ensure_bitmap_index()
+    redis = get_redis()
+    key = broadcast_bitmap_key(broadcast_id)
+    recorded = 0
+
+    chunk_size = 10_000
+    for start in range(0, len(telegram_ids), chunk_size):
+        indexes = _fetch_indexes("""
+            SELECT b.idx
+            FROM app.users u
+            JOIN app.user_bitmap_index b ON b.user_id = u.id
+            WHERE u.telegram_id = ANY(%s)
+        """, [list(telegram_ids[start:start + chunk_size])])
+
+        pipe = redis.pipeline(transaction=False)
+        for idx in indexes:
+            pipe.setbit(key, idx, 1)
+        pipe.execute()
+        recorded += len(indexes)
+
+    ttl_days = getattr(settings, 'BROADCAST_DELIVERY_BITMAP_TTL_DAYS', 180)
+    redis.expire(key, ttl_days * 24 * 3600)
+    return recorded
+
+
+# ============================================================================
+# ВЫРАЖЕНИЯ НАД СЕГМЕНТАМИ
+# ============================================================================
+
+def validate_set_expression(expression: Any, parents: tuple = ()) -> None:
+    """
+    Проверяет set_expression: операторы, существование сегментов, отсутствие циклов.
+    parents — slug'и составных сегментов выше по цепочке (включая проверяемый).
+
+    Raises:
+        SegmentRuleError: если выражение некорректно
+    """
+    from .models import UserSegment
+
+    if isinstance(expression, str):
+        segment = UserSegment.objects.filter(slug=expression).only('slug', 'segment_type', 'set_expression').first()
+        if segment is None:
+            raise SegmentRuleError(f'Сегмент {expression!r} не найден')
+        if expression in parents:
+            raise SegmentRuleError(f'Циклическая ссылка на сегмент {expression!r}')
+        if segment.segment_type == 'composite':
+            validate_set_expression(segment.set_expression, parents + (expression,))
+        return
+
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise SegmentRuleError(
+            f'Ожидается slug сегмента или объект с одним ключом '
+            f'({", ".join(SET_OPERATORS)}, broadcast), получено {expression!r}'
+        )
+
+    (op, operand), = expression.items()
+    if op == 'broadcast':
+        try:
+            uuid.UUID(str(operand))
+        except ValueError:
+            raise SegmentRuleError(f'broadcast: ожидается UUID рассылки, получено {operand!r}')
+        return
+
+    if op not in SET_OPERATORS:
+        raise SegmentRuleError(f'Неизвестный оператор {op!r}')
+    if not isinstance(operand, list) or not operand:
+        raise SegmentRuleError(f'{op}: ожидается непустой список')
+    if op == 'exclude' and len(operand) < 2:
+        raise SegmentRuleError('exclude: ожидается [base, что_исключить, ...]')
+    for item in operand:
+        validate_set_expression(item, parents)
+
+
+class _Evaluator:
+    """Вычисляет выражение в ключ Redis, собирая временные ключи для удаления."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.temp_keys = []
+
+    def _temp_key(self) -> str:
+        key = f'segment_bitmap:tmp:{uuid.uuid4().hex}'
+        self.temp_keys.append(key)
+        return key
+
+    def _bitop(self, op: str, keys: List[str]) -> str:
+        if len(keys) == 1:
+            return keys[0]
+        dest = self._temp_key()
+        self.redis.bitop(op, dest, *keys)
+        self.redis.expire(dest, TEMP_KEY_TTL)
+        return dest
+
+    def segment_key(self, slug: str) -> str:
+        from .models import UserSegment
+
+        segment = UserSegment.objects.get(slug=slug)
+        key = segment_bitmap_key(segment.id)
+        if not self.redis.exists(key):
+            if segment.segment_type == 'composite':
+                refresh_composite_members(segment)
+            store_segment_bitmap(segment)
+        return key
+
+    def evaluate(self, expression) -> str:
+        if isinstance(expression, str):
+            return self.segment_key(expression)
+
+        (op, operand), = expression.items()
+        if op == 'broadcast':
+            return broadcast_bitmap_key(operand)
+
+        keys = [self.evaluate(item) for item in operand]
+        if op == 'union':
+            return self._bitop('OR', keys)
+        if op == 'intersect':
+            return self._bitop('AND', keys)
+
+        # exclude: base XOR (base AND (a OR b ...)).
+        # BITOP NOT не подходит: короткий битмап дополняется нулями, а не единицами.
+        base, excluded = keys[0], self._bitop('OR', keys[1:])
+        common = self._bitop('AND', [base, excluded])
+        return self._bitop('XOR', [base, common])
+
+    def cleanup(self):
+        if self.temp_keys:
+            self.redis.delete(*self.temp_keys)
+
+
+def evaluate_set_expression(expression: Any) -> List[int]:
+    """Номера пользователей (idx), удовлетворяющих выражению."""
+    validate_set_expression(expression)
+
+    redis = get_redis()
+    evaluator = _Evaluator(redis)
+    try:
+        return decode_bitmap(redis.get(evaluator.evaluate(expression)))
+    finally:
+        evaluator.cleanup()
+
+
+# ============================================================================
+# СОСТАВ СОСТАВНЫХ СЕГМЕНТОВ
+# ============================================================================
+
+def refresh_composite_members(segment) -> dict:
+    """
+    Пересчитывает segment_members составного сегмента из битмапов источников.
+
+    Результат BITOP загружается во временную таблицу и сравнивается
+    с текущим составом (удалить лишних, добавить недостающих активных).
+    """
+    from .models import UserSegment
+    from .segments import membership_signature
+
+    started_at = timezone.now()
+    indexes = evaluate_set_expression(segment.set_expression)
+
+    chunk_size = 50_000
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE tmp_composite_members (idx BIGINT PRIMARY KEY) ON COMMIT DROP")
+        for start in range(0, len(indexes), chunk_size):
+            cursor.execute(
+                "INSERT INTO tmp_composite_members (idx) SELECT unnest(%s::bigint[])",
+                [indexes[start:start + chunk_size]],
+            )
+
+        cursor.execute("""
+            DELETE FROM app.segment_members m
+            WHERE m.segment_id = %s
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM tmp_composite_members t
+                  JOIN app.user_bitmap_index b ON b.idx = t.idx
+                  WHERE b.user_id = m.user_id
+              )
+        """, [segment.id])
+        removed = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO app.segment_members (segment_id, user_id, date_added)
+            SELECT %s, b.user_id, NOW()
+            FROM tmp_composite_members t
+            JOIN app.user_bitmap_index b ON b.idx = t.idx
+            JOIN app.users u ON u.id = b.user_id AND u.status = 'active'
+            ON CONFLICT (segment_id, user_id) DO NOTHING
+        """, [segment.id])
+        added = cursor.rowcount
+
+        cursor.execute("SELECT COUNT(*) FROM app.segment_members WHERE segment_id = %s", [segment.id])
+        count = cursor.fetchone()[0]
+
+        UserSegment.objects.filter(id=segment.id).update(
+            members_refreshed_at=started_at,
+            members_rules_hash=membership_signature(segment),
+            cached_user_count=count,
+            cache_updated_at=started_at,
+        )
+
+    return {'full': True, 'added': added, 'removed': removed, 'count': count}
@@ -3,20 +3,41 @@
 Содержит метрики: Пульс, Деньги, Удержание.
 """
 
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from decimal import Decimal
-from django.db import connection
-from django.db.models import Count, Sum, Avg, F
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Sum, F, Q
 from django.db.models.functions import TruncDate
 from django.utils import timezone
+from redis.exceptions import RedisError
 
-from .models import User, JournalEntry, Transaction, Subscription, UsageLog, Habit, HabitCompletion
+from .ai_analytics import get_ai_analytics
+from .dashboard_cache import get_cached_block, period_scope
+from .db_router import reporting_connection, use_replica
+from .instrumentation import get_slow_endpoints, is_enabled as instrumentation_enabled
+from .models import User, JournalEntry, DailyMetric, Transaction, Subscription, UsageLog
+from .retention import MAX_WINDOW_DAYS, get_retention_matrix
+from .rollups import local_day_bounds
+from .sketches import ACTIVITY_SOURCES, count_unique_users, count_unique_users_by_bucket, sketches_filled_since
+
+
+logger = logging.getLogger(__name__)
+
+
+def local_day_start(moment=None):
+    """Начало суток в часовом поясе проекта (TIME_ZONE, Europe/Moscow)."""
+    moment = moment or timezone.now()
+    return timezone.localtime(moment).replace(hour=0, minute=0, second=0, microsecond=0)
 
 
 def get_date_range(period: str = 'today', start_date=None, end_date=None):
-    """Получить диапазон дат по периоду."""
+    """Получить диапазон дат по периоду (сутки считаются по московскому времени)."""
     now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = local_day_start(now)
     
     if period == 'today':
         return today, now
@@ -42,52 +63,158 @@ def get_date_range(period: str = 'today', start_date=None, end_date=None):
 # БЛОК 1: ПУЛЬС (Жив ли пациент?) 💓
 # ============================================================================
 
+def rollup_days(start_date, end_date):
+    """
+    Дни daily_metrics, покрывающие период [start_date, end_date).
+    Периоды дашборда начинаются с полуночи по местному времени; сегодняшний
+    день в rollup обновляется каждые 5 минут (core.tasks.update_daily_metrics).
+    """
+    first_day = timezone.localtime(start_date).date()
+    last_day = timezone.localtime(end_date - timedelta(microseconds=1)).date()
+    return first_day, last_day
+
+
+def split_partial_day(start_date, end_date):
+    """
+    Период [start_date, end_date) → целые дни для rollup (first_day, last_day)
+    и неполный последний день (tail_start, end_date) или None, если период
+    кончается в полночь. Период внутри одних суток — пустые дни (last_day < first_day).
+    """
+    tail_start = local_day_start(end_date)
+    days = (timezone.localtime(start_date).date(), tail_start.date() - timedelta(days=1))
+    if tail_start == end_date:
+        return days, None
+    return days, (max(tail_start, start_date), end_date)
+
+
+def get_rollup_totals(start_date, end_date, **aggregates):
+    """Суммы по daily_metrics за период: get_rollup_totals(s, e, total=Sum('signups'))."""
+    first_day, last_day = rollup_days(start_date, end_date)
+    return DailyMetric.objects.filter(day__range=(first_day, last_day)).aggregate(**aggregates)
+
+
+# Источники активности для точного подсчёта (те же, что у скетчей core.sketches)
+ACTIVITY_TABLES = {
+    'entries': 'app.journal_entries',
+    'habits': 'app.habit_completions',
+}
+
+
+def _count_active_users_exact(windows):
+    """
+    Точный DISTINCT для нескольких окон одним проходом: строки активности
+    за общий интервал, по окну — COUNT(DISTINCT) FILTER.
+    """
+    sources = sorted({source for _, _, window_sources in windows.values() for source in window_sources})
+    params = {
+        'span_start': min(start for start, _, _ in windows.values()),
+        'span_end': max(end for _, end, _ in windows.values()),
+    }
+    union = '\nUNION ALL\n'.join(
+        f"SELECT user_id, date_created, '{source}' AS source FROM {ACTIVITY_TABLES[source]} "
+        f"WHERE date_created >= %(span_start)s AND date_created < %(span_end)s"
+        for source in sources
+    )
+    columns = []
+    for position, (start, end, window_sources) in enumerate(windows.values()):
+        params[f'start_{position}'] = start
+        params[f'end_{position}'] = end
+        source_list = ', '.join(f"'{source}'" for source in window_sources)
+        columns.append(
+            f"COUNT(DISTINCT user_id) FILTER (WHERE date_created >= %(start_{position})s "
+            f"AND date_created < %(end_{position})s AND source IN ({source_list}))"
+        )
+    
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(columns)} FROM ({union}) AS activity", params)
+        return dict(zip(windows, cursor.fetchone()))
+
+
+def get_active_users_windows(windows):
+    """
+    Уникальные активные пользователи (записи и/или выполнения привычек)
+    для нескольких окон сразу: {name: (start, end, sources)} → {name: count}.
+    
+    По умолчанию — объединение дневных HyperLogLog-скетчей в Redis (погрешность ~1%).
+    Скетч покрывает сутки целиком, поэтому точный DISTINCT в SQL (один запрос
+    на все такие окна) — для окон, начинающихся раньше sketches_filled_since(),
+    окон с неполным прошлым днём («вчера до 10:00»), при DASHBOARD_EXACT_UNIQUES=True
+    и недоступном Redis. Сегодняшний скетч — активность до текущего момента.
+    """
+    counts = {}
+    exact = dict(windows)
+    if not getattr(settings, 'DASHBOARD_EXACT_UNIQUES', False):
+        try:
+            filled_since = sketches_filled_since()
+            today = timezone.localdate()
+            for name, (start, end, sources) in windows.items():
+                first_day, last_day = rollup_days(start, end)
+                _, tail = split_partial_day(start, end)
+                whole_days = tail is None or last_day >= today
+                if filled_since is not None and first_day >= filled_since and whole_days:
+                    counts[name] = count_unique_users(first_day, last_day, sources=sources)
+                    del exact[name]
+        except RedisError as e:
+            logger.warning(f"Activity sketches unavailable, counting exactly: {e}")
+            counts, exact = {}, dict(windows)
+    if exact:
+        counts.update(_count_active_users_exact(exact))
+    return counts
+
+
+def get_active_users(start_date, end_date, sources=ACTIVITY_SOURCES):
+    """Уникальные активные пользователи за период."""
+    return get_active_users_windows({'value': (start_date, end_date, sources)})['value']
+
+
 def get_dau(start_date, end_date):
     """
-    DAU (Daily Active Users) - уникальные пользователи, сделавшие запись.
+    DAU (Daily Active Users) - уникальные пользователи, сделавшие запись
+    или отметившие привычку.
     """
-    return JournalEntry.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date
-    ).values('user_id').distinct().count()
+    return get_active_users(start_date, end_date)
+
+
+def rolling_window_start(end_date, days):
+    """Начало окна WAU / MAU: days суток по момент end_date, с полуночи первого дня."""
+    last_day = timezone.localtime(end_date - timedelta(microseconds=1)).date()
+    start, _ = local_day_bounds(last_day - timedelta(days=days - 1), last_day)
+    return start
+
+
+def get_rolling_active_users(end_date, days):
+    """WAU / MAU: уникальные активные за days суток по момент end_date."""
+    return get_active_users(rolling_window_start(end_date, days), end_date)
 
 
 def get_entries_count(start_date, end_date):
     """
     Количество записей за период.
     """
-    return JournalEntry.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date
-    ).count()
+    totals = get_rollup_totals(start_date, end_date, total=Sum(F('entries_text') + F('entries_voice')))
+    return totals['total'] or 0
 
 
 def get_voice_entries_count(start_date, end_date):
     """
     Количество голосовых записей за период.
     """
-    return JournalEntry.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date,
-        is_voice=True
-    ).count()
+    return get_rollup_totals(start_date, end_date, total=Sum('entries_voice'))['total'] or 0
 
 
 def get_new_signups(start_date, end_date):
     """
     Новые пользователи за период.
     """
-    return User.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date
-    ).count()
+    return get_rollup_totals(start_date, end_date, total=Sum('signups'))['total'] or 0
 
 
 def get_entries_per_user(start_date, end_date):
     """
     Среднее количество записей на активного пользователя.
     """
-    dau = get_dau(start_date, end_date)
+    # Среди писавших, а не всех активных
+    dau = get_active_users(start_date, end_date, sources=('entries',))
     entries = get_entries_count(start_date, end_date)
     if dau > 0:
         return round(entries / dau, 2)
@@ -123,14 +250,11 @@ def get_revenue(start_date, end_date):
     """
     Доход за период (успешные транзакции).
     """
-    revenue = Transaction.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date,
-        is_successful=True
-    ).aggregate(
-        total_usd=Sum('amount_usd'),
-        total_stars=Sum('amount_stars'),
-        count=Count('id')
+    revenue = get_rollup_totals(
+        start_date, end_date,
+        total_usd=Sum('revenue_usd'),
+        total_stars=Sum('revenue_stars'),
+        count=Sum('transactions')
     )
     
     return {
@@ -165,13 +289,11 @@ def get_ai_costs(start_date, end_date):
     """
     Расходы на AI за период.
     """
-    costs = UsageLog.objects.filter(
-        date_created__gte=start_date,
-        date_created__lt=end_date
-    ).aggregate(
-        total_cost=Sum('cost_usd'),
-        total_requests=Count('id'),
-        total_tokens=Sum(F('input_tokens') + F('output_tokens'))
+    costs = get_rollup_totals(
+        start_date, end_date,
+        total_cost=Sum('ai_cost_usd'),
+        total_requests=Sum('ai_requests'),
+        total_tokens=Sum('ai_tokens')
     )
     
     return {
@@ -246,7 +368,7 @@ def get_retention_day_n(day_n: int):
     Используем SQL для производительности.
     """
     now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = local_day_start(now)
     
     # Когорта: зарегистрировались (day_n + 1) дней назад
     # Для Day 1: позавчера (2 дня назад)
@@ -272,11 +394,9 @@ def get_retention_day_n(day_n: int):
     if cohort_count == 0:
         return {'rate': 0, 'cohort_size': 0, 'returned': 0}
     
-    # Считаем вернувшихся одним запросом
-    cohort_user_ids = list(cohort_users.values_list('id', flat=True))
-    
+    # Считаем вернувшихся одним запросом (когорта — подзапрос, без выгрузки ID)
     returned = JournalEntry.objects.filter(
-        user_id__in=cohort_user_ids,
+        user_id__in=cohort_users.values('id'),
         date_created__gte=return_day,
         date_created__lt=return_next_day
     ).values('user_id').distinct().count()
@@ -308,50 +428,254 @@ def get_retention_day_30():
 # ============================================================================
 # ГРАФИКИ
 # ============================================================================
+# Каждый график — один запрос: generate_series по корзинам (час, день,
+# неделя, месяц по московскому времени) + LEFT JOIN агрегатов GROUP BY корзина
+# для каждой серии. Размер корзины подбирается по длине периода, чтобы точек
+# было не больше CHART_MAX_POINTS: год — ~52 недели из daily_metrics, сутки —
+# 24 часа из сырых таблиц (в rollup нет часов, но и строк за сутки немного).
+
+CHART_MAX_POINTS = 92
+
+# Корзины от мелкой к крупной: (единица date_trunc, шаг generate_series, примерная длина)
+CHART_BUCKETS = (
+    ('hour', '1 hour', timedelta(hours=1)),
+    ('day', '1 day', timedelta(days=1)),
+    ('week', '1 week', timedelta(days=7)),
+    ('month', '1 month', timedelta(days=31)),
+)
+
+CHART_LABEL_FORMATS = {
+    'day': '%d.%m',
+    'week': '%d.%m',
+    'month': '%m.%Y',
+}
+
+
+def chart_bucket(date_start, date_end):
+    """Самая мелкая корзина, при которой в периоде не больше CHART_MAX_POINTS точек."""
+    span = date_end - date_start
+    for unit, _, size in CHART_BUCKETS:
+        if span / size <= CHART_MAX_POINTS:
+            return unit
+    return CHART_BUCKETS[-1][0]
+
+
+def _bucket_start(day, unit):
+    """Начало корзины, в которую попадает день (как date_trunc, без часового пояса)."""
+    if unit == 'week':
+        day -= timedelta(days=day.weekday())
+    elif unit == 'month':
+        day = day.replace(day=1)
+    return datetime.combine(day, datetime.min.time())
 
-def get_users_chart_data(days=14):
+
+def chart_window(date_start, date_end):
+    """
+    Окно графика по периоду дашборда.
+    
+    Returns:
+        {unit, step, first_day, last_day, start, end, first_bucket, last_bucket}
+        Для часовых корзин start/end — сам период, иначе — целые сутки
+        first_day..last_day; first_bucket/last_bucket — местное время без пояса.
+    """
+    unit = chart_bucket(date_start, date_end)
+    step = next(step for bucket, step, _ in CHART_BUCKETS if bucket == unit)
+    first_day, last_day = rollup_days(date_start, date_end)
+    
+    if unit == 'hour':
+        start, end = date_start, date_end
+        first_bucket = timezone.localtime(date_start).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+        last_bucket = timezone.localtime(date_end - timedelta(microseconds=1)).replace(
+            minute=0, second=0, microsecond=0, tzinfo=None,
+        )
+    else:
+        start, end = local_day_bounds(first_day, last_day)
+        first_bucket = _bucket_start(first_day, unit)
+        last_bucket = _bucket_start(last_day, unit)
+    
+    return {
+        'unit': unit,
+        'step': step,
+        'first_day': first_day,
+        'last_day': last_day,
+        'start': start,
+        'end': end,
+        'first_bucket': first_bucket,
+        'last_bucket': last_bucket,
+    }
+
+
+def _bucket_label(bucket, window):
+    if window['unit'] == 'hour':
+        # Период длиннее суток — к часу добавляем дату
+        if window['first_bucket'].date() == window['last_bucket'].date():
+            return bucket.strftime('%H:00')
+        return bucket.strftime('%d.%m %H:00')
+    return bucket.strftime(CHART_LABEL_FORMATS[window['unit']])
+
+
+def _bucket_series(window, sources: dict):
+    """
+    Выполняет один запрос для нескольких серий по корзинам окна.
+    
+    Args:
+        window: chart_window(...)
+        sources: {alias: (SQL с колонкой bucket и колонками серий, (имена серий, ...))}.
+                 В SQL доступны параметры %(unit)s, %(start)s, %(end)s,
+                 %(first_day)s, %(last_day)s и %(tz)s (часовой пояс).
+    
+    Returns:
+        (labels, {серия: [значения по корзинам]})
+    """
+    joins = '\n'.join(
+        f'LEFT JOIN ({sql}) AS {alias} ON {alias}.bucket = b.bucket'
+        for alias, (sql, _) in sources.items()
+    )
+    series = [(alias, name) for alias, (_, names) in sources.items() for name in names]
+    columns = ', '.join(f'COALESCE({alias}.{name}, 0)' for alias, name in series)
+    
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(f"""
+            SELECT b.bucket, {columns}
+            FROM (
+                SELECT generate_series(
+                    %(first_bucket)s::timestamp, %(last_bucket)s::timestamp, %(step)s::interval
+                ) AS bucket
+            ) AS b
+            {joins}
+            ORDER BY b.bucket
+        """, {
+            'unit': window['unit'],
+            'step': window['step'],
+            'first_bucket': window['first_bucket'],
+            'last_bucket': window['last_bucket'],
+            'first_day': window['first_day'],
+            'last_day': window['last_day'],
+            'start': window['start'],
+            'end': window['end'],
+            'tz': settings.TIME_ZONE,
+        })
+        rows = cursor.fetchall()
+    
+    labels = [_bucket_label(row[0], window) for row in rows]
+    values = {
+        name: [row[position] for row in rows]
+        for position, (_, name) in enumerate(series, start=1)
+    }
+    return labels, values
+
+
+# Суточные метрики из rollup (app.daily_metrics), дни уже по местному времени
+def _rollup_source(*sums):
+    """Источник для _bucket_series: SUM(выражение) AS серия по корзинам из daily_metrics."""
+    columns = ', '.join(f'SUM({expression}) AS {name}' for name, expression in sums)
+    return (f"""
+        SELECT date_trunc(%(unit)s, day::timestamp) AS bucket, {columns}
+        FROM app.daily_metrics
+        WHERE day BETWEEN %(first_day)s AND %(last_day)s
+        GROUP BY 1
+    """, tuple(name for name, _ in sums))
+
+
+def _raw_source(table, aggregates, condition=''):
+    """Источник для _bucket_series из сырой таблицы (часовые корзины, которых нет в rollup)."""
+    columns = ', '.join(f'{expression} AS {name}' for name, expression in aggregates)
+    return (f"""
+        SELECT date_trunc(%(unit)s, date_created AT TIME ZONE %(tz)s) AS bucket, {columns}
+        FROM {table}
+        WHERE date_created >= %(start)s AND date_created < %(end)s {condition}
+        GROUP BY 1
+    """, tuple(name for name, _ in aggregates))
+
+
+def _metric_source(window, rollup_sums, table, raw_aggregates, condition=''):
+    """Серии из daily_metrics, а для часовых корзин — из сырой таблицы."""
+    if window['unit'] == 'hour':
+        return _raw_source(table, raw_aggregates, condition)
+    return _rollup_source(*rollup_sums)
+
+
+def _active_users_source():
+    """Точный DISTINCT активных (записи + привычки) по корзинам."""
+    union = '\nUNION ALL\n'.join(
+        f"SELECT user_id, date_created FROM {table} "
+        f"WHERE date_created >= %(start)s AND date_created < %(end)s"
+        for table in ACTIVITY_TABLES.values()
+    )
+    return (f"""
+        SELECT date_trunc(%(unit)s, date_created AT TIME ZONE %(tz)s) AS bucket,
+               COUNT(DISTINCT user_id) AS active_users
+        FROM ({union}) AS activity
+        GROUP BY 1
+    """, ('active_users',))
+
+
+def _sketch_buckets(window):
+    """Дни [first_day, last_day] корзин окна — для PFCOUNT по скетчам."""
+    buckets = []
+    bucket = window['first_bucket'].date()
+    while bucket <= window['last_day']:
+        if window['unit'] == 'week':
+            next_bucket = bucket + timedelta(days=7)
+        elif window['unit'] == 'month':
+            next_bucket = (bucket + timedelta(days=31)).replace(day=1)
+        else:
+            next_bucket = bucket + timedelta(days=1)
+        buckets.append((max(bucket, window['first_day']), min(next_bucket - timedelta(days=1), window['last_day'])))
+        bucket = next_bucket
+    return buckets
+
+
+def _sketches_cover(window):
+    """Есть ли полные скетчи за все дни окна (иначе считаем точно)."""
+    try:
+        filled_since = sketches_filled_since()
+    except RedisError as e:
+        logger.warning(f"Activity sketches unavailable, counting exactly: {e}")
+        return False
+    return filled_since is not None and window['first_day'] >= filled_since
+
+
+def get_users_chart_data(window):
     """
     Данные для графика: Новые юзеры vs Активные юзеры.
     """
-    now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    labels = []
-    new_users_data = []
-    active_users_data = []
-    
-    for i in range(days - 1, -1, -1):
-        day_start = today - timedelta(days=i)
-        day_end = day_start + timedelta(days=1)
-        
-        labels.append(day_start.strftime('%d.%m'))
-        
-        # Новые пользователи
-        new_count = User.objects.filter(
-            date_created__gte=day_start,
-            date_created__lt=day_end
-        ).count()
-        new_users_data.append(new_count)
-        
-        # Активные пользователи (сделавшие запись)
-        active_count = JournalEntry.objects.filter(
-            date_created__gte=day_start,
-            date_created__lt=day_end
-        ).values('user_id').distinct().count()
-        active_users_data.append(active_count)
+    sources = {
+        'signups': _metric_source(window, (('new_users', 'signups'),), 'app.users', (('new_users', 'COUNT(*)'),)),
+    }
+    # Активные по корзинам — из скетчей (записи + привычки), как DAU в пульсе;
+    # часы, старые периоды и DASHBOARD_EXACT_UNIQUES — точным DISTINCT в том же запросе
+    use_sketches = (
+        window['unit'] != 'hour'
+        and not getattr(settings, 'DASHBOARD_EXACT_UNIQUES', False)
+        and _sketches_cover(window)
+    )
+    if not use_sketches:
+        sources['activity'] = _active_users_source()
+    
+    labels, values = _bucket_series(window, sources)
+    
+    if use_sketches:
+        try:
+            values['active_users'] = count_unique_users_by_bucket(_sketch_buckets(window))
+        except RedisError as e:
+            logger.warning(f"Activity sketches unavailable, counting exactly: {e}")
+            _, exact = _bucket_series(window, {'activity': _active_users_source()})
+            values['active_users'] = exact['active_users']
     
     return {
         'labels': labels,
+        'bucket': window['unit'],
         'datasets': [
             {
                 'label': 'Новые пользователи',
-                'data': new_users_data,
+                'data': values['new_users'],
                 'borderColor': '#8B5CF6',
                 'backgroundColor': 'rgba(139, 92, 246, 0.1)',
             },
             {
                 'label': 'Активные пользователи',
-                'data': active_users_data,
+                'data': values['active_users'],
                 'borderColor': '#10B981',
                 'backgroundColor': 'rgba(16, 185, 129, 0.1)',
             }
@@ -359,36 +683,27 @@ def get_users_chart_data(days=14):
     }
 
 
-def get_revenue_chart_data(days=14):
+def get_revenue_chart_data(window):
     """
-    Данные для графика: Доход по дням.
+    Данные для графика: Доход по корзинам периода.
     """
-    now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    labels = []
-    revenue_data = []
-    
-    for i in range(days - 1, -1, -1):
-        day_start = today - timedelta(days=i)
-        day_end = day_start + timedelta(days=1)
-        
-        labels.append(day_start.strftime('%d.%m'))
-        
-        revenue = Transaction.objects.filter(
-            date_created__gte=day_start,
-            date_created__lt=day_end,
-            is_successful=True
-        ).aggregate(total=Sum('amount_usd'))
-        
-        revenue_data.append(float(revenue['total'] or 0))
+    labels, values = _bucket_series(window, {
+        'metrics': _metric_source(
+            window,
+            (('revenue', 'revenue_usd'),),
+            'app.transactions',
+            (('revenue', 'SUM(amount_usd)'),),
+            'AND is_successful',
+        ),
+    })
     
     return {
         'labels': labels,
+        'bucket': window['unit'],
         'datasets': [
             {
                 'label': 'Доход ($)',
-                'data': revenue_data,
+                'data': [float(value) for value in values['revenue']],
                 'borderColor': '#F59E0B',
                 'backgroundColor': 'rgba(245, 158, 11, 0.1)',
                 'fill': True,
@@ -397,49 +712,32 @@ def get_revenue_chart_data(days=14):
     }
 
 
-def get_entries_chart_data(days=14):
+def get_entries_chart_data(window):
     """
-    Данные для графика: Записи по дням (текст vs голос).
+    Данные для графика: Записи по корзинам периода (текст vs голос).
     """
-    now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    labels = []
-    text_data = []
-    voice_data = []
-    
-    for i in range(days - 1, -1, -1):
-        day_start = today - timedelta(days=i)
-        day_end = day_start + timedelta(days=1)
-        
-        labels.append(day_start.strftime('%d.%m'))
-        
-        text_count = JournalEntry.objects.filter(
-            date_created__gte=day_start,
-            date_created__lt=day_end,
-            is_voice=False
-        ).count()
-        text_data.append(text_count)
-        
-        voice_count = JournalEntry.objects.filter(
-            date_created__gte=day_start,
-            date_created__lt=day_end,
-            is_voice=True
-        ).count()
-        voice_data.append(voice_count)
+    labels, values = _bucket_series(window, {
+        'metrics': _metric_source(
+            window,
+            (('text_entries', 'entries_text'), ('voice_entries', 'entries_voice')),
+            'app.journal_entries',
+            (('text_entries', 'COUNT(*) FILTER (WHERE NOT is_voice)'), ('voice_entries', 'COUNT(*) FILTER (WHERE is_voice)')),
+        ),
+    })
     
     return {
         'labels': labels,
+        'bucket': window['unit'],
         'datasets': [
             {
                 'label': 'Текстовые',
-                'data': text_data,
+                'data': values['text_entries'],
                 'borderColor': '#3B82F6',
                 'backgroundColor': 'rgba(59, 130, 246, 0.5)',
             },
             {
                 'label': 'Голосовые',
-                'data': voice_data,
+                'data': values['voice_entries'],
                 'borderColor': '#EC4899',
                 'backgroundColor': 'rgba(236, 72, 153, 0.5)',
             }
@@ -451,134 +749,207 @@ def get_entries_chart_data(days=14):
 # БЛОК 4: ПРИВЫЧКИ (Habit Tracker) 📊
 # ============================================================================
 
+# Подписи частот привычек (enum app.habit_frequency)
+HABIT_FREQUENCY_LABELS = {
+    'daily': 'Каждый день',
+    'weekdays': 'По будням',
+    'weekends': 'По выходным',
+    'custom': 'Свои дни',
+}
+
+# Привычки одним проходом: итоги и строки по частоте (GROUPING SETS).
+# scheduled — сколько дней периода привычка была запланирована, начиная с дня
+# создания: по 7 дням недели считается число таких дней в [since, last_day]
+# (расписание как в calculateHabitStreak на сервере; custom_days: 0=пн..6=вс).
+# total_users — COUNT(*) по users тем же запросом: daily_metrics покрывает только
+# дни после backfill, и сумма регистраций занизила бы знаменатель adoption_rate.
+HABITS_STATS_SQL = """
+    SELECT
+        GROUPING(h.frequency) AS is_total,
+        h.frequency::text,
+        COUNT(*) FILTER (WHERE NOT h.is_archived),
+        COUNT(*) FILTER (WHERE h.is_active AND NOT h.is_archived),
+        COUNT(DISTINCT h.user_id) FILTER (WHERE NOT h.is_archived),
+        AVG(h.current_streak) FILTER (WHERE h.is_active AND NOT h.is_archived),
+        MAX(h.longest_streak) FILTER (WHERE NOT h.is_archived),
+        COALESCE(SUM(s.scheduled) FILTER (WHERE h.is_active AND NOT h.is_archived), 0),
+        (SELECT COUNT(*) FROM app.users)
+    FROM app.habits h
+    CROSS JOIN LATERAL (
+        SELECT COALESCE(SUM(CASE WHEN d.offset_days <= d.span THEN (d.span - d.offset_days) / 7 + 1 ELSE 0 END), 0) AS scheduled
+        FROM (
+            SELECT
+                w.dow,
+                (w.dow - (EXTRACT(ISODOW FROM since.day)::int - 1) + 7) %% 7 AS offset_days,
+                %(last_day)s::date - since.day AS span
+            FROM (SELECT GREATEST((h.date_created AT TIME ZONE %(tz)s)::date, %(first_day)s::date) AS day) AS since
+            CROSS JOIN generate_series(0, 6) AS w(dow)
+        ) AS d
+        WHERE CASE h.frequency::text
+            WHEN 'weekdays' THEN d.dow <= 4
+            WHEN 'weekends' THEN d.dow >= 5
+            WHEN 'custom' THEN d.dow = ANY(h.custom_days)
+            ELSE true
+        END
+    ) AS s
+    GROUP BY GROUPING SETS ((h.frequency), ())
+"""
+
+# Выполнения за период и за сегодня одним проходом по habit_completions
+HABIT_COMPLETIONS_SQL = """
+    SELECT
+        GROUPING(h.frequency) AS is_total,
+        h.frequency::text,
+        COUNT(*) FILTER (WHERE c.completed_date BETWEEN %(first_day)s AND %(last_day)s),
+        COUNT(*) FILTER (
+            WHERE c.completed_date BETWEEN %(first_day)s AND %(last_day)s
+              AND h.is_active AND NOT h.is_archived
+        ),
+        COUNT(*) FILTER (WHERE c.completed_date = %(today)s),
+        COUNT(DISTINCT c.user_id) FILTER (WHERE c.completed_date = %(today)s)
+    FROM app.habit_completions c
+    JOIN app.habits h ON h.id = c.habit_id
+    WHERE c.completed_date BETWEEN LEAST(%(first_day)s::date, %(today)s::date)
+                               AND GREATEST(%(last_day)s::date, %(today)s::date)
+    GROUP BY GROUPING SETS ((h.frequency), ())
+"""
+
+
+def _completion_rate(completions, scheduled):
+    return round(completions / scheduled * 100, 1) if scheduled else None
+
+
 def get_habits_stats(start_date=None, end_date=None):
     """
-    Общая статистика по привычкам.
+    Общая статистика по привычкам: два запроса (привычки и выполнения),
+    каждый — итог и строки по частоте через GROUPING SETS.
+
+    completion_rate — выполнения активных привычек за период / запланированные
+    на период дни этих привычек, %.
     """
-    from django.db.models import Max
-    
     now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = local_day_start(now)
     
     # Если даты не заданы, берём за последние 30 дней
     if not start_date:
         start_date = today - timedelta(days=30)
     if not end_date:
         end_date = now
-    
-    # Общее количество привычек
-    total_habits = Habit.objects.filter(is_archived=False).count()
-    active_habits = Habit.objects.filter(is_active=True, is_archived=False).count()
-    
-    # Пользователей с привычками
-    users_with_habits = Habit.objects.filter(
-        is_archived=False
-    ).values('user_id').distinct().count()
-    
-    # Всего пользователей
-    total_users = User.objects.count()
-    
-    # Привычек на пользователя (в среднем)
-    habits_per_user = round(total_habits / users_with_habits, 2) if users_with_habits > 0 else 0
-    
-    # Процент пользователей с привычками
-    adoption_rate = round(users_with_habits / total_users * 100, 1) if total_users > 0 else 0
-    
-    # Выполнения за период
-    completions_in_period = HabitCompletion.objects.filter(
-        completed_date__gte=start_date,
-        completed_date__lt=end_date
-    ).count()
-    
-    # Выполнения сегодня
-    completions_today = HabitCompletion.objects.filter(
-        completed_date__gte=today
-    ).count()
-    
-    # Активных юзеров с привычками сегодня
-    active_users_today = HabitCompletion.objects.filter(
-        completed_date__gte=today
-    ).values('user_id').distinct().count()
-    
-    # Средний стрик
-    avg_streak = Habit.objects.filter(
-        is_active=True,
-        is_archived=False
-    ).aggregate(avg=Avg('current_streak'))['avg'] or 0
-    
-    # Максимальный стрик
-    max_streak = Habit.objects.filter(
-        is_archived=False
-    ).aggregate(max=Max('longest_streak'))['max'] or 0
-    
-    # Распределение по частоте
-    frequency_distribution = Habit.objects.filter(
-        is_archived=False
-    ).values('frequency').annotate(
-        count=Count('id')
-    ).order_by('-count')
-    
-    frequency_stats = {item['frequency']: item['count'] for item in frequency_distribution}
+
+    first_day, last_day = rollup_days(start_date, end_date)
+    params = {
+        'first_day': first_day,
+        'last_day': last_day,
+        'today': timezone.localdate(now),
+        'tz': settings.TIME_ZONE,
+    }
+
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(HABITS_STATS_SQL, params)
+        habit_rows = cursor.fetchall()
+        cursor.execute(HABIT_COMPLETIONS_SQL, params)
+        completion_rows = cursor.fetchall()
+
+    habits = {}
+    total_users = 0
+    for is_total, frequency, total, active, users, avg_streak, max_streak, scheduled, users_total in habit_rows:
+        habits[None if is_total else frequency] = {
+            'total': total,
+            'active': active,
+            'users': users,
+            'avg_streak': avg_streak or 0,
+            'max_streak': max_streak or 0,
+            'scheduled': scheduled,
+        }
+        total_users = users_total
+
+    completions = {
+        None if is_total else frequency: {
+            'in_period': in_period,
+            'active_in_period': active_in_period,
+            'today': today_count,
+            'users_today': users_today,
+        }
+        for is_total, frequency, in_period, active_in_period, today_count, users_today in completion_rows
+    }
+
+    empty_habits = {'total': 0, 'active': 0, 'users': 0, 'avg_streak': 0, 'max_streak': 0, 'scheduled': 0}
+    empty_completions = {'in_period': 0, 'active_in_period': 0, 'today': 0, 'users_today': 0}
+    total = habits.get(None, empty_habits)
+    done = completions.get(None, empty_completions)
+
+    frequency_rates = []
+    for frequency, row in habits.items():
+        if frequency is None:
+            continue
+        row_done = completions.get(frequency, empty_completions)
+        frequency_rates.append({
+            'frequency': frequency,
+            'label': HABIT_FREQUENCY_LABELS.get(frequency, frequency),
+            'habits': row['total'],
+            'active_habits': row['active'],
+            'scheduled': row['scheduled'],
+            'completions': row_done['active_in_period'],
+            'completion_rate': _completion_rate(row_done['active_in_period'], row['scheduled']),
+        })
+    frequency_rates.sort(key=lambda row: row['habits'], reverse=True)
+
+    users_with_habits = total['users']
     
     return {
-        'total_habits': total_habits,
-        'active_habits': active_habits,
+        'total_habits': total['total'],
+        'active_habits': total['active'],
         'users_with_habits': users_with_habits,
-        'habits_per_user': habits_per_user,
-        'adoption_rate': adoption_rate,
-        'completions_in_period': completions_in_period,
-        'completions_today': completions_today,
-        'active_users_today': active_users_today,
-
-        'avg_streak': round(avg_streak, 1),
-        'max_streak': max_streak,
-        'frequency_distribution': frequency_stats,
+        'habits_per_user': round(total['total'] / users_with_habits, 2) if users_with_habits > 0 else 0,
+        'adoption_rate': round(users_with_habits / total_users * 100, 1) if total_users > 0 else 0,
+        'completions_in_period': done['in_period'],
+        'completions_today': done['today'],
+        'active_users_today': done['users_today'],
+        'completion_rate': _completion_rate(done['active_in_period'], total['scheduled']),
+
+        'avg_streak': round(float(total['avg_streak']), 1),
+        'max_streak': total['max_streak'],
+        'frequency_distribution': {row['frequency']: row['habits'] for row in frequency_rates if row['habits']},
+        'frequency_rates': frequency_rates,
     }
 
 
-def get_habits_chart_data(days=14):
+def get_habits_chart_data(window):
     """
-    Данные для графика: Выполнения привычек по дням.
+    Данные для графика: Выполнения привычек по корзинам периода.
     """
-    now = timezone.now()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    labels = []
-    completions_data = []
-    users_data = []
-    
-    for i in range(days - 1, -1, -1):
-        day_start = today - timedelta(days=i)
-        day_end = day_start + timedelta(days=1)
-        
-        labels.append(day_start.strftime('%d.%m'))
-        
-        # Выполнений за день
-        completions = HabitCompletion.objects.filter(
-            completed_date__gte=day_start,
-            completed_date__lt=day_end
-        ).count()
-        completions_data.append(completions)
-        
-        # Активных пользователей с привычками за день
-        active = HabitCompletion.objects.filter(
-            completed_date__gte=day_start,
-            completed_date__lt=day_end
-        ).values('user_id').distinct().count()
-        users_data.append(active)
+    if window['unit'] == 'hour':
+        source = _raw_source('app.habit_completions', (
+            ('completions', 'COUNT(*)'),
+            ('active_users', 'COUNT(DISTINCT user_id)'),
+        ))
+    else:
+        # completed_date — DATE (день по календарю пользователя), часовой пояс не нужен
+        source = ("""
+            SELECT
+                date_trunc(%(unit)s, completed_date::timestamp) AS bucket,
+                COUNT(*) AS completions,
+                COUNT(DISTINCT user_id) AS active_users
+            FROM app.habit_completions
+            WHERE completed_date BETWEEN %(first_day)s AND %(last_day)s
+            GROUP BY 1
+        """, ('completions', 'active_users'))
+    
+    labels, values = _bucket_series(window, {'completions': source})
     
     return {
         'labels': labels,
+        'bucket': window['unit'],
         'datasets': [
             {
                 'label': 'Выполнений привычек',
-                'data': completions_data,
+                'data': values['completions'],
                 'borderColor': '#22C55E',
                 'backgroundColor': 'rgba(34, 197, 94, 0.1)',
             },
             {
                 'label': 'Активных пользователей',
-                'data': users_data,
+                'data': values['active_users'],
                 'borderColor': '#8B5CF6',
                 'backgroundColor': 'rgba(139, 92, 246, 0.1)',
             }
@@ -590,70 +961,102 @@ def get_habits_chart_data(days=14):
 # ВОРОНКА КОНВЕРСИИ
 # ============================================================================
 
+# Метрики этапов воронки: подзапрос по пользователю u (условие — WHERE-часть)
+FUNNEL_METRICS = {
+    'entries': "SELECT 1 FROM app.journal_entries x WHERE x.user_id = u.id",
+    'voice_entries': "SELECT 1 FROM app.journal_entries x WHERE x.user_id = u.id AND x.is_voice",
+    'habits': "SELECT 1 FROM app.habits x WHERE x.user_id = u.id",
+    'habit_completions': "SELECT 1 FROM app.habit_completions x WHERE x.user_id = u.id",
+    'payments': "SELECT 1 FROM app.transactions x WHERE x.user_id = u.id AND x.is_successful",
+}
+
+# Этапы после «Зарегистрировались»; переопределяются DASHBOARD_FUNNEL_STAGES,
+# например {'name': 'Первая привычка', 'metric': 'habits', 'min': 1}
+DEFAULT_FUNNEL_STAGES = [
+    {'name': '1+ запись', 'metric': 'entries', 'min': 1},
+    {'name': '5+ записей', 'metric': 'entries', 'min': 5},
+    {'name': 'Купили подписку', 'metric': 'payments', 'min': 1},
+]
+
+
+def _funnel_metric_sql(metric, threshold):
+    """
+    Значение метрики пользователя, обрезанное сверху порогом:
+    для порога 1 — EXISTS, иначе COUNT по LIMIT threshold строк
+    (дальше порога считать незачем).
+    """
+    subquery = FUNNEL_METRICS[metric]
+    if threshold <= 1:
+        return f"(EXISTS ({subquery}))::int"
+    return f"(SELECT COUNT(*) FROM ({subquery} LIMIT {int(threshold)}) AS capped)"
+
+
 def get_conversion_funnel(days=30):
     """
     Воронка конверсии за последние N дней.
-    Этапы: Зарегистрировались → 1 запись → 5 записей → Купили подписку
-    """
-    from django.db.models import Count
+    Этапы: Зарегистрировались → этапы DASHBOARD_FUNNEL_STAGES
+    (по умолчанию 1 запись → 5 записей → Купили подписку).
     
-    now = timezone.now()
-    start = now - timedelta(days=days)
+    Один проход по новым пользователям: по каждой метрике — коррелированный
+    подзапрос (EXISTS или COUNT с LIMIT), этапы — COUNT(*) FILTER над ними.
+    Число запросов не зависит от числа этапов.
+    """
+    stages = getattr(settings, 'DASHBOARD_FUNNEL_STAGES', None) or DEFAULT_FUNNEL_STAGES
+    for stage in stages:
+        if stage['metric'] not in FUNNEL_METRICS:
+            raise ValueError(f"Unknown funnel metric: {stage['metric']}")
     
-    # Все пользователи за период
-    users = User.objects.filter(date_created__gte=start)
-    total_registered = users.count()
-    
-    if total_registered == 0:
-        return {
-            'stages': [
-                {'name': 'Зарегистрировались', 'count': 0, 'percent': 100},
-                {'name': '1+ запись', 'count': 0, 'percent': 0},
-                {'name': '5+ записей', 'count': 0, 'percent': 0},
-                {'name': 'Купили подписку', 'count': 0, 'percent': 0},
-            ],
-            'period_days': days
-        }
+    start = timezone.now() - timedelta(days=days)
     
-    # Пользователи с 1+ записью
-    users_with_entries = users.annotate(
-        entries_count=Count('entries')
-    ).filter(entries_count__gte=1).count()
+    # Порог метрики — максимальный среди этапов, которые её используют
+    thresholds = {}
+    for stage in stages:
+        thresholds[stage['metric']] = max(thresholds.get(stage['metric'], 0), stage.get('min', 1))
     
-    # Пользователи с 5+ записями
-    users_with_5_entries = users.annotate(
-        entries_count=Count('entries')
-    ).filter(entries_count__gte=5).count()
+    metric_columns = ', '.join(
+        f"{_funnel_metric_sql(metric, threshold)} AS {metric}"
+        for metric, threshold in thresholds.items()
+    )
+    stage_columns = ''.join(
+        f", COUNT(*) FILTER (WHERE {stage['metric']} >= {int(stage.get('min', 1))})"
+        for stage in stages
+    )
     
-    # Пользователи, купившие подписку (есть успешная транзакция)
-    users_paid = Transaction.objects.filter(
-        user__date_created__gte=start,
-        is_successful=True
-    ).values('user_id').distinct().count()
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(f"""
+            SELECT COUNT(*){stage_columns}
+            FROM (
+                SELECT {metric_columns}
+                FROM app.users u
+                WHERE u.date_created >= %s
+            ) AS per_user
+        """, [start])
+        total_registered, *counts = cursor.fetchone()
+    
+    def percent(count):
+        return round(count / total_registered * 100, 1) if total_registered > 0 else 0
+    
+    result_stages = [{'name': 'Зарегистрировались', 'count': total_registered, 'percent': 100}]
+    for stage, count in zip(stages, counts):
+        result_stages.append({
+            'name': stage['name'],
+            'metric': stage['metric'],
+            'min': stage.get('min', 1),
+            'count': count,
+            'percent': percent(count),
+        })
+    
+    # Для подсказок под воронкой: первая запись и покупка (если такие этапы есть)
+    def stage_percent(metric):
+        return next((
+            stage['percent'] for stage in result_stages[1:]
+            if stage['metric'] == metric and stage['min'] == 1
+        ), None)
     
     return {
-        'stages': [
-            {
-                'name': 'Зарегистрировались',
-                'count': total_registered,
-                'percent': 100,
-            },
-            {
-                'name': '1+ запись',
-                'count': users_with_entries,
-                'percent': round(users_with_entries / total_registered * 100, 1) if total_registered > 0 else 0,
-            },
-            {
-                'name': '5+ записей',
-                'count': users_with_5_entries,
-                'percent': round(users_with_5_entries / total_registered * 100, 1) if total_registered > 0 else 0,
-            },
-            {
-                'name': 'Купили подписку',
-                'count': users_paid,
-                'percent': round(users_paid / total_registered * 100, 1) if total_registered > 0 else 0,
-            },
-        ],
+        'stages': result_stages,
+        'first_entry_percent': stage_percent('entries'),
+        'paid_percent': stage_percent('payments'),
         'period_days': days
     }
 
@@ -662,89 +1065,388 @@ def get_conversion_funnel(days=30):
 # СВОДНЫЙ ДАШБОРД
 # ============================================================================
 
-def get_dashboard_data(period='today', start_date=None, end_date=None):
-    """
-    Получить все данные для дашборда.
-    """
+def get_period_bounds(period='today', start_date=None, end_date=None):
+    """Границы периода, предыдущего периода той же длины и окна графиков."""
     date_start, date_end = get_date_range(period, start_date, end_date)
     
-    # Для сравнения берём предыдущий период той же длительности
-    period_length = (date_end - date_start).days or 1
-    prev_start = date_start - timedelta(days=period_length)
-    prev_end = date_start
+    # Предыдущий период — тот же интервал, сдвинутый на столько суток, сколько
+    # дней он затрагивает: неполный последний день сравнивается с тем же
+    # временем суток (неделя с сегодняшним днём — с 8 предыдущими днями),
+    # а не сдвиг на (date_end - date_start).days. Сравнение в пульсе —
+    # build_pulse_block
+    first_day, last_day = rollup_days(date_start, date_end)
+    shift = timedelta(days=(last_day - first_day).days + 1)
     
-    # Текущие метрики
-    current_dau = get_dau(date_start, date_end)
-    current_entries = get_entries_count(date_start, date_end)
-    current_signups = get_new_signups(date_start, date_end)
+    return {
+        'period': period,
+        'date_start': date_start,
+        'date_end': date_end,
+        'prev_start': date_start - shift,
+        'prev_end': date_end - shift,
+        # Окно графиков — сам период, корзины (час/день/неделя/месяц) по его длине
+        'chart_window': chart_window(date_start, date_end),
+    }
+
+
+def calc_change(current, previous):
+    if previous == 0:
+        return 100 if current > 0 else 0
+    return round(((current - previous) / previous) * 100, 1)
+
+
+def _count_partial_days(windows):
+    """
+    Записи, голосовые записи и регистрации за неполные дни {name: (start, end)}
+    из исходных таблиц (rollup хранит только сутки целиком): строки за общий
+    интервал, по окну — COUNT(*) FILTER. Возвращает {name: {entries, voice, signups}}.
+    """
+    params = {
+        'span_start': min(start for start, _ in windows.values()),
+        'span_end': max(end for _, end in windows.values()),
+    }
+    entry_columns, signup_columns = [], []
+    for position, (start, end) in enumerate(windows.values()):
+        params[f'start_{position}'] = start
+        params[f'end_{position}'] = end
+        window = f"date_created >= %(start_{position})s AND date_created < %(end_{position})s"
+        entry_columns += [f"COUNT(*) FILTER (WHERE {window})", f"COUNT(*) FILTER (WHERE {window} AND is_voice)"]
+        signup_columns.append(f"COUNT(*) FILTER (WHERE {window})")
+    
+    span = "date_created >= %(span_start)s AND date_created < %(span_end)s"
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(
+            f"SELECT * FROM "
+            f"(SELECT {', '.join(entry_columns)} FROM app.journal_entries WHERE {span}) AS e "
+            f"CROSS JOIN (SELECT {', '.join(signup_columns)} FROM app.users WHERE {span}) AS u",
+            params,
+        )
+        row = cursor.fetchone()
+    
+    entries, signups = row[:2 * len(windows)], row[2 * len(windows):]
+    return {
+        name: {'entries': entries[2 * position], 'voice': entries[2 * position + 1], 'signups': signups[position]}
+        for position, name in enumerate(windows)
+    }
+
+
+def build_pulse_block(bounds):
+    """
+    Блок 1: Пульс.
+    
+    Текущий и предыдущий периоды — в одних и тех же запросах: суммы
+    по daily_metrics с FILTER по целым дням каждого окна, неполный последний
+    день (сегодня до текущего момента и то же время суток в прошлом окне) —
+    из исходных таблиц, уникальные пользователи — для всех окон разом
+    (скетчи или один DISTINCT-запрос). Записи, регистрации и DAU сравниваются
+    на одних и тех же окнах.
+    """
+    date_start, date_end = bounds['date_start'], bounds['date_end']
+    prev_start, prev_end = bounds['prev_start'], bounds['prev_end']
     
-    # Предыдущие метрики для сравнения
-    prev_dau = get_dau(prev_start, prev_end)
-    prev_entries = get_entries_count(prev_start, prev_end)
-    prev_signups = get_new_signups(prev_start, prev_end)
+    current_days, current_tail = split_partial_day(date_start, date_end)
+    prev_days, prev_tail = split_partial_day(prev_start, prev_end)
+    current = Q(day__range=current_days)
+    previous = Q(day__range=prev_days)
+    entries = F('entries_text') + F('entries_voice')
     
-    def calc_change(current, previous):
-        if previous == 0:
-            return 100 if current > 0 else 0
-        return round(((current - previous) / previous) * 100, 1)
+    totals = DailyMetric.objects.filter(
+        day__range=(min(prev_days[0], current_days[0]), max(prev_days[1], current_days[1]))
+    ).aggregate(
+        entries=Sum(entries, filter=current),
+        prev_entries=Sum(entries, filter=previous),
+        voice=Sum('entries_voice', filter=current),
+        signups=Sum('signups', filter=current),
+        prev_signups=Sum('signups', filter=previous),
+    )
+    totals = {name: value or 0 for name, value in totals.items()}
+    
+    tails = {name: tail for name, tail in (('current', current_tail), ('prev', prev_tail)) if tail}
+    if tails:
+        partial = _count_partial_days(tails)
+        for name, prefix in (('current', ''), ('prev', 'prev_')):
+            if name in partial:
+                totals[f'{prefix}entries'] += partial[name]['entries']
+                totals[f'{prefix}signups'] += partial[name]['signups']
+        if 'current' in partial:
+            totals['voice'] += partial['current']['voice']
+    
+    active = get_active_users_windows({
+        'dau': (date_start, date_end, ACTIVITY_SOURCES),
+        'prev_dau': (prev_start, prev_end, ACTIVITY_SOURCES),
+        # Для «записей на юзера» — только писавшие
+        'writers': (date_start, date_end, ('entries',)),
+        'wau': (rolling_window_start(date_end, 7), date_end, ACTIVITY_SOURCES),
+        'mau': (rolling_window_start(date_end, 30), date_end, ACTIVITY_SOURCES),
+    })
     
     return {
-        # Блок 1: Пульс
-        'pulse': {
-            'dau': {
-                'value': current_dau,
-                'change': calc_change(current_dau, prev_dau),
-                'prev': prev_dau,
-            },
-            'entries': {
-                'value': current_entries,
-                'change': calc_change(current_entries, prev_entries),
-                'prev': prev_entries,
-                'voice': get_voice_entries_count(date_start, date_end),
-            },
-            'signups': {
-                'value': current_signups,
-                'change': calc_change(current_signups, prev_signups),
-                'prev': prev_signups,
-            },
-            'entries_per_user': get_entries_per_user(date_start, date_end),
+        'dau': {
+            'value': active['dau'],
+            'change': calc_change(active['dau'], active['prev_dau']),
+            'prev': active['prev_dau'],
+            'wau': active['wau'],
+            'mau': active['mau'],
         },
-        
-        # Блок 2: Деньги
-        'money': {
-            'mrr': get_mrr(),
-            'revenue': get_revenue(date_start, date_end),
-            'conversion': get_conversion_rate(30),
-            'unit_economics': get_unit_economics(30),
-            'ai_costs': get_ai_costs(date_start, date_end),
+        'entries': {
+            'value': totals['entries'],
+            'change': calc_change(totals['entries'], totals['prev_entries']),
+            'prev': totals['prev_entries'],
+            'voice': totals['voice'],
         },
-        
-        # Блок 3: Удержание
-        'retention': {
-            'day_1': get_retention_day_1(),
-            'day_7': get_retention_day_7(),
-            'day_30': get_retention_day_30(),
+        'signups': {
+            'value': totals['signups'],
+            'change': calc_change(totals['signups'], totals['prev_signups']),
+            'prev': totals['prev_signups'],
         },
-        
-        # Блок 4: Воронка конверсии
-        'funnel': get_conversion_funnel(30),
-        
-        # Блок 5: Привычки
-        'habits': get_habits_stats(date_start, date_end),
-        
-        # Графики
-        'charts': {
-            'users': get_users_chart_data(14),
-            'revenue': get_revenue_chart_data(14),
-            'entries': get_entries_chart_data(14),
-            'habits': get_habits_chart_data(14),
-        },
-        
-        # Метаданные
-        'meta': {
-            'period': period,
-            'start_date': date_start.isoformat(),
-            'end_date': date_end.isoformat(),
-            'generated_at': timezone.now().isoformat(),
+        'entries_per_user': round(totals['entries'] / active['writers'], 2) if active['writers'] else 0,
+    }
+
+
+def build_money_block(bounds):
+    """Блок 2: Деньги."""
+    return {
+        'mrr': get_mrr(),
+        'revenue': get_revenue(bounds['date_start'], bounds['date_end']),
+        'conversion': get_conversion_rate(30),
+        'unit_economics': get_unit_economics(30),
+        'ai_costs': get_ai_costs(bounds['date_start'], bounds['date_end']),
+    }
+
+
+def build_ai_block(bounds):
+    """
+    Блок AI: стоимость, токены и задержка по сервисам и моделям,
+    топ пользователей по расходам, расходы на активного пользователя.
+    """
+    date_start, date_end = bounds['date_start'], bounds['date_end']
+    analytics = get_ai_analytics(date_start, date_end, *rollup_days(date_start, date_end))
+    active_users = get_active_users(date_start, date_end)
+    analytics['active_users'] = active_users
+    analytics['cost_per_active_user'] = (
+        round(analytics['total']['cost_usd'] / active_users, 4) if active_users else 0
+    )
+    return analytics
+
+
+def build_retention_block(bounds):
+    """Блок 3: Удержание (не зависит от периода)."""
+    return {
+        'day_1': get_retention_day_1(),
+        'day_7': get_retention_day_7(),
+        'day_30': get_retention_day_30(),
+    }
+
+
+def build_cohorts_block(bounds):
+    """Матрицы когортного удержания (не зависят от периода)."""
+    return {
+        'daily': get_retention_matrix('day', 30),
+        'weekly': get_retention_matrix('week', MAX_WINDOW_DAYS),
+    }
+
+
+def build_funnel_block(bounds):
+    """Блок 4: Воронка конверсии (не зависит от периода)."""
+    return get_conversion_funnel(30)
+
+
+def build_habits_block(bounds):
+    """Блок 5: Привычки."""
+    return get_habits_stats(bounds['date_start'], bounds['date_end'])
+
+
+def build_details_block(bounds):
+    """Детали: последние транзакции и топ пользователей по записям (не зависят от периода)."""
+    recent_transactions = Transaction.objects.select_related('user').filter(
+        is_successful=True
+    ).order_by('-date_created')[:10]
+    
+    top_users = User.objects.annotate(
+        entries_count=Count('entries')
+    ).order_by('-entries_count')[:10]
+    
+    return {
+        'recent_transactions': [
+            {
+                'user': str(tx.user),
+                'transaction_type': tx.transaction_type,
+                'amount_stars': tx.amount_stars,
+                'amount_usd': float(tx.amount_usd),
+                'date_created': tx.date_created,
+            }
+            for tx in recent_transactions
+        ],
+        'top_users': [
+            {
+                'user': str(user),
+                'entries_count': user.entries_count,
+                'subscription_tier': user.subscription_tier,
+            }
+            for user in top_users
+        ],
+    }
+
+
+def build_perf_block(bounds):
+    """Самые медленные страницы и блоки за сутки (core.instrumentation, если включено)."""
+    if not instrumentation_enabled():
+        return {'enabled': False, 'endpoints': []}
+    return {'enabled': True, 'endpoints': get_slow_endpoints(hours=24)}
+
+
+def _chart_block(chart_builder):
+    """Блок графика: каждый из четырёх графиков считается и кэшируется отдельно."""
+    return lambda bounds: chart_builder(bounds['chart_window'])
+
+
+EMPTY_CHART = {'labels': [], 'bucket': None, 'datasets': []}
+
+# Блок дашборда → (функция расчёта, зависит ли от периода, заглушка при таймауте/ошибке).
+# 'charts.users' попадает в data['charts']['users'].
+DASHBOARD_BLOCKS = {
+    'pulse': (build_pulse_block, True, {}),
+    'money': (build_money_block, True, {}),
+    'ai': (build_ai_block, True, {}),
+    'retention': (build_retention_block, False, {}),
+    'cohorts': (build_cohorts_block, False, {}),
+    'funnel': (build_funnel_block, False, {'stages': []}),
+    'habits': (build_habits_block, True, {}),
+    'charts.users': (_chart_block(get_users_chart_data), True, EMPTY_CHART),
+    'charts.revenue': (_chart_block(get_revenue_chart_data), True, EMPTY_CHART),
+    'charts.entries': (_chart_block(get_entries_chart_data), True, EMPTY_CHART),
+    'charts.habits': (_chart_block(get_habits_chart_data), True, EMPTY_CHART),
+    'details': (build_details_block, False, {}),
+    'perf': (build_perf_block, False, {'enabled': False, 'endpoints': []}),
+}
+
+
+def _run_block(name, builder, scope, bounds, force_refresh):
+    """Выполняется в потоке пула: свой коннект к БД, закрывается по завершении."""
+    try:
+        return get_cached_block(name, scope, lambda: builder(bounds), force=force_refresh)
+    finally:
+        connections.close_all()
+
+
+def _compute_blocks(bounds, scope, force_refresh):
+    """
+    Считает блоки параллельно в пуле потоков (у каждого потока своё соединение).
+    
+    Блок, не уложившийся в DASHBOARD_BLOCK_TIMEOUT или упавший, заменяется
+    заглушкой; досчитавшись в фоне, он попадёт в кэш к следующему запросу.
+    Задержка страницы — самый медленный блок, а не сумма всех.
+    """
+    workers = getattr(settings, 'DASHBOARD_PARALLEL_WORKERS', len(DASHBOARD_BLOCKS))
+    timeout = getattr(settings, 'DASHBOARD_BLOCK_TIMEOUT', 20)
+    
+    def block_scope(per_period):
+        return scope if per_period else 'all'
+    
+    if workers <= 1:
+        entries = {}
+        for name, (builder, per_period, _) in DASHBOARD_BLOCKS.items():
+            try:
+                entries[name] = get_cached_block(
+                    name, block_scope(per_period), lambda builder=builder: builder(bounds), force=force_refresh,
+                )
+            except Exception as e:
+                logger.error(f"Dashboard block {name} failed: {e}")
+        return entries
+    
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dashboard')
+    try:
+        # Отдельная копия контекста на задачу: contextvars (например, выбор реплики) видны в потоке
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run,
+                _run_block, name, builder, block_scope(per_period), bounds, force_refresh,
+            ): name
+            for name, (builder, per_period, _) in DASHBOARD_BLOCKS.items()
+        }
+        done, not_done = wait(futures, timeout=timeout)
+    finally:
+        # Не ждём зависшие блоки и снимаем ещё не начатые: ответ уходит с заглушками
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    entries = {}
+    for future in done:
+        name = futures[future]
+        try:
+            entries[name] = future.result()
+        except Exception as e:
+            logger.error(f"Dashboard block {name} failed: {e}")
+    for future in not_done:
+        logger.warning(f"Dashboard block {futures[future]} timed out after {timeout}s")
+    return entries
+
+
+def get_dashboard_block(name, period='today', start_date=None, end_date=None, force_refresh=False):
+    """
+    Один блок дашборда (для ленивой загрузки страницы по блокам).
+    
+    Returns:
+        {data, computed_at, expires_at, duration_ms}
+    
+    Raises:
+        KeyError: неизвестный блок
+    """
+    builder, per_period, _ = DASHBOARD_BLOCKS[name]
+    bounds = get_period_bounds(period, start_date, end_date)
+    scope = period_scope(period, bounds['date_start'], bounds['date_end']) if per_period else 'all'
+    with use_replica():
+        return get_cached_block(name, scope, lambda: builder(bounds), force=force_refresh)
+
+
+def get_dashboard_data(period='today', start_date=None, end_date=None, force_refresh=False):
+    """
+    Получить все данные для дашборда.
+    
+    Блоки берутся из кэша (core.dashboard_cache) со своими TTL и считаются
+    параллельно; force_refresh=True пересчитывает их (остальные запросы
+    тем временем получают предыдущее значение). Чтения идут с реплики
+    (core.db_router), если она настроена и не отстаёт.
+    """
+    bounds = get_period_bounds(period, start_date, end_date)
+    scope = period_scope(period, bounds['date_start'], bounds['date_end'])
+    with use_replica():
+        entries = _compute_blocks(bounds, scope, force_refresh)
+    
+    data = {'charts': {}}
+    blocks_meta = {}
+    for name, (_, _, placeholder) in DASHBOARD_BLOCKS.items():
+        entry = entries.get(name)
+        section, _, chart = name.partition('.')
+        value = entry['data'] if entry else placeholder
+        if chart:
+            data[section][chart] = value
+        else:
+            data[section] = value
+        blocks_meta[name] = {
+            'computed_at': entry['computed_at'] if entry else None,
+            'duration_ms': entry['duration_ms'] if entry else None,
+            # Число SQL и время в БД при пересчёте (если включены замеры)
+            'queries': entry.get('queries') if entry else None,
+            'db_ms': entry.get('db_ms') if entry else None,
+            'unavailable': entry is None,
         }
+    
+    # Секция графиков в шаблоне — по самому старому из графиков
+    chart_meta = [meta for name, meta in blocks_meta.items() if name.startswith('charts.')]
+    computed = [meta['computed_at'] for meta in chart_meta if meta['computed_at']]
+    blocks_meta['charts'] = {
+        'computed_at': min(computed) if computed else None,
+        'unavailable': any(meta['unavailable'] for meta in chart_meta),
+    }
+    
+    # Метаданные
+    computed = [meta['computed_at'] for meta in blocks_meta.values() if meta['computed_at']]
+    data['meta'] = {
+        'period': period,
+        'start_date': bounds['date_start'].isoformat(),
+        'end_date': bounds['date_end'].isoformat(),
+        'generated_at': timezone.now().isoformat(),
+        # Самый старый из блоков — «данные актуальны на»
+        'computed_at': min(computed) if computed else None,
+        'blocks': blocks_meta,
     }
+    return data
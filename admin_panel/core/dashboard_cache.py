@@ -0,0 +1,141 @@
+"""
+Кэш блоков аналитического дашборда в Redis.
+
+Каждый блок (пульс, деньги, удержание, ...) кэшируется отдельно со своим TTL:
+пульс живёт минуту, удержание и воронка — час. Ключ — блок + период
+(period, начало, конец по московским датам); блоки, не зависящие от периода,
+общие для всех периодов.
+
+Пересчёт блока замеряется (core.instrumentation, если включено): число
+SQL и время в БД сохраняются в записи кэша рядом с duration_ms.
+
+Защита от «стада»: пересчитывает блок только тот запрос, который взял
+блокировку (cache.add). Остальные получают устаревшее значение, пока идёт
+пересчёт, а если значения ещё нет — ждут его до DASHBOARD_CACHE_LOCK_WAIT секунд.
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .instrumentation import measure
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = 'dashboard:v1'
+
+# TTL блоков по умолчанию (секунды), переопределяются DASHBOARD_CACHE_TTLS
+DEFAULT_BLOCK_TTLS = {
+    'pulse': 60,
+    'details': 60,
+    'perf': 60,
+    'money': 300,
+    'habits': 300,
+    'ai': 600,
+    'charts': 600,
+    'retention': 3600,
+    'cohorts': 3600,
+    'funnel': 3600,
+}
+
+# Устаревшее значение хранится ещё столько TTL — его отдают, пока идёт пересчёт
+STALE_TTL_FACTOR = 4
+
+# Интервал опроса кэша при ожидании чужого пересчёта
+LOCK_POLL_INTERVAL = 0.2
+
+
+def block_ttl(block: str) -> int:
+    """TTL блока; 'charts.users' берёт TTL секции 'charts'."""
+    ttls = {**DEFAULT_BLOCK_TTLS, **getattr(settings, 'DASHBOARD_CACHE_TTLS', {})}
+    return ttls.get(block, ttls.get(block.partition('.')[0], 300))
+
+
+def block_cache_key(block: str, scope: str) -> str:
+    return f'{CACHE_PREFIX}:{block}:{scope}'
+
+
+def period_scope(period: str, date_start, date_end) -> str:
+    """Часть ключа для блоков, зависящих от периода (даты по местному времени)."""
+    start = timezone.localtime(date_start).date().isoformat()
+    end = timezone.localtime(date_end).date().isoformat()
+    return f'{period}:{start}:{end}'
+
+
+def _measured_compute(block: str, compute: Callable[[], Any]) -> Dict[str, Any]:
+    started = time.monotonic()
+    with measure(f'dashboard.{block}') as stats:
+        data = compute()
+    return {
+        'data': data,
+        'computed_at': timezone.now(),
+        'duration_ms': round((time.monotonic() - started) * 1000),
+        'queries': stats.queries if stats else None,
+        'db_ms': round(stats.db_ms) if stats else None,
+    }
+
+
+def _compute_entry(block: str, key: str, compute: Callable[[], Any]) -> Dict[str, Any]:
+    ttl = block_ttl(block)
+    entry = _measured_compute(block, compute)
+    entry['expires_at'] = time.time() + ttl
+    cache.set(key, entry, timeout=ttl * STALE_TTL_FACTOR)
+    return entry
+
+
+def get_cached_block(
+    block: str,
+    scope: str,
+    compute: Callable[[], Any],
+    force: bool = False,
+) -> Dict[str, Any]:
+    """
+    Возвращает блок из кэша или пересчитывает его под блокировкой.
+
+    Args:
+        block: имя блока (ключ DEFAULT_BLOCK_TTLS)
+        scope: 'all' или period_scope(...)
+        compute: функция расчёта блока
+        force: считать закэшированное значение устаревшим
+
+    Returns:
+        {data, computed_at, expires_at, duration_ms, queries, db_ms}
+        queries / db_ms — None, если замеры выключены
+    """
+    if not getattr(settings, 'DASHBOARD_CACHE_ENABLED', True):
+        return {**_measured_compute(block, compute), 'expires_at': None}
+
+    key = block_cache_key(block, scope)
+    entry: Optional[Dict[str, Any]] = cache.get(key)
+    if entry and not force and entry['expires_at'] > time.time():
+        return entry
+
+    lock_key = f'{key}:lock'
+    lock_timeout = getattr(settings, 'DASHBOARD_CACHE_LOCK_TIMEOUT', 120)
+    if cache.add(lock_key, 1, timeout=lock_timeout):
+        try:
+            return _compute_entry(block, key, compute)
+        finally:
+            cache.delete(lock_key)
+
+    # Блок уже пересчитывает другой запрос
+    if entry:
+        return entry
+
+    deadline = time.monotonic() + getattr(settings, 'DASHBOARD_CACHE_LOCK_WAIT', 30)
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry:
+            return entry
+        if not cache.get(lock_key):
+            break
+
+    # Владелец блокировки упал или не уложился — считаем сами
+    logger.warning(f"Dashboard block {block} ({scope}): lock wait timed out, computing locally")
+    return _compute_entry(block, key, compute)
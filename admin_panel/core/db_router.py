@@ -0,0 +1,123 @@
+"""
+Чтение аналитики с реплики PostgreSQL.
+
+Дашборд, списки админки и статистические задачи Celery читают внутри
+use_replica(): ORM-чтения уходят на реплику через ReplicaRouter, сырые
+запросы — через reporting_connection(). Всё остальное (в том числе любые
+записи и статусы рассылок) остаётся на primary ('default').
+
+Реплика используется, только если она настроена (DATABASES['replica'])
+и отстаёт от primary не больше REPLICA_MAX_LAG_SECONDS; иначе чтения
+тихо возвращаются на primary. Отставание проверяется не чаще раза
+в REPLICA_LAG_CHECK_INTERVAL секунд на процесс.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+logger = logging.getLogger(__name__)
+
+REPLICA_ALIAS = 'replica'
+
+# Секунды отставания реплики: 0 — не реплика (например, второй локальный
+# Postgres в тестах) или всё WAL уже применено
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+_use_replica: contextvars.ContextVar[bool] = contextvars.ContextVar('use_replica', default=False)
+
+_lag_lock = threading.Lock()
+_lag_state = {'checked_at': None, 'healthy': False}
+
+
+@contextmanager
+def use_replica():
+    """Чтения внутри блока — с реплики (если она доступна и не отстаёт)."""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def _check_replica() -> bool:
+    try:
+        with connections[REPLICA_ALIAS].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = float(cursor.fetchone()[0])
+    except DatabaseError as e:
+        logger.warning(f"Replica unavailable, reading from primary: {e}")
+        return False
+
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 30)
+    if lag > max_lag:
+        logger.warning(f"Replica lag {lag:.1f}s exceeds {max_lag}s, reading from primary")
+        return False
+    return True
+
+
+def replica_available() -> bool:
+    """Настроена ли реплика и укладывается ли она в допустимое отставание."""
+    if REPLICA_ALIAS not in settings.DATABASES:
+        return False
+
+    interval = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 10)
+    with _lag_lock:
+        now = time.monotonic()
+        if _lag_state['checked_at'] is None or now - _lag_state['checked_at'] >= interval:
+            _lag_state['healthy'] = _check_replica()
+            _lag_state['checked_at'] = now
+        return _lag_state['healthy']
+
+
+def reporting_db_alias() -> str:
+    """База для аналитических чтений в текущем контексте."""
+    if _use_replica.get() and replica_available():
+        return REPLICA_ALIAS
+    return DEFAULT_DB_ALIAS
+
+
+def reporting_connection():
+    """Соединение для сырых аналитических запросов (реплика внутри use_replica())."""
+    return connections[reporting_db_alias()]
+
+
+class ReplicaRouter:
+    """
+    Чтения внутри use_replica() — на реплику, все записи — на primary.
+
+    db_for_write явно возвращает 'default': иначе Django сохранил бы объект,
+    прочитанный с реплики, обратно в реплику (instance._state.db).
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and replica_available():
+            return REPLICA_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплика — копия primary: объекты из обеих баз можно связывать
+        databases = {DEFAULT_DB_ALIAS, REPLICA_ALIAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPLICA_ALIAS:
+            return False
+        return None
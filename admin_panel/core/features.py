@@ -0,0 +1,170 @@
+"""
+Поведенческие признаки пользователей (app.user_features).
+
+Одна строка на пользователя с агрегатами по записям, привычкам,
+платежам и AI-расходам. Сегменты фильтруют по ним через JOIN 1:1
+(поля доступны в filter_rules по имени: "entries_7d", "last_payment_at", ...)
+вместо EXISTS по большим таблицам в момент рассылки.
+
+Обновление инкрементальное: пересчитываются только пользователи,
+у которых появились/изменились строки после прошлого прогона,
+и те, у кого события пересекли границу окна 7 / 30 дней.
+Раз в сутки — полный пересчёт (подхватывает удаления).
+"""
+
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+# Запас на транзакции, закоммиченные позже своего date_created
+FEATURES_REFRESH_OVERLAP = timedelta(minutes=5)
+
+WATERMARK_CACHE_KEY = 'user_features:refreshed_at'
+
+FEATURE_COLUMNS = (
+    'last_entry_at',
+    'entries_7d',
+    'entries_30d',
+    'active_habits',
+    'max_habit_streak',
+    'last_habit_completion_at',
+    'last_payment_at',
+    'payments_30d',
+    'ai_spend_usd',
+    'ai_spend_30d_usd',
+    'date_updated',
+)
+
+FULL_SCOPE_SQL = "SELECT id AS user_id FROM app.users"
+
+# Пользователи, чьи признаки могли измениться с %(since)s
+INCREMENTAL_SCOPE_SQL = """
+    SELECT id AS user_id FROM app.users WHERE date_created >= %(since)s
+    UNION
+    SELECT user_id FROM app.journal_entries
+    WHERE date_created >= %(since)s OR date_updated >= %(since)s
+    UNION
+    -- Записи, вышедшие из окна 7 / 30 дней
+    SELECT user_id FROM app.journal_entries
+    WHERE date_created >= %(since)s - INTERVAL '7 days' AND date_created < %(now)s - INTERVAL '7 days'
+    UNION
+    SELECT user_id FROM app.journal_entries
+    WHERE date_created >= %(since)s - INTERVAL '30 days' AND date_created < %(now)s - INTERVAL '30 days'
+    UNION
+    SELECT user_id FROM app.habits WHERE date_updated >= %(since)s
+    UNION
+    SELECT user_id FROM app.habit_completions WHERE date_created >= %(since)s
+    UNION
+    SELECT user_id FROM app.transactions
+    WHERE date_created >= %(since)s
+       OR (date_created >= %(since)s - INTERVAL '30 days' AND date_created < %(now)s - INTERVAL '30 days')
+    UNION
+    SELECT user_id FROM app.usage_logs
+    WHERE date_created >= %(since)s
+       OR (date_created >= %(since)s - INTERVAL '30 days' AND date_created < %(now)s - INTERVAL '30 days')
+"""
+
+UPSERT_SQL = """
+    WITH scope AS ({scope})
+    INSERT INTO app.user_features ({columns_with_user})
+    SELECT
+        scope.user_id,
+        e.last_entry_at,
+        COALESCE(e.entries_7d, 0),
+        COALESCE(e.entries_30d, 0),
+        COALESCE(h.active_habits, 0),
+        COALESCE(h.max_habit_streak, 0),
+        hc.last_completion_at,
+        t.last_payment_at,
+        COALESCE(t.payments_30d, 0),
+        COALESCE(l.ai_spend_usd, 0),
+        COALESCE(l.ai_spend_30d_usd, 0),
+        %(now)s
+    FROM scope
+    LEFT JOIN (
+        SELECT
+            user_id,
+            MAX(date_created) AS last_entry_at,
+            COUNT(*) FILTER (WHERE date_created >= %(now)s - INTERVAL '7 days') AS entries_7d,
+            COUNT(*) FILTER (WHERE date_created >= %(now)s - INTERVAL '30 days') AS entries_30d
+        FROM app.journal_entries
+        WHERE user_id IN (SELECT user_id FROM scope)
+        GROUP BY user_id
+    ) e ON e.user_id = scope.user_id
+    LEFT JOIN (
+        SELECT
+            user_id,
+            COUNT(*) AS active_habits,
+            MAX(current_streak) AS max_habit_streak
+        FROM app.habits
+        WHERE user_id IN (SELECT user_id FROM scope) AND is_active AND NOT is_archived
+        GROUP BY user_id
+    ) h ON h.user_id = scope.user_id
+    LEFT JOIN (
+        SELECT user_id, MAX(completed_date) AS last_completion_at
+        FROM app.habit_completions
+        WHERE user_id IN (SELECT user_id FROM scope)
+        GROUP BY user_id
+    ) hc ON hc.user_id = scope.user_id
+    LEFT JOIN (
+        SELECT
+            user_id,
+            MAX(date_created) AS last_payment_at,
+            COUNT(*) FILTER (WHERE date_created >= %(now)s - INTERVAL '30 days') AS payments_30d
+        FROM app.transactions
+        WHERE user_id IN (SELECT user_id FROM scope)
+          AND is_successful AND transaction_type <> 'refund'
+        GROUP BY user_id
+    ) t ON t.user_id = scope.user_id
+    LEFT JOIN (
+        SELECT
+            user_id,
+            SUM(cost_usd) AS ai_spend_usd,
+            SUM(cost_usd) FILTER (WHERE date_created >= %(now)s - INTERVAL '30 days') AS ai_spend_30d_usd
+        FROM app.usage_logs
+        WHERE user_id IN (SELECT user_id FROM scope)
+        GROUP BY user_id
+    ) l ON l.user_id = scope.user_id
+    ON CONFLICT (user_id) DO UPDATE SET {updates}
+"""
+
+
+def _upsert_sql(scope_sql: str) -> str:
+    return UPSERT_SQL.format(
+        scope=scope_sql,
+        columns_with_user=', '.join(('user_id',) + FEATURE_COLUMNS),
+        updates=', '.join(f'{column} = EXCLUDED.{column}' for column in FEATURE_COLUMNS),
+    )
+
+
+def refresh_user_features(full: bool = False, now: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Обновляет user_features одним INSERT ... SELECT ... ON CONFLICT.
+
+    Без сохранённой отметки прошлого прогона (первый запуск, сброс кэша)
+    выполняется полный пересчёт.
+
+    Returns:
+        {full: bool, updated: int}
+    """
+    started_at = now or timezone.now()
+    watermark = None if full else cache.get(WATERMARK_CACHE_KEY)
+    full = watermark is None
+
+    params = {'now': started_at}
+    if full:
+        sql = _upsert_sql(FULL_SCOPE_SQL)
+    else:
+        sql = _upsert_sql(INCREMENTAL_SCOPE_SQL)
+        params['since'] = watermark - FEATURES_REFRESH_OVERLAP
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        updated = cursor.rowcount
+
+    cache.set(WATERMARK_CACHE_KEY, started_at, timeout=None)
+    return {'full': full, 'updated': updated}
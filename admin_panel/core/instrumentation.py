@@ -0,0 +1,178 @@
+"""
+Замеры SQL и времени для блоков дашборда и страниц админки (опционально).
+
+measure(name) — контекстный менеджер: считает запросы и время в БД через
+execute_wrapper соединений текущего потока, плюс общее время выполнения.
+Вложенные замеры (блок внутри запроса страницы, в том числе из потоков
+пула дашборда) добавляют свои цифры родителю.
+
+Каждый замер пишется в почасовые хэши Redis; get_slow_endpoints() собирает
+из них отчёт «самые медленные» за последние часы. Включается
+QUERY_INSTRUMENTATION_ENABLED; выключенный — measure() ничего не делает.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+from redis.exceptions import RedisError
+
+from admin_panel.utils import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+REPORT_KEY_PREFIX = 'perf:endpoints'
+
+# Сколько часов хранится почасовая статистика
+REPORT_RETENTION_HOURS = 48
+
+METRIC_FIELDS = ('count', 'queries', 'db_ms', 'wall_ms')
+
+
+class QueryStats:
+    """Счётчики одного замера; обновляются из нескольких потоков."""
+
+    def __init__(self, name: str, parent: Optional['QueryStats'] = None):
+        self.name = name
+        self.parent = parent
+        self.queries = 0
+        self.db_ms = 0.0
+        self.wall_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, queries: int, db_ms: float):
+        with self._lock:
+            self.queries += queries
+            self.db_ms += db_ms
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_ms, 1),
+            'wall_ms': round(self.wall_ms, 1),
+        }
+
+
+_current_stats: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar(
+    'query_stats', default=None,
+)
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'QUERY_INSTRUMENTATION_ENABLED', False)
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    started = time.monotonic()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if stats is not None:
+            stats.add(1, (time.monotonic() - started) * 1000)
+
+
+def _report_key(moment) -> str:
+    return f"{REPORT_KEY_PREFIX}:{timezone.localtime(moment).strftime('%Y%m%d%H')}"
+
+
+def record_endpoint(name: str, stats: QueryStats):
+    """Добавляет замер в почасовой хэш Redis: {name}:count|queries|db_ms|wall_ms."""
+    key = _report_key(timezone.now())
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hincrby(key, f'{name}:count', 1)
+        pipe.hincrby(key, f'{name}:queries', stats.queries)
+        pipe.hincrbyfloat(key, f'{name}:db_ms', round(stats.db_ms, 3))
+        pipe.hincrbyfloat(key, f'{name}:wall_ms', round(stats.wall_ms, 3))
+        pipe.expire(key, REPORT_RETENTION_HOURS * 3600)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Query instrumentation: failed to record {name}: {e}")
+
+
+@contextmanager
+def measure(name: str, record: bool = True):
+    """
+    Замер запросов и времени блока кода.
+
+    Args:
+        name: имя в отчёте ('dashboard.pulse', 'GET admin:core_user_changelist')
+        record: писать ли замер в отчёт Redis
+
+    Yields:
+        QueryStats (None, если инструментирование выключено)
+    """
+    if not is_enabled():
+        yield None
+        return
+
+    stats = QueryStats(name, parent=_current_stats.get())
+    token = _current_stats.set(stats)
+    started = time.monotonic()
+    try:
+        with ExitStack() as stack:
+            # execute_wrapper привязан к соединениям потока (primary и реплика);
+            # вложенный замер его не дублирует
+            for conn in connections.all():
+                if _record_query not in conn.execute_wrappers:
+                    stack.enter_context(conn.execute_wrapper(_record_query))
+            yield stats
+    finally:
+        stats.wall_ms = (time.monotonic() - started) * 1000
+        _current_stats.reset(token)
+        if stats.parent is not None:
+            stats.parent.add(stats.queries, stats.db_ms)
+        if record:
+            record_endpoint(name, stats)
+
+
+def get_slow_endpoints(hours: int = 24, limit: int = 10) -> List[Dict[str, Any]]:
+    """
+    Самые медленные эндпоинты и блоки за последние hours часов (по среднему времени).
+
+    Returns:
+        [{name, count, avg_wall_ms, avg_db_ms, avg_queries}, ...]
+    """
+    now = timezone.now()
+    keys = [_report_key(now - timedelta(hours=offset)) for offset in range(hours)]
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        hourly = pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Query instrumentation: report unavailable: {e}")
+        return []
+
+    totals: Dict[str, Dict[str, float]] = {}
+    for fields in hourly:
+        for field, value in fields.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            name, _, metric = field.rpartition(':')
+            if metric not in METRIC_FIELDS:
+                continue
+            endpoint = totals.setdefault(name, dict.fromkeys(METRIC_FIELDS, 0.0))
+            endpoint[metric] += float(value)
+
+    report = [
+        {
+            'name': name,
+            'count': int(values['count']),
+            'avg_wall_ms': round(values['wall_ms'] / values['count'], 1),
+            'avg_db_ms': round(values['db_ms'] / values['count'], 1),
+            'avg_queries': round(values['queries'] / values['count'], 1),
+        }
+        for name, values in totals.items()
+        if values['count']
+    ]
+    report.sort(key=lambda row: row['avg_wall_ms'], reverse=True)
+    return report[:limit]
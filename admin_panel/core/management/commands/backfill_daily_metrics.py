@@ -0,0 +1,60 @@
+"""
+Заполнение daily_metrics и daily_ai_metrics за прошлые дни.
+
+Использование:
+    python manage.py backfill_daily_metrics               # с первой регистрации
+    python manage.py backfill_daily_metrics --days 90
+    python manage.py backfill_daily_metrics --since 2025-01-01 --chunk-days 14
+
+Диапазон пересобирается кусками по --chunk-days дней (каждый — своя
+транзакция), от новых дней к старым: дашборд получает свежие данные первыми.
+"""
+
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from core.models import User
+from core.rollups import rebuild_daily_metrics
+
+
+class Command(BaseCommand):
+    help = 'Пересборка суточных метрик дашборда (daily_metrics, daily_ai_metrics) за прошлые дни'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Сколько последних дней пересобрать')
+        parser.add_argument('--since', type=str, help='С какой даты (YYYY-MM-DD)')
+        parser.add_argument('--chunk-days', type=int, default=30, help='Дней в одной транзакции')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+
+        if options['since']:
+            try:
+                first_day = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError('--since: ожидается дата YYYY-MM-DD')
+        elif options['days']:
+            first_day = today - timedelta(days=options['days'] - 1)
+        else:
+            first_registration = User.objects.aggregate(first=Min('date_created'))['first']
+            if first_registration is None:
+                self.stdout.write('Пользователей нет — заполнять нечего')
+                return
+            first_day = timezone.localdate(first_registration)
+
+        chunk_days = max(options['chunk_days'], 1)
+        last_day = today
+        total_rows = 0
+        while last_day >= first_day:
+            chunk_start = max(first_day, last_day - timedelta(days=chunk_days - 1))
+            stats = rebuild_daily_metrics(chunk_start, last_day)
+            total_rows += stats['rows']
+            self.stdout.write(
+                f"{stats['first_day']} .. {stats['last_day']}: {stats['rows']} строк, {stats['ai_rows']} AI-строк"
+            )
+            last_day = chunk_start - timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f'Готово: {total_rows} строк с {first_day.isoformat()}'))
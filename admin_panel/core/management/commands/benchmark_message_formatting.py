@@ -0,0 +1,52 @@
+"""
+Микро-бенчмарк разбора HTML рассылок (core.telegram_formatting).
+
+Использование:
+    python manage.py benchmark_message_formatting
+    python manage.py benchmark_message_formatting --sizes 10000 100000 1000000 --repeat 5
+
+Проверяет, что время разбора растёт линейно с размером текста:
+колонка "мкс/КБ" должна оставаться примерно постоянной.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.telegram_formatting import compile_message_html
+
+
+SAMPLE_BLOCK = (
+    '<b>Привет!</b> Это <i>тестовая</i> рассылка с <a href="https://example.com/path_(1)">ссылкой</a>, '
+    '<code>кодом</code>, <s>зачёркнутым</s> и эмодзи 🎉. Спецсимволы: _*[]()~`>#+-=|{}.! &amp; 5 < 6<br>'
+    '<b>незакрытый <i>тег</b> и лишний </u> закрывающий.\n'
+)
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк compile_message_html на больших текстах'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[4096, 65536, 1048576],
+            help='Размеры текста в символах',
+        )
+        parser.add_argument('--repeat', type=int, default=3, help='Повторов на размер (берётся лучший)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'символов':>12} {'entities':>10} {'лучшее, мс':>12} {'мкс/КБ':>10}")
+
+        for size in options['sizes']:
+            source = (SAMPLE_BLOCK * (size // len(SAMPLE_BLOCK) + 1))[:size]
+
+            best = None
+            entities = 0
+            for _ in range(max(1, options['repeat'])):
+                started = time.perf_counter()
+                compiled = compile_message_html(source)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+                entities = len(compiled.entities)
+
+            per_kb = best * 1_000_000 / (size / 1024)
+            self.stdout.write(f"{size:>12} {entities:>10} {best * 1000:>12.2f} {per_kb:>10.1f}")
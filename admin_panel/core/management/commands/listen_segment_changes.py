@@ -0,0 +1,138 @@
+"""
+Слушатель изменений users для счётчиков сегментов (LISTEN/NOTIFY).
+
+Использование:
+    python manage.py listen_segment_changes
+    python manage.py listen_segment_changes --debounce 2 --flush-interval 10
+
+Триггер на users (миграция 020) шлёт pg_notify('user_changed', <user_id>).
+Уведомления копятся --debounce секунд, затем принадлежность к сегментам
+пересчитывается только для этих пользователей (segment_members).
+Для затронутых сегментов cached_user_count не чаще раза в --flush-interval
+секунд пересчитывается по segment_members — абсолютным значением, как и в
+refresh_segment_members, поэтому порядок записей с периодическими задачами
+не важен и счётчик не накапливает дрейф.
+
+Обрабатываются сегменты с актуальным segment_members (построен по текущим
+правилам). Составные сегменты и сегменты с изменёнными правилами остаются
+за периодическим refresh_all_segment_members.
+
+В production запускается через systemd: segment-listener.service.
+"""
+
+import logging
+import select
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, connection
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.models import SegmentMember, UserSegment
+from core.segments import membership_signature, sync_members_for_users
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'user_changed'
+SEGMENTS_RELOAD_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = 'Инкрементальное обновление состава и счётчиков сегментов по NOTIFY из users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debounce', type=float, default=2.0, help='Сколько секунд копить уведомления')
+        parser.add_argument('--flush-interval', type=float, default=10.0, help='Как часто писать cached_user_count (сек)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Максимум пользователей за один пересчёт')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        self.pending = set()
+        self.touched = set()
+        self.segments = []
+        self.segments_loaded_at = 0.0
+        self.last_flush = time.monotonic()
+
+        while self.running:
+            try:
+                self._listen(options)
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f"Segment listener: database connection lost: {e}")
+                connection.close()
+                time.sleep(5)
+
+        self._flush_counts()
+        self.stdout.write('Segment listener stopped')
+
+    def _stop(self, signum, frame):
+        self.running = False
+
+    def _listen(self, options):
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {CHANNEL}')
+        pg_connection = connection.connection
+        self.stdout.write(f'Listening on "{CHANNEL}"')
+
+        first_pending_at = None
+        while self.running:
+            timeout = options['debounce'] if first_pending_at is None else max(
+                0.0, options['debounce'] - (time.monotonic() - first_pending_at)
+            )
+            ready, _, _ = select.select([pg_connection], [], [], timeout)
+            if ready:
+                pg_connection.poll()
+                while pg_connection.notifies:
+                    self.pending.add(pg_connection.notifies.pop(0).payload)
+                if self.pending and first_pending_at is None:
+                    first_pending_at = time.monotonic()
+
+            debounce_expired = first_pending_at is not None and (
+                time.monotonic() - first_pending_at >= options['debounce']
+            )
+            if debounce_expired or len(self.pending) >= options['batch_size']:
+                self._process(options['batch_size'])
+                first_pending_at = time.monotonic() if self.pending else None
+
+            if time.monotonic() - self.last_flush >= options['flush_interval']:
+                self._flush_counts()
+
+    def _load_segments(self):
+        """Сегменты с актуальным segment_members (перечитываются раз в минуту)."""
+        if time.monotonic() - self.segments_loaded_at < SEGMENTS_RELOAD_INTERVAL:
+            return self.segments
+        self.segments = [
+            segment
+            for segment in UserSegment.objects.exclude(segment_type='composite')
+            if segment.members_refreshed_at is not None
+            and segment.members_rules_hash == membership_signature(segment)
+        ]
+        self.segments_loaded_at = time.monotonic()
+        return self.segments
+
+    def _process(self, batch_size: int):
+        batch = [self.pending.pop() for _ in range(min(batch_size, len(self.pending)))]
+        deltas = sync_members_for_users(self._load_segments(), batch)
+        self.touched.update(segment_id for segment_id, delta in deltas.items() if delta)
+        if deltas:
+            logger.info(f"Segment listener: {len(batch)} users, deltas {dict(deltas)}")
+
+    def _flush_counts(self):
+        """Одним UPDATE записывает размер затронутых сегментов по segment_members."""
+        self.last_flush = time.monotonic()
+        if not self.touched:
+            return
+        member_count = SegmentMember.objects.filter(
+            segment_id=OuterRef('pk'),
+        ).order_by().values('segment_id').annotate(total=Count('*')).values('total')
+        UserSegment.objects.filter(id__in=self.touched).update(
+            cached_user_count=Coalesce(Subquery(member_count, output_field=IntegerField()), Value(0)),
+            cache_updated_at=timezone.now(),
+        )
+        self.touched.clear()
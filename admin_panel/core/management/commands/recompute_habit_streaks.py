@@ -0,0 +1,40 @@
+"""
+Пересчёт стриков привычек по habit_completions.
+
+Использование:
+    python manage.py recompute_habit_streaks             # исправить расхождения
+    python manage.py recompute_habit_streaks --dry-run   # только отчёт
+
+Все привычки пересчитываются одним запросом (core.streaks); записываются
+только строки, где current_streak/longest_streak расходятся с пересчётом.
+"""
+
+from django.core.management.base import BaseCommand
+
+from core.streaks import DRIFT_SAMPLE_SIZE, recompute_habit_streaks
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт current_streak/longest_streak всех привычек по habit_completions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения, ничего не менять')
+        parser.add_argument('--sample', type=int, default=DRIFT_SAMPLE_SIZE, help='Сколько расхождений показать')
+
+    def handle(self, *args, **options):
+        stats = recompute_habit_streaks(dry_run=options['dry_run'], sample_size=options['sample'])
+
+        self.stdout.write(
+            f"Привычек: {stats['habits']}, расходится: {stats['drifted']} "
+            f"(текущий стрик: {stats['current_drifted']}, лучший: {stats['longest_drifted']})"
+        )
+        for row in stats['sample']:
+            self.stdout.write(
+                f"  {row['habit_id']}: текущий {row['old_current']} → {row['new_current']}, "
+                f"лучший {row['old_longest']} → {row['new_longest']}"
+            )
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Dry run: ничего не изменено'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Обновлено привычек: {stats['updated']}"))
@@ -0,0 +1,38 @@
+"""
+Middleware админки.
+"""
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from .instrumentation import is_enabled, measure, record_endpoint
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Замер SQL и времени каждого запроса к админке (core.instrumentation).
+
+    Имя в отчёте — метод и имя URL ('GET admin:core_user_changelist');
+    в ответ добавляется заголовок Server-Timing (видно в DevTools браузера).
+    Подключается только при QUERY_INSTRUMENTATION_ENABLED=True.
+    """
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Имя известно только после resolve — пишем в отчёт вручную
+        with measure('request', record=False) as stats:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return response
+
+        name = f'{request.method} {match.view_name}'
+        record_endpoint(name, stats)
+        response['Server-Timing'] = (
+            f'db;dur={stats.db_ms:.1f};desc="{stats.queries} SQL", app;dur={stats.wall_ms:.1f}'
+        )
+        return response
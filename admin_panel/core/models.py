@@ -306,6 +306,7 @@ class UserSegment(models.Model):
         ('system', 'Системный'),
         ('dynamic', 'Динамический'),
         ('static', 'Статический'),
+        ('composite', 'Составной'),
     ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -322,17 +323,17 @@ class UserSegment(models.Model):
     is_system = models.BooleanField(default=False, verbose_name='Системный')
     
     filter_rules = models.JSONField(blank=True, null=True, verbose_name='Правила фильтрации')
-    static_user_ids = ArrayField(
-        models.UUIDField(),
-        blank=True,
-        null=True,
-        default=list,
-        verbose_name='Статический список UUID'
-    )
+    # Состав статических сегментов — в SegmentStaticMember
+    # (колонка static_user_ids в БД устарела и не загружается)
+    set_expression = models.JSONField(blank=True, null=True, verbose_name='Выражение над сегментами')
     
     cached_user_count = models.IntegerField(default=0, verbose_name='Юзеров в сегменте')
     cache_updated_at = models.DateTimeField(blank=True, null=True, verbose_name='Кэш обновлён')
     
+    # Материализация состава (segment_members)
+    members_refreshed_at = models.DateTimeField(blank=True, null=True, verbose_name='Состав обновлён')
+    members_rules_hash = models.CharField(max_length=40, blank=True, null=True, verbose_name='Хэш правил состава')
+    
     date_created = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
     date_updated = models.DateTimeField(auto_now=True, verbose_name='Обновлён')
 
@@ -347,6 +348,137 @@ class UserSegment(models.Model):
         return f"{self.name} ({self.cached_user_count} юзеров)"
 
 
+class SegmentMember(models.Model):
+    """
+    Материализованный состав сегмента.
+    Соответствует таблице app.segment_members.
+    """
+    id = models.BigAutoField(primary_key=True)
+    segment = models.ForeignKey(
+        UserSegment,
+        on_delete=models.CASCADE,
+        db_column='segment_id',
+        related_name='members',
+        verbose_name='Сегмент'
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        db_column='user_id',
+        related_name='segment_memberships',
+        verbose_name='Пользователь'
+    )
+    date_added = models.DateTimeField(auto_now_add=True, verbose_name='Добавлен')
+
+    class Meta:
+        managed = False
+        db_table = 'segment_members'
+        verbose_name = 'Участник сегмента'
+        verbose_name_plural = 'Участники сегментов'
+        unique_together = [('segment', 'user')]
+
+    def __str__(self):
+        return f"{self.segment_id} → {self.user_id}"
+
+
+class UserBitmapIndex(models.Model):
+    """
+    Плотный целочисленный индекс пользователя (номер бита в битмапах).
+    Соответствует таблице app.user_bitmap_index.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        db_column='user_id',
+        related_name='bitmap_index',
+        verbose_name='Пользователь'
+    )
+    idx = models.BigIntegerField(unique=True, editable=False, verbose_name='Индекс')
+
+    class Meta:
+        managed = False
+        db_table = 'user_bitmap_index'
+        verbose_name = 'Индекс пользователя'
+        verbose_name_plural = 'Индексы пользователей'
+
+    def __str__(self):
+        return f"{self.user_id} → {self.idx}"
+
+
+class UserFeatures(models.Model):
+    """
+    Поведенческие признаки пользователя для сегментации.
+    Соответствует таблице app.user_features (обновляется Celery).
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        db_column='user_id',
+        related_name='features',
+        verbose_name='Пользователь'
+    )
+    
+    last_entry_at = models.DateTimeField(blank=True, null=True, verbose_name='Последняя запись')
+    entries_7d = models.IntegerField(default=0, verbose_name='Записей за 7 дней')
+    entries_30d = models.IntegerField(default=0, verbose_name='Записей за 30 дней')
+    
+    active_habits = models.IntegerField(default=0, verbose_name='Активных привычек')
+    max_habit_streak = models.IntegerField(default=0, verbose_name='Лучший текущий стрик')
+    last_habit_completion_at = models.DateTimeField(blank=True, null=True, verbose_name='Последнее выполнение привычки')
+    
+    last_payment_at = models.DateTimeField(blank=True, null=True, verbose_name='Последний платёж')
+    payments_30d = models.IntegerField(default=0, verbose_name='Платежей за 30 дней')
+    
+    ai_spend_usd = models.DecimalField(max_digits=12, decimal_places=6, default=0, verbose_name='AI расходы USD')
+    ai_spend_30d_usd = models.DecimalField(max_digits=12, decimal_places=6, default=0, verbose_name='AI расходы за 30 дней USD')
+    
+    date_updated = models.DateTimeField(verbose_name='Обновлено')
+
+    class Meta:
+        managed = False
+        db_table = 'user_features'
+        verbose_name = 'Признаки пользователя'
+        verbose_name_plural = 'Признаки пользователей'
+
+    def __str__(self):
+        return f"Features({self.user_id})"
+
+
+class SegmentStaticMember(models.Model):
+    """
+    Участник статического сегмента (ручной список / импорт CSV).
+    Соответствует таблице app.segment_static_members.
+    """
+    id = models.BigAutoField(primary_key=True)
+    segment = models.ForeignKey(
+        UserSegment,
+        on_delete=models.CASCADE,
+        db_column='segment_id',
+        related_name='static_members',
+        verbose_name='Сегмент'
+    )
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        db_column='user_id',
+        related_name='static_segment_memberships',
+        verbose_name='Пользователь'
+    )
+    date_added = models.DateTimeField(auto_now_add=True, verbose_name='Добавлен')
+
+    class Meta:
+        managed = False
+        db_table = 'segment_static_members'
+        verbose_name = 'Участник статического сегмента'
+        verbose_name_plural = 'Участники статических сегментов'
+        unique_together = [('segment', 'user')]
+
+    def __str__(self):
+        return f"{self.segment_id} → {self.user_id}"
+
+
 class UsageLog(models.Model):
     """
     Модель логов использования AI.
@@ -558,3 +690,75 @@ class HabitCompletion(models.Model):
 
     def __str__(self):
         return f"{self.habit.name} - {self.completed_date.strftime('%d.%m.%Y') if self.completed_date else 'N/A'}"
+
+
+class DailyMetric(models.Model):
+    """
+    Суточные метрики дашборда по источнику трафика.
+    Соответствует таблице app.daily_metrics (обновляется Celery).
+    """
+    id = models.BigAutoField(primary_key=True)
+    day = models.DateField(verbose_name='День')
+    referral_source = models.CharField(max_length=100, blank=True, default='', verbose_name='Источник')
+    
+    signups = models.IntegerField(default=0, verbose_name='Регистрации')
+    active_users = models.IntegerField(default=0, verbose_name='Активные пользователи')
+    entries_text = models.IntegerField(default=0, verbose_name='Текстовые записи')
+    entries_voice = models.IntegerField(default=0, verbose_name='Голосовые записи')
+    
+    transactions = models.IntegerField(default=0, verbose_name='Транзакции')
+    revenue_usd = models.DecimalField(max_digits=14, decimal_places=4, default=0, verbose_name='Доход USD')
+    revenue_stars = models.BigIntegerField(default=0, verbose_name='Доход (звёзды)')
+    
+    ai_requests = models.IntegerField(default=0, verbose_name='AI запросы')
+    ai_tokens = models.BigIntegerField(default=0, verbose_name='AI токены')
+    ai_cost_usd = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name='AI расходы USD')
+    
+    habit_completions = models.IntegerField(default=0, verbose_name='Выполнения привычек')
+    
+    date_updated = models.DateTimeField(verbose_name='Обновлено')
+
+    class Meta:
+        managed = False
+        db_table = 'daily_metrics'
+        verbose_name = 'Метрики за день'
+        verbose_name_plural = 'Метрики по дням'
+        ordering = ['-day', 'referral_source']
+        unique_together = [('day', 'referral_source')]
+
+    def __str__(self):
+        return f"{self.day} / {self.referral_source or '—'}"
+
+
+class DailyAIMetric(models.Model):
+    """
+    Суточные AI-метрики по сервису и модели.
+    Соответствует таблице app.daily_ai_metrics (обновляется Celery вместе с daily_metrics).
+    """
+    id = models.BigAutoField(primary_key=True)
+    day = models.DateField(verbose_name='День')
+    service_type = models.CharField(max_length=50, verbose_name='Сервис')
+    model_name = models.CharField(max_length=50, verbose_name='Модель')
+    
+    requests = models.IntegerField(default=0, verbose_name='Запросы')
+    input_tokens = models.BigIntegerField(default=0, verbose_name='Входные токены')
+    output_tokens = models.BigIntegerField(default=0, verbose_name='Выходные токены')
+    cost_usd = models.DecimalField(max_digits=14, decimal_places=6, default=0, verbose_name='Стоимость USD')
+    
+    latency_count = models.IntegerField(default=0, verbose_name='Запросов с задержкой')
+    latency_sum_ms = models.BigIntegerField(default=0, verbose_name='Сумма задержек (мс)')
+    latency_max_ms = models.IntegerField(blank=True, null=True, verbose_name='Макс. задержка (мс)')
+    latency_histogram = models.JSONField(default=dict, verbose_name='Гистограмма задержек')
+    
+    date_updated = models.DateTimeField(verbose_name='Обновлено')
+
+    class Meta:
+        managed = False
+        db_table = 'daily_ai_metrics'
+        verbose_name = 'AI-метрики за день'
+        verbose_name_plural = 'AI-метрики по дням'
+        ordering = ['-day', 'service_type', 'model_name']
+        unique_together = [('day', 'service_type', 'model_name')]
+
+    def __str__(self):
+        return f"{self.day} / {self.service_type} / {self.model_name}"
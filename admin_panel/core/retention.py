@@ -0,0 +1,133 @@
+"""
+Когортное удержание: матрица когорта × смещение.
+
+Когорта — пользователи, зарегистрированные в один день (или неделю)
+по часовому поясу проекта. Ячейка [когорта, N] — доля когорты, сделавшая
+хотя бы одну запись в N-й день (неделю) от начала когорты.
+
+Вся матрица считается одним запросом: размеры когорт и число вернувшихся
+по смещениям — две ветки UNION ALL над общими CTE, без выгрузки ID в Python.
+"""
+
+from datetime import timedelta
+from typing import Any, Dict
+
+from django.conf import settings
+from django.utils import timezone
+
+from .db_router import reporting_connection
+from .rollups import local_day_bounds
+
+
+# Самое длинное окно когорт (дней)
+MAX_WINDOW_DAYS = 90
+
+GRANULARITY_DAYS = {
+    'day': 1,
+    'week': 7,
+}
+
+MATRIX_SQL = """
+    WITH cohort_users AS (
+        SELECT
+            u.id AS user_id,
+            date_trunc(%(unit)s, u.date_created AT TIME ZONE %(tz)s)::date AS cohort
+        FROM app.users u
+        WHERE u.date_created >= %(start)s AND u.date_created < %(end)s
+    ),
+    activity AS (
+        SELECT DISTINCT
+            c.cohort,
+            c.user_id,
+            ((e.date_created AT TIME ZONE %(tz)s)::date - c.cohort) / %(step)s AS period
+        FROM cohort_users c
+        JOIN app.journal_entries e ON e.user_id = c.user_id
+        WHERE e.date_created >= %(start)s AND e.date_created < %(end)s
+    )
+    SELECT cohort, NULL AS period, COUNT(*) AS users
+    FROM cohort_users
+    GROUP BY cohort
+
+    UNION ALL
+
+    SELECT cohort, period, COUNT(*) AS users
+    FROM activity
+    WHERE period BETWEEN 0 AND %(max_period)s
+    GROUP BY cohort, period
+"""
+
+
+def _cell_alpha(rate: float) -> float:
+    """Насыщенность ячейки тепловой карты (0.08 — пусто, 1 — 100%)."""
+    return round(0.08 + 0.92 * min(rate, 100) / 100, 2)
+
+
+def get_retention_matrix(granularity: str = 'day', window_days: int = 30) -> Dict[str, Any]:
+    """
+    Матрица удержания за последние window_days дней (не больше 90).
+
+    Args:
+        granularity: 'day' или 'week' — размер когорты и шага смещения
+        window_days: глубина окна когорт
+
+    Returns:
+        {granularity, periods: [0..N], cohorts: [{label, size, cells: [{rate, retained, alpha} | None]}]}
+        Ячейка None — смещение ещё не наступило.
+    """
+    if granularity not in GRANULARITY_DAYS:
+        raise ValueError(f'Unknown granularity: {granularity}')
+
+    step = GRANULARITY_DAYS[granularity]
+    window_days = min(max(window_days, step), MAX_WINDOW_DAYS)
+
+    today = timezone.localdate()
+    first_day = today - timedelta(days=window_days - 1)
+    if granularity == 'week':
+        # Целые недели с понедельника, как date_trunc('week')
+        first_day -= timedelta(days=first_day.weekday())
+    start, end = local_day_bounds(first_day, today)
+    max_period = (today - first_day).days // step
+
+    with reporting_connection().cursor() as cursor:
+        cursor.execute(MATRIX_SQL, {
+            'unit': granularity,
+            'tz': settings.TIME_ZONE,
+            'start': start,
+            'end': end,
+            'step': step,
+            'max_period': max_period,
+        })
+        rows = cursor.fetchall()
+
+    sizes = {}
+    retained = {}
+    for cohort, period, users in rows:
+        if period is None:
+            sizes[cohort] = users
+        else:
+            retained[(cohort, period)] = users
+
+    cohorts = []
+    for cohort in sorted(sizes, reverse=True):
+        size = sizes[cohort]
+        # Последнее смещение, которое для когорты уже наступило (хотя бы частично)
+        last_period = (today - cohort).days // step
+        cells = []
+        for period in range(max_period + 1):
+            if period > last_period:
+                cells.append(None)
+                continue
+            count = retained.get((cohort, period), 0)
+            rate = round(count / size * 100, 1) if size else 0
+            cells.append({'rate': rate, 'retained': count, 'alpha': _cell_alpha(rate)})
+        cohorts.append({
+            'label': cohort.strftime('%d.%m') if step == 1 else f"нед. {cohort.strftime('%d.%m')}",
+            'size': size,
+            'cells': cells,
+        })
+
+    return {
+        'granularity': granularity,
+        'periods': list(range(max_period + 1)),
+        'cohorts': cohorts,
+    }
@@ -0,0 +1,241 @@
+"""
+Суточные агрегаты для дашборда (app.daily_metrics, app.daily_ai_metrics).
+
+Одна строка на (день, источник трафика): регистрации, активные пользователи,
+записи, доход, AI-расходы, выполнения привычек. День считается по часовому
+поясу проекта (Europe/Moscow), как и периоды дашборда.
+
+Пересборка диапазона — DELETE + INSERT ... SELECT в одной транзакции:
+исчезнувшие строки (удалённые пользователи, сменившийся источник) уходят сами.
+AI-метрики (app.daily_ai_metrics) — по сервису и модели, с гистограммой
+задержек — пересобираются в той же транзакции.
+Ночью пересобираются последние дни (поздние транзакции, правки),
+сегодняшний день — каждые несколько минут.
+"""
+
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+# Сколько последних дней пересобирает ночная задача
+NIGHTLY_REBUILD_DAYS = 3
+
+# Ключ pg_advisory_xact_lock: пересборки (каждые 5 минут, ночная, backfill)
+# идут по очереди. Иначе DELETE второй транзакции не видит строк, только что
+# вставленных первой, и её INSERT падает на UNIQUE (day, referral_source)
+REBUILD_LOCK_KEY = 210_021
+
+METRIC_COLUMNS = (
+    'signups',
+    'active_users',
+    'entries_text',
+    'entries_voice',
+    'transactions',
+    'revenue_usd',
+    'revenue_stars',
+    'ai_requests',
+    'ai_tokens',
+    'ai_cost_usd',
+    'habit_completions',
+)
+
+# Каждая ветка UNION ALL отдаёт (day, referral_source, <METRIC_COLUMNS>)
+REBUILD_SQL = """
+    WITH source_rows AS (
+        SELECT
+            (u.date_created AT TIME ZONE %(tz)s)::date AS day,
+            COALESCE(u.referral_source, '') AS referral_source,
+            COUNT(*) AS signups,
+            0 AS active_users, 0 AS entries_text, 0 AS entries_voice,
+            0 AS transactions, 0 AS revenue_usd, 0 AS revenue_stars,
+            0 AS ai_requests, 0 AS ai_tokens, 0 AS ai_cost_usd,
+            0 AS habit_completions
+        FROM app.users u
+        WHERE u.date_created >= %(start)s AND u.date_created < %(end)s
+        GROUP BY 1, 2
+
+        UNION ALL
+        SELECT
+            (e.date_created AT TIME ZONE %(tz)s)::date,
+            COALESCE(u.referral_source, ''),
+            0,
+            COUNT(DISTINCT e.user_id),
+            COUNT(*) FILTER (WHERE NOT e.is_voice),
+            COUNT(*) FILTER (WHERE e.is_voice),
+            0, 0, 0, 0, 0, 0, 0
+        FROM app.journal_entries e
+        JOIN app.users u ON u.id = e.user_id
+        WHERE e.date_created >= %(start)s AND e.date_created < %(end)s
+        GROUP BY 1, 2
+
+        UNION ALL
+        SELECT
+            (t.date_created AT TIME ZONE %(tz)s)::date,
+            COALESCE(u.referral_source, ''),
+            0, 0, 0, 0,
+            COUNT(*),
+            COALESCE(SUM(t.amount_usd), 0),
+            COALESCE(SUM(t.amount_stars), 0),
+            0, 0, 0, 0
+        FROM app.transactions t
+        JOIN app.users u ON u.id = t.user_id
+        WHERE t.date_created >= %(start)s AND t.date_created < %(end)s AND t.is_successful
+        GROUP BY 1, 2
+
+        UNION ALL
+        SELECT
+            (l.date_created AT TIME ZONE %(tz)s)::date,
+            COALESCE(u.referral_source, ''),
+            0, 0, 0, 0, 0, 0, 0,
+            COUNT(*),
+            COALESCE(SUM(l.input_tokens + l.output_tokens), 0),
+            COALESCE(SUM(l.cost_usd), 0),
+            0
+        FROM app.usage_logs l
+        JOIN app.users u ON u.id = l.user_id
+        WHERE l.date_created >= %(start)s AND l.date_created < %(end)s
+        GROUP BY 1, 2
+
+        UNION ALL
+        -- completed_date — уже календарный день пользователя
+        SELECT
+            hc.completed_date::date,
+            COALESCE(u.referral_source, ''),
+            0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+            COUNT(*)
+        FROM app.habit_completions hc
+        JOIN app.users u ON u.id = hc.user_id
+        WHERE hc.completed_date BETWEEN %(first_day)s AND %(last_day)s
+        GROUP BY 1, 2
+    )
+    INSERT INTO app.daily_metrics (day, referral_source, {columns}, date_updated)
+    SELECT day, referral_source, {sums}, %(now)s
+    FROM source_rows
+    GROUP BY day, referral_source
+"""
+
+# Границы корзин гистограммы задержек AI (мс) для width_bucket: корзина 0 — меньше
+# первой границы, корзина N — не меньше последней. При смене границ
+# daily_ai_metrics нужно пересобрать (manage.py backfill_daily_metrics).
+LATENCY_BUCKETS_MS = (
+    100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 4000,
+    5000, 7500, 10000, 15000, 20000, 30000, 45000, 60000, 120000,
+)
+
+AI_REBUILD_SQL = """
+    WITH logs AS (
+        SELECT
+            (date_created AT TIME ZONE %(tz)s)::date AS day,
+            service_type::text AS service_type,
+            model_name,
+            input_tokens,
+            output_tokens,
+            cost_usd,
+            latency_ms,
+            width_bucket(latency_ms, %(latency_buckets)s::int[]) AS latency_bucket
+        FROM app.usage_logs
+        WHERE date_created >= %(start)s AND date_created < %(end)s
+    ),
+    totals AS (
+        SELECT
+            day, service_type, model_name,
+            COUNT(*) AS requests,
+            COALESCE(SUM(input_tokens), 0) AS input_tokens,
+            COALESCE(SUM(output_tokens), 0) AS output_tokens,
+            COALESCE(SUM(cost_usd), 0) AS cost_usd,
+            COUNT(latency_ms) AS latency_count,
+            COALESCE(SUM(latency_ms), 0) AS latency_sum_ms,
+            MAX(latency_ms) AS latency_max_ms
+        FROM logs
+        GROUP BY 1, 2, 3
+    ),
+    histograms AS (
+        SELECT day, service_type, model_name, jsonb_object_agg(latency_bucket, requests) AS latency_histogram
+        FROM (
+            SELECT day, service_type, model_name, latency_bucket, COUNT(*) AS requests
+            FROM logs
+            WHERE latency_ms IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        ) AS buckets
+        GROUP BY 1, 2, 3
+    )
+    INSERT INTO app.daily_ai_metrics (
+        day, service_type, model_name, requests, input_tokens, output_tokens, cost_usd,
+        latency_count, latency_sum_ms, latency_max_ms, latency_histogram, date_updated
+    )
+    SELECT
+        t.day, t.service_type, t.model_name,
+        t.requests, t.input_tokens, t.output_tokens, t.cost_usd,
+        t.latency_count, t.latency_sum_ms, t.latency_max_ms,
+        COALESCE(h.latency_histogram, '{}'),
+        %(now)s
+    FROM totals t
+    LEFT JOIN histograms h USING (day, service_type, model_name)
+"""
+
+
+def local_day_bounds(first_day: date, last_day: date):
+    """[начало first_day, начало дня после last_day) в часовом поясе проекта."""
+    start = timezone.make_aware(datetime.combine(first_day, time.min))
+    end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min))
+    return start, end
+
+
+def rebuild_daily_metrics(first_day: date, last_day: date) -> Dict[str, Any]:
+    """
+    Пересобирает daily_metrics и daily_ai_metrics за дни [first_day, last_day] включительно.
+
+    Returns:
+        {first_day, last_day, rows, ai_rows}
+    """
+    start, end = local_day_bounds(first_day, last_day)
+    sql = REBUILD_SQL.format(
+        columns=', '.join(METRIC_COLUMNS),
+        sums=', '.join(f'SUM({column})' for column in METRIC_COLUMNS),
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [REBUILD_LOCK_KEY])
+        cursor.execute(
+            "DELETE FROM app.daily_metrics WHERE day BETWEEN %s AND %s",
+            [first_day, last_day],
+        )
+        cursor.execute(sql, {
+            'tz': settings.TIME_ZONE,
+            'start': start,
+            'end': end,
+            'first_day': first_day,
+            'last_day': last_day,
+            'now': timezone.now(),
+        })
+        rows = cursor.rowcount
+
+        cursor.execute(
+            "DELETE FROM app.daily_ai_metrics WHERE day BETWEEN %s AND %s",
+            [first_day, last_day],
+        )
+        cursor.execute(AI_REBUILD_SQL, {
+            'tz': settings.TIME_ZONE,
+            'start': start,
+            'end': end,
+            'latency_buckets': list(LATENCY_BUCKETS_MS),
+            'now': timezone.now(),
+        })
+        ai_rows = cursor.rowcount
+
+    return {
+        'first_day': first_day.isoformat(),
+        'last_day': last_day.isoformat(),
+        'rows': rows,
+        'ai_rows': ai_rows,
+    }
+
+
+def rebuild_recent_daily_metrics(days: int = 1) -> Dict[str, Any]:
+    """Пересобирает последние days дней, включая сегодняшний (неполный)."""
+    today = timezone.localdate()
+    return rebuild_daily_metrics(today - timedelta(days=days - 1), today)
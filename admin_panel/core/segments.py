@@ -0,0 +1,890 @@
+"""
+Движок фильтрации сегментов пользователей.
+
+filter_rules компилируются один раз в проверенное дерево выражений
+(and / or / not + условия по полям), план кэшируется по хэшу правил
+и превращается в один Q → один WHERE в SQL. Одним и тем же планом
+пользуются счётчики сегментов, превью и выборка получателей рассылки.
+
+Формат filter_rules:
+{
+    "subscription_tier": {"in": ["premium", "basic"]},
+    "date_created": {"gte": "-7 days"},
+    "or": [
+        {"total_entries_count": {"gte": 10}},
+        {"entries__is_voice": {"eq": true}}
+    ],
+    "not": {"status": {"eq": "blocked"}}
+}
+
+Ключи верхнего уровня объединяются через AND.
+Поля связанных таблиц (entries__*, transactions__*, habits__*, ...)
+проверяются через EXISTS, поэтому не размножают строки users.
+Поведенческие признаки из user_features (entries_7d, last_entry_at,
+max_habit_streak, last_payment_at, ai_spend_usd, ...) указываются по имени
+и проверяются через JOIN 1:1 по индексам.
+"""
+
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field as dataclass_field
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db import models
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+class SegmentRuleError(ValueError):
+    """Ошибка в filter_rules сегмента (неизвестное поле, оператор или значение)."""
+
+
+# ============================================================================
+# ОПИСАНИЕ ДОПУСТИМЫХ ПОЛЕЙ
+# ============================================================================
+
+OPERATORS = ('eq', 'ne', 'in', 'not_in', 'gt', 'gte', 'lt', 'lte', 'between', 'is_null', 'exists')
+
+RELATIVE_TIME_RE = re.compile(r'^-\s*(\d+)\s*(minute|hour|day|week|month|year)s?$', re.IGNORECASE)
+
+RELATIVE_UNITS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+    'month': timedelta(days=30),
+    'year': timedelta(days=365),
+}
+
+
+def _related_models() -> Dict[str, models.Model]:
+    """Связанные с users таблицы, доступные в правилах через EXISTS."""
+    from .models import Habit, HabitCompletion, JournalEntry, Subscription, Transaction, UsageLog
+
+    return {
+        'entries': JournalEntry,
+        'transactions': Transaction,
+        'subscriptions': Subscription,
+        'habits': Habit,
+        'habit_completions': HabitCompletion,
+        'usage_logs': UsageLog,
+    }
+
+
+def _model_fields(model) -> Dict[str, models.Field]:
+    return {f.name: f for f in model._meta.concrete_fields}
+
+
+def _feature_fields() -> Dict[str, models.Field]:
+    """Признаки из user_features, доступные в правилах по имени."""
+    from .models import UserFeatures
+
+    fields = _model_fields(UserFeatures)
+    fields.pop('user', None)
+    fields.pop('date_updated', None)
+    return fields
+
+
+# ============================================================================
+# ДЕРЕВО ВЫРАЖЕНИЙ
+# ============================================================================
+
+@dataclass
+class Node:
+    """Базовый узел дерева правил."""
+
+    def to_q(self, now: datetime) -> Q:
+        raise NotImplementedError
+
+    @property
+    def is_time_relative(self) -> bool:
+        return any(child.is_time_relative for child in self.children)
+
+    @property
+    def uses_relations(self) -> bool:
+        return any(child.uses_relations for child in self.children)
+
+    @property
+    def children(self) -> List['Node']:
+        return []
+
+
+@dataclass
+class AllOf(Node):
+    items: List[Node] = dataclass_field(default_factory=list)
+
+    @property
+    def children(self):
+        return self.items
+
+    def to_q(self, now):
+        q = Q()
+        for item in self.items:
+            q &= item.to_q(now)
+        return q
+
+
+@dataclass
+class AnyOf(Node):
+    items: List[Node] = dataclass_field(default_factory=list)
+
+    @property
+    def children(self):
+        return self.items
+
+    def to_q(self, now):
+        q = self.items[0].to_q(now)
+        for item in self.items[1:]:
+            q |= item.to_q(now)
+        return q
+
+
+@dataclass
+class Negation(Node):
+    item: Node = None
+
+    @property
+    def children(self):
+        return [self.item]
+
+    def to_q(self, now):
+        return ~self.item.to_q(now)
+
+
+@dataclass
+class Condition(Node):
+    """
+    Условие по одному полю.
+
+    lookup — путь в терминах ORM относительно модели (users или связанной),
+    resolve(now) — значение, относительные даты считаются в момент выполнения.
+    """
+    lookup: str = ''
+    resolve: Callable[[datetime], Any] = None
+    negate: bool = False
+    relation: Optional[str] = None
+    relative: bool = False
+
+    @property
+    def is_time_relative(self):
+        return self.relative
+
+    @property
+    def uses_relations(self):
+        return self.relation is not None
+
+    def to_q(self, now):
+        if self.relation is None:
+            q = Q(**{self.lookup: self.resolve(now)})
+        else:
+            related_model = _related_models()[self.relation]
+            subquery = related_model.objects.filter(user_id=OuterRef('pk'))
+            if self.lookup:
+                subquery = subquery.filter(**{self.lookup: self.resolve(now)})
+            q = Q(Exists(subquery))
+        return ~q if self.negate else q
+
+
+@dataclass
+class FeatureJoin(Node):
+    """
+    Условие по user_features.
+
+    Признаки меняются без изменения users.date_updated,
+    поэтому для materialized-состава считается связью.
+    """
+    item: Node = None
+
+    @property
+    def children(self):
+        return [self.item]
+
+    @property
+    def uses_relations(self):
+        return True
+
+    def to_q(self, now):
+        return self.item.to_q(now)
+
+
+@dataclass
+class RawQ(Node):
+    """Готовый Q без параметров времени (null-обработка для "in")."""
+    q: Q = None
+    relation: Optional[str] = None
+
+    @property
+    def uses_relations(self):
+        return self.relation is not None
+
+    def to_q(self, now):
+        return self.q
+
+
+# ============================================================================
+# КОМПИЛЯЦИЯ
+# ============================================================================
+
+def parse_relative_time(value: str) -> Optional[timedelta]:
+    """Парсит относительное время типа '-7 days', '-1 month', '-12 hours'."""
+    match = RELATIVE_TIME_RE.match(value.strip())
+    if not match:
+        return None
+    return RELATIVE_UNITS[match.group(2).lower()] * int(match.group(1))
+
+
+def _coerce_scalar(path: str, model_field: models.Field, value: Any):
+    """
+    Проверяет и приводит значение к типу поля.
+    Возвращает (resolver, is_relative).
+    """
+    if value is None or value == 'null':
+        return (lambda now: None), False
+
+    if isinstance(model_field, (models.DateTimeField, models.DateField)):
+        if not isinstance(value, str):
+            raise SegmentRuleError(f'{path}: ожидается дата или относительное время, получено {value!r}')
+        if value.strip().startswith('-'):
+            delta = parse_relative_time(value)
+            if delta is None:
+                raise SegmentRuleError(
+                    f'{path}: не удалось разобрать относительное время {value!r} '
+                    f'(пример: "-7 days", "-12 hours", "-1 month")'
+                )
+            return (lambda now: now - delta), True
+        try:
+            parsed = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise SegmentRuleError(f'{path}: некорректная дата {value!r}')
+        if isinstance(parsed, datetime) and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        if isinstance(parsed, date) and not isinstance(parsed, datetime) and isinstance(model_field, models.DateTimeField):
+            parsed = timezone.make_aware(datetime.combine(parsed, datetime.min.time()))
+        return (lambda now: parsed), False
+
+    if isinstance(model_field, models.BooleanField):
+        if not isinstance(value, bool):
+            raise SegmentRuleError(f'{path}: ожидается true/false, получено {value!r}')
+        return (lambda now: value), False
+
+    if isinstance(model_field, (models.IntegerField, models.DecimalField, models.FloatField)):
+        if isinstance(value, bool):
+            raise SegmentRuleError(f'{path}: ожидается число, получено {value!r}')
+        try:
+            number = Decimal(str(value))
+        except InvalidOperation:
+            raise SegmentRuleError(f'{path}: ожидается число, получено {value!r}')
+        if isinstance(model_field, models.IntegerField):
+            number = int(number)
+        return (lambda now: number), False
+
+    if isinstance(model_field, models.UUIDField):
+        if not isinstance(value, str):
+            raise SegmentRuleError(f'{path}: ожидается UUID, получено {value!r}')
+        return (lambda now: value), False
+
+    if not isinstance(value, (str, int)):
+        raise SegmentRuleError(f'{path}: ожидается строка, получено {value!r}')
+    return (lambda now: value), False
+
+
+def _resolve_path(path: str):
+    """
+    Проверяет путь поля. Возвращает (relation, field_name, model_field).
+    relation = None для полей users и user_features (field_name = features__*).
+    """
+    from .models import User
+
+    user_fields = _model_fields(User)
+    if path in user_fields:
+        return None, path, user_fields[path]
+
+    feature_name = path[len('features__'):] if path.startswith('features__') else path
+    feature_fields = _feature_fields()
+    if feature_name in feature_fields:
+        return None, f'features__{feature_name}', feature_fields[feature_name]
+
+    relation, _, field_name = path.partition('__')
+    related = _related_models()
+    if relation not in related:
+        raise SegmentRuleError(f'Неизвестное поле {path!r}')
+    if not field_name:
+        return relation, '', None
+
+    related_fields = _model_fields(related[relation])
+    if field_name not in related_fields:
+        raise SegmentRuleError(f'Неизвестное поле {field_name!r} в {relation}')
+    return relation, field_name, related_fields[field_name]
+
+
+def _compile_condition(path: str, op: str, value: Any) -> Node:
+    relation, field_name, model_field = _resolve_path(path)
+    if field_name.startswith('features__'):
+        return FeatureJoin(item=_compile_field_condition(path, op, value, relation, field_name, model_field))
+    return _compile_field_condition(path, op, value, relation, field_name, model_field)
+
+
+def _compile_field_condition(path: str, op: str, value: Any, relation, field_name, model_field) -> Node:
+
+    if op not in OPERATORS:
+        raise SegmentRuleError(f'{path}: неизвестный оператор {op!r}')
+
+    if op == 'exists':
+        if relation is None or field_name:
+            raise SegmentRuleError(f'{path}: "exists" применим только к связи (entries, habits, ...)')
+        if not isinstance(value, bool):
+            raise SegmentRuleError(f'{path}: ожидается true/false для "exists"')
+        return Condition(lookup='', resolve=None, negate=not value, relation=relation)
+
+    if model_field is None:
+        raise SegmentRuleError(f'{path}: укажите поле связи, например {path}__date_created')
+
+    if op == 'is_null':
+        if not isinstance(value, bool):
+            raise SegmentRuleError(f'{path}: ожидается true/false для "is_null"')
+        return Condition(
+            lookup=f'{field_name}__isnull',
+            resolve=lambda now: value,
+            relation=relation,
+        )
+
+    if op in ('in', 'not_in'):
+        if not isinstance(value, list):
+            raise SegmentRuleError(f'{path}: для "{op}" ожидается список')
+        has_null = any(v is None or v == 'null' for v in value)
+        values = [v for v in value if v is not None and v != 'null']
+        resolved = []
+        for v in values:
+            resolve, relative = _coerce_scalar(path, model_field, v)
+            if relative:
+                # Список компилируется в готовый Q без момента вычисления
+                raise SegmentRuleError(f'{path}: относительное время {v!r} не поддерживается в "{op}"')
+            resolved.append(resolve(None))
+
+        q = Q(**{f'{field_name}__in': resolved}) if resolved else Q(pk__in=[])
+        if has_null:
+            q |= Q(**{f'{field_name}__isnull': True})
+            # Пустая строка в subscription_tier тоже означает "без подписки"
+            if field_name == 'subscription_tier':
+                q |= Q(**{field_name: ''})
+        if relation is not None:
+            related_model = _related_models()[relation]
+            q = Q(Exists(related_model.objects.filter(q, user_id=OuterRef('pk'))))
+        return RawQ(q=~q if op == 'not_in' else q, relation=relation)
+
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise SegmentRuleError(f'{path}: для "between" ожидается [от, до]')
+        start, start_relative = _coerce_scalar(path, model_field, value[0])
+        end, end_relative = _coerce_scalar(path, model_field, value[1])
+        return Condition(
+            lookup=f'{field_name}__range',
+            resolve=lambda now: (start(now), end(now)),
+            relation=relation,
+            relative=start_relative or end_relative,
+        )
+
+    resolve, relative = _coerce_scalar(path, model_field, value)
+    if op in ('eq', 'ne'):
+        if value is None or value == 'null':
+            return Condition(
+                lookup=f'{field_name}__isnull',
+                resolve=lambda now: True,
+                negate=op == 'ne',
+                relation=relation,
+            )
+        return Condition(
+            lookup=field_name,
+            resolve=resolve,
+            negate=op == 'ne',
+            relation=relation,
+            relative=relative,
+        )
+
+    return Condition(
+        lookup=f'{field_name}__{op}',
+        resolve=resolve,
+        relation=relation,
+        relative=relative,
+    )
+
+
+def _compile_node(rules: Any) -> Node:
+    if not isinstance(rules, dict):
+        raise SegmentRuleError(f'Ожидается объект с правилами, получено {rules!r}')
+
+    items: List[Node] = []
+    for key, value in rules.items():
+        if key in ('and', 'or'):
+            if not isinstance(value, list) or not value:
+                raise SegmentRuleError(f'"{key}": ожидается непустой список правил')
+            children = [_compile_node(item) for item in value]
+            items.append(AllOf(children) if key == 'and' else AnyOf(children))
+        elif key == 'not':
+            items.append(Negation(item=_compile_node(value)))
+        elif isinstance(value, dict):
+            if not value:
+                raise SegmentRuleError(f'{key}: пустое условие')
+            for op, operand in value.items():
+                items.append(_compile_condition(key, op, operand))
+        elif isinstance(value, list):
+            # Старый формат: {"subscription_tier": ["premium"]}
+            items.append(_compile_condition(key, 'in', value))
+        else:
+            # Старый формат: {"status": "active"} без оператора
+            items.append(_compile_condition(key, 'eq', value))
+
+    return items[0] if len(items) == 1 else AllOf(items)
+
+
+@dataclass
+class CompiledSegment:
+    """Скомпилированный план сегмента."""
+    rules_hash: str
+    tree: Node
+
+    @property
+    def is_time_relative(self) -> bool:
+        """Есть ли условия вида "-7 days" (состав меняется со временем)."""
+        return self.tree.is_time_relative
+
+    @property
+    def uses_relations(self) -> bool:
+        """Есть ли условия по связанным таблицам (EXISTS)."""
+        return self.tree.uses_relations
+
+    def to_q(self, now: Optional[datetime] = None) -> Q:
+        return self.tree.to_q(now or timezone.now())
+
+    def apply(self, queryset, now: Optional[datetime] = None):
+        return queryset.filter(self.to_q(now))
+
+
+def rules_hash(filter_rules: Any) -> str:
+    """Стабильный хэш правил (порядок ключей не важен)."""
+    payload = json.dumps(filter_rules, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+_PLAN_CACHE: 'OrderedDict[str, CompiledSegment]' = OrderedDict()
+_PLAN_CACHE_SIZE = 256
+_plan_cache_lock = Lock()
+
+
+def compile_segment_rules(filter_rules: Any) -> CompiledSegment:
+    """
+    Компилирует filter_rules в план (с кэшированием по хэшу правил).
+
+    Raises:
+        SegmentRuleError: если правила некорректны
+    """
+    if isinstance(filter_rules, str):
+        try:
+            filter_rules = json.loads(filter_rules)
+        except ValueError as e:
+            raise SegmentRuleError(f'Некорректный JSON: {e}')
+
+    key = rules_hash(filter_rules)
+    with _plan_cache_lock:
+        plan = _PLAN_CACHE.get(key)
+        if plan is not None:
+            _PLAN_CACHE.move_to_end(key)
+            return plan
+
+    plan = CompiledSegment(
+        rules_hash=key,
+        tree=_compile_node(filter_rules) if filter_rules else AllOf([]),
+    )
+
+    with _plan_cache_lock:
+        _PLAN_CACHE[key] = plan
+        if len(_PLAN_CACHE) > _PLAN_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+    return plan
+
+
+# ============================================================================
+# ПОЛЬЗОВАТЕЛИ СЕГМЕНТА
+# ============================================================================
+
+def segment_filter_q(segment, now: Optional[datetime] = None) -> Q:
+    """
+    Условие сегмента в виде Q (без фильтра по статусу).
+
+    Приоритет: составной сегмент > filter_rules > статический список > системный slug.
+    Пригоден и для WHERE, и для COUNT(*) FILTER (WHERE ...).
+    """
+    from .models import SegmentMember, SegmentStaticMember
+
+    if segment.segment_type == 'composite':
+        # Состав считается из битмапов (core.bitmaps) и лежит в segment_members
+        return Q(Exists(SegmentMember.objects.filter(segment_id=segment.id, user_id=OuterRef('pk'))))
+    if segment.filter_rules:
+        return compile_segment_rules(segment.filter_rules).to_q(now)
+    if segment.segment_type == 'static':
+        return Q(Exists(SegmentStaticMember.objects.filter(segment_id=segment.id, user_id=OuterRef('pk'))))
+    if segment.slug == 'all':
+        return Q()
+    if segment.slug == 'premium':
+        return Q(subscription_tier__in=['premium', 'basic'])
+    if segment.slug == 'free':
+        return Q(subscription_tier__in=['free', '']) | Q(subscription_tier__isnull=True)
+    return Q(pk__in=[])
+
+
+def segment_users_queryset(segment, now: Optional[datetime] = None):
+    """
+    Активные пользователи сегмента.
+
+    Общая точка для рассылок, счётчиков и превью.
+    """
+    from .models import User
+
+    return User.objects.filter(status='active').filter(segment_filter_q(segment, now))
+
+
+# ============================================================================
+# МАТЕРИАЛИЗАЦИЯ СОСТАВА (segment_members)
+# ============================================================================
+
+# Запас на транзакции, закоммиченные позже своего date_updated
+MEMBERS_REFRESH_OVERLAP = timedelta(minutes=5)
+
+
+def membership_signature(segment) -> str:
+    """Хэш всего, что определяет состав сегмента."""
+    return rules_hash([segment.filter_rules, segment.segment_type, segment.slug, segment.set_expression])
+
+
+def _insert_members(segment, users_query) -> int:
+    """INSERT ... SELECT в segment_members без выгрузки id в Python."""
+    from django.db import connection
+
+    sql, params = users_query.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO app.segment_members (segment_id, user_id, date_added)
+            SELECT %s, matched.id, NOW()
+            FROM ({sql}) AS matched
+            ON CONFLICT (segment_id, user_id) DO NOTHING
+        """, [segment.id, *params])
+        return cursor.rowcount
+
+
+def refresh_segment_members(segment, force_full: bool = False) -> Dict[str, Any]:
+    """
+    Обновляет segment_members для сегмента.
+
+    Полный пересчёт (diff: удалить лишних, добавить недостающих) нужен,
+    если правила изменились, состав ещё не строился, сегмент статический,
+    или план зависит от времени ("-7 days") / связанных таблиц — такие
+    условия меняются без изменения users.date_updated.
+
+    Иначе обрабатываются только пользователи, у которых date_updated
+    сдвинулся после прошлого обновления.
+
+    Составные сегменты пересчитываются из битмапов (core.bitmaps).
+    """
+    from django.db import transaction
+    from .models import SegmentMember, User, UserSegment
+
+    if segment.segment_type == 'composite':
+        from .bitmaps import refresh_composite_members
+        return refresh_composite_members(segment)
+
+    started_at = timezone.now()
+    signature = membership_signature(segment)
+
+    plan = compile_segment_rules(segment.filter_rules) if segment.filter_rules else None
+    full = (
+        force_full
+        or segment.members_refreshed_at is None
+        or segment.members_rules_hash != signature
+        or segment.segment_type == 'static'
+        or (plan is not None and (plan.is_time_relative or plan.uses_relations))
+    )
+
+    matching = segment_users_queryset(segment, now=started_at)
+    members = SegmentMember.objects.filter(segment_id=segment.id)
+
+    with transaction.atomic():
+        if full:
+            removed, _ = members.exclude(user_id__in=matching.values('id')).delete()
+            added = _insert_members(segment, matching)
+        else:
+            since = segment.members_refreshed_at - MEMBERS_REFRESH_OVERLAP
+            changed_ids = User.objects.filter(date_updated__gte=since).values('id')
+            removed, _ = members.filter(user_id__in=changed_ids).exclude(
+                user_id__in=matching.values('id')
+            ).delete()
+            added = _insert_members(segment, matching.filter(date_updated__gte=since))
+
+        count = members.count()
+        UserSegment.objects.filter(id=segment.id).update(
+            members_refreshed_at=started_at,
+            members_rules_hash=signature,
+            cached_user_count=count,
+            cache_updated_at=started_at,
+        )
+
+    return {'full': full, 'added': added, 'removed': removed, 'count': count}
+
+
+def segment_recipients_queryset(segment, max_age: Optional[timedelta] = None):
+    """
+    Получатели рассылки по сегменту.
+
+    Статический сегмент — JOIN по segment_static_members (это и есть состав).
+    Если segment_members свежий и построен по текущим правилам —
+    индексный JOIN по материализованному составу, иначе план сегмента.
+    """
+    from django.conf import settings
+    from .models import User
+
+    if segment.segment_type == 'static' and not segment.filter_rules:
+        return User.objects.filter(status='active', static_segment_memberships__segment_id=segment.id)
+
+    if max_age is None:
+        max_age = timedelta(seconds=getattr(settings, 'SEGMENT_MEMBERS_MAX_AGE', 15 * 60))
+
+    is_fresh = (
+        segment.members_refreshed_at is not None
+        and segment.members_rules_hash == membership_signature(segment)
+        and timezone.now() - segment.members_refreshed_at <= max_age
+    )
+    if not is_fresh and segment.segment_type == 'composite':
+        # Для составного сегмента другого источника нет — досчитываем состав сразу
+        refresh_segment_members(segment)
+        is_fresh = True
+    if is_fresh:
+        return User.objects.filter(status='active', segment_memberships__segment_id=segment.id)
+    return segment_users_queryset(segment)
+
+
+# ============================================================================
+# ПРЕВЬЮ РАЗМЕРА СЕГМЕНТА
+# ============================================================================
+
+PREVIEW_CACHE_PREFIX = 'segment_preview:'
+
+
+def preview_cache_key(plan_hash: str) -> str:
+    return f'{PREVIEW_CACHE_PREFIX}{plan_hash}'
+
+
+def _users_reltuples() -> int:
+    """Оценка числа строк users из статистики планировщика (-1 если ANALYZE не было)."""
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'app.users'::regclass")
+        row = cursor.fetchone()
+    return int(row[0]) if row else -1
+
+
+def count_segment_exact(filter_rules: Any) -> int:
+    """Точный COUNT активных пользователей по правилам."""
+    from .models import User
+
+    plan = compile_segment_rules(filter_rules)
+    return plan.apply(User.objects.filter(status='active')).count()
+
+
+def estimate_segment_size(filter_rules: Any) -> Dict[str, Any]:
+    """
+    Быстрая оценка размера сегмента по правилам.
+
+    Небольшие таблицы считаются точно. Для больших план применяется
+    к выборке TABLESAMPLE SYSTEM (~SEGMENT_PREVIEW_SAMPLE_ROWS строк),
+    доля совпавших масштабируется на reltuples из pg_class.
+
+    Returns:
+        {count, exact, method, sample_percent}
+    """
+    from django.conf import settings
+    from django.db.models import Count
+    from django.db.models.expressions import RawSQL
+    from .models import User
+
+    plan = compile_segment_rules(filter_rules)
+    total = _users_reltuples()
+
+    if total < getattr(settings, 'SEGMENT_PREVIEW_EXACT_BELOW', 50_000):
+        return {
+            'count': count_segment_exact(filter_rules),
+            'exact': True,
+            'method': 'count',
+            'sample_percent': 100.0,
+        }
+
+    sample_rows = getattr(settings, 'SEGMENT_PREVIEW_SAMPLE_ROWS', 20_000)
+    sample_percent = min(100.0, max(0.01, sample_rows * 100.0 / total))
+    sampled_ids = RawSQL(
+        'SELECT id FROM app.users TABLESAMPLE SYSTEM (%s)',
+        [sample_percent],
+    )
+    stats = User.objects.filter(pk__in=sampled_ids).aggregate(
+        sampled=Count('pk'),
+        matched=Count('pk', filter=Q(status='active') & plan.to_q()),
+    )
+
+    sampled = stats['sampled'] or 0
+    estimate = round(stats['matched'] * total / sampled) if sampled else 0
+    return {
+        'count': estimate,
+        'exact': False,
+        'method': 'tablesample',
+        'sample_percent': round(sample_percent, 3),
+    }
+
+
+# ============================================================================
+# СТАТИЧЕСКИЕ СЕГМЕНТЫ (segment_static_members)
+# ============================================================================
+
+UUID_SQL_RE = '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+
+
+def import_static_members(segment, csv_file, replace: bool = False) -> Dict[str, int]:
+    """
+    Импорт состава статического сегмента из CSV.
+
+    Первая колонка — UUID пользователя или telegram_id (разделитель , ; или TAB,
+    заголовок и мусорные строки просто не совпадут ни с кем). Файл потоком
+    уходит в Postgres через COPY во временную таблицу, сопоставление
+    с users и вставка — одним INSERT ... SELECT на стороне БД.
+
+    Args:
+        csv_file: бинарный или текстовый файловый объект
+        replace: заменить текущий состав, а не дополнить
+
+    Returns:
+        {rows, matched, added, removed}
+    """
+    from django.db import connection, transaction
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE tmp_static_import (line TEXT) ON COMMIT DROP")
+        # Вся строка — одно значение: управляющие символы вместо разделителя и кавычки
+        cursor.copy_expert(
+            "COPY tmp_static_import (line) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\x01', QUOTE E'\\x02')",
+            csv_file,
+        )
+
+        cursor.execute("""
+            CREATE TEMP TABLE tmp_static_values ON COMMIT DROP AS
+            SELECT DISTINCT
+                CASE WHEN value ~* %(uuid_re)s THEN value::uuid END AS user_uuid,
+                CASE WHEN value ~ '^[0-9]{1,18}$' THEN value::bigint END AS telegram_id
+            FROM (
+                SELECT lower(btrim((regexp_split_to_array(line, '[,;\t]'))[1], ' "''')) AS value
+                FROM tmp_static_import
+            ) raw
+        """, {'uuid_re': UUID_SQL_RE})
+        cursor.execute("SELECT COUNT(*) FROM tmp_static_import")
+        rows = cursor.fetchone()[0]
+
+        cursor.execute("""
+            CREATE TEMP TABLE tmp_static_users ON COMMIT DROP AS
+            SELECT u.id FROM app.users u JOIN tmp_static_values v ON u.id = v.user_uuid
+            UNION
+            SELECT u.id FROM app.users u JOIN tmp_static_values v ON u.telegram_id = v.telegram_id
+        """)
+        cursor.execute("SELECT COUNT(*) FROM tmp_static_users")
+        matched = cursor.fetchone()[0]
+
+        removed = 0
+        if replace:
+            cursor.execute("""
+                DELETE FROM app.segment_static_members m
+                WHERE m.segment_id = %s
+                  AND NOT EXISTS (SELECT 1 FROM tmp_static_users t WHERE t.id = m.user_id)
+            """, [segment.id])
+            removed = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO app.segment_static_members (segment_id, user_id, date_added)
+            SELECT %s, t.id, NOW() FROM tmp_static_users t
+            ON CONFLICT (segment_id, user_id) DO NOTHING
+        """, [segment.id])
+        added = cursor.rowcount
+
+    return {'rows': rows, 'matched': matched, 'added': added, 'removed': removed}
+
+
+# ============================================================================
+# ТОЧЕЧНОЕ ОБНОВЛЕНИЕ СОСТАВА (LISTEN/NOTIFY)
+# ============================================================================
+
+def sync_members_for_users(segments, user_ids, now: Optional[datetime] = None) -> Dict[Any, int]:
+    """
+    Пересчитывает принадлежность к сегментам только для указанных пользователей.
+
+    Один SELECT по users с флагом на каждый сегмент, diff с segment_members,
+    вставка / удаление разницы. Используется слушателем изменений users
+    (manage.py listen_segment_changes).
+
+    Returns:
+        {segment_id: изменение размера}
+    """
+    from collections import Counter, defaultdict
+    from django.db import transaction
+    from django.db.models import BooleanField, ExpressionWrapper
+    from .models import SegmentMember, User
+
+    now = now or timezone.now()
+    user_ids = list(user_ids)
+
+    annotations = {}
+    segment_by_alias = {}
+    for segment in segments:
+        alias = f'in_{segment.pk.hex}'
+        try:
+            condition = Q(status='active') & segment_filter_q(segment, now)
+        except SegmentRuleError:
+            continue
+        annotations[alias] = ExpressionWrapper(condition, output_field=BooleanField())
+        segment_by_alias[alias] = segment
+
+    if not annotations or not user_ids:
+        return {}
+
+    rows = User.objects.filter(id__in=user_ids).order_by().annotate(**annotations).values('id', *annotations)
+    expected = {
+        (segment.id, row['id'])
+        for row in rows
+        for alias, segment in segment_by_alias.items()
+        if row[alias]
+    }
+    current = set(
+        SegmentMember.objects.filter(
+            user_id__in=user_ids,
+            segment_id__in=[segment.id for segment in segment_by_alias.values()],
+        ).values_list('segment_id', 'user_id')
+    )
+
+    to_add = expected - current
+    to_remove = defaultdict(list)
+    for segment_id, user_id in current - expected:
+        to_remove[segment_id].append(user_id)
+
+    with transaction.atomic():
+        SegmentMember.objects.bulk_create(
+            [SegmentMember(segment_id=segment_id, user_id=user_id) for segment_id, user_id in to_add],
+            ignore_conflicts=True,
+        )
+        for segment_id, removed_ids in to_remove.items():
+            SegmentMember.objects.filter(segment_id=segment_id, user_id__in=removed_ids).delete()
+
+    deltas = Counter(segment_id for segment_id, _ in to_add)
+    for segment_id, removed_ids in to_remove.items():
+        deltas[segment_id] -= len(removed_ids)
+    return {segment_id: delta for segment_id, delta in deltas.items() if delta}
@@ -0,0 +1,197 @@
+"""
+Пересчёт стриков привычек (app.habits.current_streak / longest_streak)
+по app.habit_completions одним запросом для всех привычек.
+
+Правила — как calculateHabitStreak на сервере (server/src/api/routes/habits.ts):
+- стрик — подряд выполненные запланированные дни; расписание задают
+  frequency и custom_days (0=пн..6=вс), выполнения в незапланированные дни
+  не считаются и не рвут стрик;
+- замороженные дни (is_frozen) — обычные выполнения;
+- текущий стрик заканчивается в последний запланированный день не позже
+  сегодня; если сегодня запланировано, но ещё не выполнено — во вчерашний
+  запланированный день; дни до создания привычки в текущий стрик не входят;
+- «сегодня» и день создания — по часовому поясу пользователя.
+
+Gaps-and-islands: каждому запланированному дню привычки присваивается
+порядковый номер (слот) — номер недели × число дней в расписании + номер
+дня внутри недели. У подряд выполненных запланированных дней разность
+слот − ROW_NUMBER() одинакова: это один «остров» (стрик). Обновляются
+только расходящиеся строки; расхождения возвращаются отчётом.
+"""
+
+import logging
+from typing import Any, Dict
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+# Сколько самых больших расхождений показывать в отчёте
+DRIFT_SAMPLE_SIZE = 20
+
+# Понедельник: от него считаются недели для слотов
+SLOT_EPOCH = '1970-01-05'
+
+COMPUTE_SQL = """
+    WITH habit_days AS (
+        SELECT
+            h.id AS habit_id,
+            h.current_streak AS old_current,
+            h.longest_streak AS old_longest,
+            (h.date_created AT TIME ZONE COALESCE(tz.name, 'UTC'))::date AS created_day,
+            (%(now)s::timestamptz AT TIME ZONE COALESCE(tz.name, 'UTC'))::date AS today,
+            sched.days,
+            -- upto[k + 1] — сколько дней расписания приходится на дни недели 0..k
+            ARRAY(
+                SELECT (SELECT COUNT(*) FROM unnest(sched.days) AS s WHERE s <= w)::int
+                FROM generate_series(0, 6) AS w
+                ORDER BY w
+            ) AS upto
+        FROM app.habits h
+        JOIN app.users u ON u.id = h.user_id
+        -- Неизвестный часовой пояс не должен ронять весь пересчёт
+        LEFT JOIN pg_timezone_names tz ON tz.name = u.timezone
+        CROSS JOIN LATERAL (
+            SELECT ARRAY(
+                SELECT DISTINCT d
+                FROM unnest(CASE h.frequency::text
+                    WHEN 'weekdays' THEN ARRAY[0, 1, 2, 3, 4]
+                    WHEN 'weekends' THEN ARRAY[5, 6]
+                    WHEN 'custom' THEN COALESCE(h.custom_days, ARRAY[]::int[])
+                    ELSE ARRAY[0, 1, 2, 3, 4, 5, 6]
+                END) AS d
+                WHERE d BETWEEN 0 AND 6
+            ) AS days
+        ) AS sched
+    ),
+    habit_slots AS (
+        SELECT
+            hd.*,
+            ((hd.today - DATE '{epoch}') / 7) * hd.upto[7] + hd.upto[EXTRACT(ISODOW FROM hd.today)::int] AS today_slot,
+            (EXTRACT(ISODOW FROM hd.today)::int - 1) = ANY(hd.days) AS today_scheduled
+        FROM habit_days hd
+    ),
+    scheduled_completions AS (
+        SELECT
+            c.habit_id,
+            c.completed_date,
+            c.completed_date >= hs.created_day AS since_created,
+            ((c.completed_date - DATE '{epoch}') / 7) * hs.upto[7]
+                + hs.upto[EXTRACT(ISODOW FROM c.completed_date)::int] AS slot
+        FROM app.habit_completions c
+        JOIN habit_slots hs ON hs.habit_id = c.habit_id
+        WHERE c.completed_date <= hs.today
+          AND (EXTRACT(ISODOW FROM c.completed_date)::int - 1) = ANY(hs.days)
+    ),
+    islands AS (
+        SELECT
+            habit_id,
+            MAX(slot) AS last_slot,
+            COUNT(*) AS length,
+            COUNT(*) FILTER (WHERE since_created) AS length_since_created
+        FROM (
+            SELECT
+                sc.*,
+                slot - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY completed_date) AS island
+            FROM scheduled_completions sc
+        ) AS numbered
+        GROUP BY habit_id, island
+    ),
+    computed AS (
+        SELECT
+            hs.habit_id,
+            hs.old_current,
+            hs.old_longest,
+            -- Последний запланированный день сервер засчитывает и до создания
+            -- привычки; вчерашний (если сегодня ещё не отмечено) — нет
+            COALESCE(MAX(CASE
+                WHEN i.last_slot = hs.today_slot THEN GREATEST(i.length_since_created, 1)
+                WHEN hs.today_scheduled AND i.last_slot = hs.today_slot - 1 THEN i.length_since_created
+            END), 0)::int AS new_current,
+            COALESCE(MAX(i.length), 0)::int AS new_longest
+        FROM habit_slots hs
+        LEFT JOIN islands i ON i.habit_id = hs.habit_id
+        GROUP BY hs.habit_id, hs.old_current, hs.old_longest
+    ),
+    drift AS (
+        SELECT *
+        FROM computed
+        WHERE (new_current, new_longest) IS DISTINCT FROM (old_current, old_longest)
+    ){update}
+    SELECT
+        (SELECT COUNT(*) FROM computed),
+        COUNT(*),
+        COUNT(*) FILTER (WHERE new_current IS DISTINCT FROM old_current),
+        COUNT(*) FILTER (WHERE new_longest IS DISTINCT FROM old_longest),
+        {updated_count},
+        (
+            SELECT COALESCE(jsonb_agg(sample), '[]'::jsonb)
+            FROM (
+                SELECT habit_id, old_current, new_current, old_longest, new_longest
+                FROM drift
+                ORDER BY GREATEST(
+                    ABS(new_current - COALESCE(old_current, 0)),
+                    ABS(new_longest - COALESCE(old_longest, 0))
+                ) DESC
+                LIMIT %(sample_size)s
+            ) AS sample
+        )
+    FROM drift
+"""
+
+# Строка, изменённая сервером после снимка запроса (отметка выполнения),
+# не перезаписывается: условие на старые значения перепроверяется
+# на новой версии строки, и такая строка пропускается
+UPDATE_CTE = """,
+    updated AS (
+        UPDATE app.habits h
+        SET current_streak = d.new_current,
+            longest_streak = d.new_longest
+        FROM drift d
+        WHERE h.id = d.habit_id
+          AND h.current_streak IS NOT DISTINCT FROM d.old_current
+          AND h.longest_streak IS NOT DISTINCT FROM d.old_longest
+        RETURNING h.id
+    )"""
+
+
+def recompute_habit_streaks(dry_run: bool = False, sample_size: int = DRIFT_SAMPLE_SIZE) -> Dict[str, Any]:
+    """
+    Пересчитывает стрики всех привычек и записывает расходящиеся значения.
+
+    Args:
+        dry_run: только отчёт о расхождениях, без записи
+        sample_size: сколько самых больших расхождений вернуть
+
+    Returns:
+        {habits, drifted, current_drifted, longest_drifted, updated, sample: [...]}
+        Элемент sample: habit_id, old_current, new_current, old_longest, new_longest.
+    """
+    sql = COMPUTE_SQL.format(
+        epoch=SLOT_EPOCH,
+        update='' if dry_run else UPDATE_CTE,
+        updated_count='0' if dry_run else '(SELECT COUNT(*) FROM updated)',
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, {'now': timezone.now(), 'sample_size': sample_size})
+        habits, drifted, current_drifted, longest_drifted, updated, sample = cursor.fetchone()
+
+    stats = {
+        'habits': habits,
+        'drifted': drifted,
+        'current_drifted': current_drifted,
+        'longest_drifted': longest_drifted,
+        'updated': updated,
+        'sample': sample or [],
+    }
+
+    if drifted:
+        logger.warning(
+            f"Habit streak drift: {drifted} of {habits} habits "
+            f"(current: {current_drifted}, longest: {longest_drifted}), updated {updated}"
+            f"{' (dry run)' if dry_run else ''}"
+        )
+    return stats
@@ -19,6 +19,25 @@ from django.utils import timezone
 
 import httpx
 
+from .db_router import reporting_connection, use_replica
+from .segments import (
+    SegmentRuleError,
+    compile_segment_rules,
+    count_segment_exact,
+    preview_cache_key,
+    refresh_segment_members,
+    segment_filter_q,
+    segment_recipients_queryset,
+)
+# convert_html_to_markdown_v2 / escape_markdown_v2 / prepare_message_text
+# раньше жили здесь — оставляем импорт для обратной совместимости
+from .telegram_formatting import (
+    compile_message_html,
+    convert_html_to_markdown_v2,
+    escape_markdown_v2,
+    prepare_message_text,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,90 +49,10 @@ def apply_segment_filter(queryset, filter_rules: dict):
     """
     Применяет правила фильтрации сегмента к queryset.
     
-    filter_rules формат:
-    {
-        "subscription_tier": {"in": ["premium", "basic"]},
-        "date_created": {"gte": "-7 days"},
-        "total_entries_count": {"gte": 1}
-    }
+    Правила компилируются и кэшируются в core.segments (формат и операторы
+    описаны там). Некорректные правила вызывают SegmentRuleError.
     """
-    from datetime import datetime, timedelta
-    from django.utils import timezone
-    from django.db.models import Q
-    
-    def parse_relative_time(value: str) -> datetime:
-        """Парсит относительное время типа '-7 days', '-1 month'."""
-        value = value.strip()
-        if not value.startswith('-'):
-            return None
-        
-        parts = value[1:].split(' ')
-        if len(parts) != 2:
-            return None
-        
-        num = int(parts[0])
-        unit = parts[1].rstrip('s')  # days -> day
-        
-        if unit == 'day':
-            return timezone.now() - timedelta(days=num)
-        elif unit == 'week':
-            return timezone.now() - timedelta(weeks=num)
-        elif unit == 'month':
-            return timezone.now() - timedelta(days=num * 30)
-        return None
-    
-    for field, conditions in filter_rules.items():
-        if not isinstance(conditions, dict):
-            # Старый формат: {"status": "active"} без оператора
-            queryset = queryset.filter(**{field: conditions})
-            continue
-            
-        for op, value in conditions.items():
-            if op == 'in':
-                # Обрабатываем null в списке
-                if None in value or 'null' in value:
-                    non_null_values = [v for v in value if v is not None and v != 'null']
-                    q = Q(**{f'{field}__isnull': True})
-                    if non_null_values:
-                        q |= Q(**{f'{field}__in': non_null_values})
-                    # Также проверяем пустую строку для subscription_tier
-                    if field == 'subscription_tier':
-                        q |= Q(**{field: ''})
-                    queryset = queryset.filter(q)
-                else:
-                    queryset = queryset.filter(**{f'{field}__in': value})
-            elif op == 'eq':
-                queryset = queryset.filter(**{field: value})
-            elif op == 'gte':
-                if isinstance(value, str) and value.startswith('-'):
-                    dt = parse_relative_time(value)
-                    if dt:
-                        queryset = queryset.filter(**{f'{field}__gte': dt})
-                else:
-                    queryset = queryset.filter(**{f'{field}__gte': value})
-            elif op == 'lte':
-                if isinstance(value, str) and value.startswith('-'):
-                    dt = parse_relative_time(value)
-                    if dt:
-                        queryset = queryset.filter(**{f'{field}__lte': dt})
-                else:
-                    queryset = queryset.filter(**{f'{field}__lte': value})
-            elif op == 'gt':
-                queryset = queryset.filter(**{f'{field}__gt': value})
-            elif op == 'lt':
-                if isinstance(value, str) and value.startswith('-'):
-                    dt = parse_relative_time(value)
-                    if dt:
-                        queryset = queryset.filter(**{f'{field}__lt': dt})
-                else:
-                    queryset = queryset.filter(**{f'{field}__lt': value})
-            elif op == 'is_null':
-                if value:
-                    queryset = queryset.filter(**{f'{field}__isnull': True})
-                else:
-                    queryset = queryset.filter(**{f'{field}__isnull': False})
-    
-    return queryset
+    return compile_segment_rules(filter_rules).apply(queryset)
 
 
 # ============================================================================
@@ -167,129 +106,12 @@ class TelegramRateLimiter:
         return 0
 
 
-# ============================================================================
-# MARKDOWN V2 HELPERS
-# ============================================================================
-
-def escape_markdown_v2(text: str) -> str:
-    """
-    Экранирует специальные символы для MarkdownV2.
-    
-    Символы которые нужно экранировать:
-    _ * [ ] ( ) ~ ` > # + - = | { } . !
-    """
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    result = []
-    for char in text:
-        if char in escape_chars:
-            result.append('\\')
-        result.append(char)
-    return ''.join(result)
-
-
-def convert_html_to_markdown_v2(text: str) -> str:
-    """
-    Конвертирует простой HTML в MarkdownV2 формат.
-    
-    Поддерживаемые теги:
-    - <b>text</b> → *text*
-    - <i>text</i> → _text_
-    - <code>text</code> → `text`
-    - <s>text</s> → ~text~
-    """
-    import re
-    
-    # Сначала обрабатываем ссылки (до экранирования)
-    link_pattern = r'<a\s+href=["\']([^"\']+)["\']>([^<]+)</a>'
-    links = re.findall(link_pattern, text, re.IGNORECASE)
-    link_placeholders = {}
-    
-    for i, (url, link_text) in enumerate(links):
-        placeholder = f"__LINK_PLACEHOLDER_{i}__"
-        text = re.sub(
-            rf'<a\s+href=["\']' + re.escape(url) + rf'["\']>' + re.escape(link_text) + r'</a>',
-            placeholder,
-            text,
-            flags=re.IGNORECASE
-        )
-        # Экранируем текст ссылки и URL
-        escaped_text = escape_markdown_v2(link_text)
-        escaped_url = url.replace(')', '\\)')
-        link_placeholders[placeholder] = f"[{escaped_text}]({escaped_url})"
-    
-    # Сохраняем форматирование
-    formatting_items = []
-    
-    # Находим все теги форматирования
-    for tag, md_char in [
-        ('b', '*'),
-        ('strong', '*'),
-        ('i', '_'),
-        ('em', '_'),
-        ('code', '`'),
-        ('s', '~'),
-        ('strike', '~'),
-    ]:
-        pattern = rf'<{tag}>([^<]*)</{tag}>'
-        for j, match in enumerate(re.finditer(pattern, text, re.IGNORECASE)):
-            content = match.group(1)
-            placeholder = f"__FORMAT_{tag}_{j}__"
-            formatting_items.append((placeholder, content, md_char))
-        text = re.sub(pattern, lambda m: f"__FORMAT_{tag}_{re.finditer(pattern, text, re.IGNORECASE).__next__}__", text, flags=re.IGNORECASE)
-    
-    # Проще - замена напрямую с экранированием
-    for tag, md_char in [
-        ('b', '*'),
-        ('strong', '*'),
-        ('i', '_'),
-        ('em', '_'),
-        ('code', '`'),
-        ('s', '~'),
-        ('strike', '~'),
-    ]:
-        pattern = rf'<{tag}>([^<]*)</{tag}>'
-        
-        def replace_tag(m, char=md_char):
-            content = escape_markdown_v2(m.group(1))
-            return f"{char}{content}{char}"
-        
-        text = re.sub(pattern, replace_tag, text, flags=re.IGNORECASE)
-    
-    # Экранируем оставшийся текст (вне тегов)
-    # Для простоты - просто удаляем необработанные теги
-    text = re.sub(r'<[^>]+>', '', text)
-    
-    # Восстанавливаем ссылки
-    for placeholder, link in link_placeholders.items():
-        text = text.replace(placeholder, link)
-    
-    return text
-
-
-def prepare_message_text(text: str) -> tuple:
-    """
-    Подготавливает текст сообщения для отправки в MarkdownV2.
-    
-    Если текст содержит HTML теги - конвертирует в MarkdownV2.
-    Иначе просто экранирует специальные символы.
-    
-    Returns:
-        (prepared_text, parse_mode)
-    """
-    import re
-    
-    # Проверяем есть ли HTML теги
-    html_pattern = r'<(b|i|u|s|code|a|strong|em|strike)\b[^>]*>'
-    has_html = bool(re.search(html_pattern, text, re.IGNORECASE))
-    
-    if has_html:
-        # Конвертируем HTML в MarkdownV2
-        prepared = convert_html_to_markdown_v2(text)
-    else:
-        # Просто экранируем
-        prepared = escape_markdown_v2(text)
-    
-    return prepared, 'MarkdownV2'
+def _is_markup_error(data: Dict[str, Any]) -> bool:
+    """Telegram отклонил разметку (HTML или entities), а не получателя."""
+    if data.get('ok') or data.get('error_code') != 400:
+        return False
+    error_desc = data.get('description', '').lower()
+    return 'parse' in error_desc or 'entit' in error_desc or "can't" in error_desc
 
 
 async def send_telegram_message_async(
@@ -300,11 +122,13 @@ async def send_telegram_message_async(
     photo_url: Optional[str] = None,
     parse_mode: str = 'HTML',
     button_text: Optional[str] = None,
-    button_url: Optional[str] = None
+    button_url: Optional[str] = None,
+    entities: Optional[List[Dict]] = None
 ) -> Dict[str, Any]:
     """
     Асинхронная отправка сообщения через Telegram Bot API.
-    Использует HTML parse_mode.
+    Использует HTML parse_mode, либо готовые entities
+    (см. compile_message_html) — тогда text должен быть plain text.
     
     Returns:
         {success: bool, error: str | None, blocked: bool}
@@ -320,29 +144,46 @@ async def send_telegram_message_async(
             ]]
         }
     
-    try:
+    def build_payload(use_entities: bool = True):
         if photo_url:
             url = f"{base_url}/sendPhoto"
             payload = {
                 "chat_id": chat_id,
                 "photo": photo_url,
                 "caption": text,
-                "parse_mode": 'HTML',
             }
+            if entities is None:
+                payload["parse_mode"] = 'HTML'
+            elif use_entities:
+                payload["caption_entities"] = entities
         else:
             url = f"{base_url}/sendMessage"
             payload = {
                 "chat_id": chat_id,
                 "text": text,
-                "parse_mode": 'HTML',
             }
+            if entities is None:
+                payload["parse_mode"] = 'HTML'
+            elif use_entities:
+                payload["entities"] = entities
         
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        
+        return url, payload
+    
+    try:
+        url, payload = build_payload()
         response = await client.post(url, json=payload, timeout=30.0)
         data = response.json()
         
+        # Telegram не принял entities (например, неверные смещения) —
+        # один раз отправляем тот же текст без разметки
+        if entities is not None and _is_markup_error(data):
+            logger.warning(f"Entities rejected for {chat_id}, retrying without them: {data.get('description')}")
+            url, payload = build_payload(use_entities=False)
+            response = await client.post(url, json=payload, timeout=30.0)
+            data = response.json()
+        
         if response.status_code == 200 and data.get('ok'):
             return {'success': True, 'error': None, 'blocked': False}
         
@@ -385,12 +226,16 @@ def send_telegram_message_sync(
     photo_url: Optional[str] = None,
     parse_mode: Optional[str] = 'HTML',
     button_text: Optional[str] = None,
-    button_url: Optional[str] = None
+    button_url: Optional[str] = None,
+    entities: Optional[List[Dict]] = None
 ) -> Dict[str, Any]:
     """
     Синхронная отправка сообщения через Telegram Bot API.
     Использует HTML parse_mode (нативная поддержка Telegram).
     При ошибке парсинга - отправляет как plain text.
+    
+    Если переданы entities (см. compile_message_html), text отправляется
+    как plain text с готовой разметкой, без parse_mode.
     """
     base_url = f"https://api.telegram.org/bot{bot_token}"
     
@@ -404,6 +249,7 @@ def send_telegram_message_sync(
         }
     
     def make_request(msg_text: str, use_parse_mode: bool = True):
+        # use_parse_mode=False — без какой-либо разметки (ни HTML, ни entities)
         if photo_url:
             url = f"{base_url}/sendPhoto"
             payload = {
@@ -411,7 +257,9 @@ def send_telegram_message_sync(
                 "photo": photo_url,
                 "caption": msg_text,
             }
-            if use_parse_mode:
+            if use_parse_mode and entities is not None:
+                payload["caption_entities"] = entities
+            elif use_parse_mode:
                 payload["parse_mode"] = 'HTML'
         else:
             url = f"{base_url}/sendMessage"
@@ -419,7 +267,9 @@ def send_telegram_message_sync(
                 "chat_id": chat_id,
                 "text": msg_text,
             }
-            if use_parse_mode:
+            if use_parse_mode and entities is not None:
+                payload["entities"] = entities
+            elif use_parse_mode:
                 payload["parse_mode"] = 'HTML'
         
         if reply_markup:
@@ -432,16 +282,19 @@ def send_telegram_message_sync(
         response = make_request(text, use_parse_mode=True)
         data = response.json()
         
-        # Если ошибка парсинга HTML - пробуем plain text
-        if not data.get('ok'):
+        # Если ошибка разметки - пробуем plain text
+        if not data.get('ok') and _is_markup_error(data):
             error_desc = data.get('description', '').lower()
-            if 'parse' in error_desc or 'entities' in error_desc or "can't" in error_desc:
-                logger.warning(f"HTML parse error, retrying as plain text: {error_desc}")
+            logger.warning(f"Markup error, retrying as plain text: {error_desc}")
+            if entities is None:
                 # Убираем HTML теги для plain text
                 import re
                 plain_text = re.sub(r'<[^>]+>', '', text)
-                response = make_request(plain_text, use_parse_mode=False)
-                data = response.json()
+            else:
+                # С entities text уже plain text — отправляем без них
+                plain_text = text
+            response = make_request(plain_text, use_parse_mode=False)
+            data = response.json()
         
         if response.status_code == 200 and data.get('ok'):
             return {'success': True, 'error': None, 'blocked': False}
@@ -493,7 +346,7 @@ def get_broadcast_progress(broadcast_id: str) -> Optional[Dict]:
     return cache.get(get_broadcast_cache_key(broadcast_id))
 
 
-@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+@shared_task(bind=True, max_retries=3, default_retry_delay=60, ignore_result=False)
 def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
     """
     Основная задача для выполнения рассылки.
@@ -537,19 +390,22 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
     users_query = User.objects.filter(status='active')
     
     # ПРИОРИТЕТ: сегмент > target_audience
-    if broadcast.segment_id:
-        segment = broadcast.segment
-        if segment and segment.filter_rules:
-            # Применяем правила фильтрации сегмента
-            users_query = apply_segment_filter(users_query, segment.filter_rules)
-        elif segment and segment.static_user_ids:
-            # Статический сегмент - конкретные user_id
-            users_query = User.objects.filter(id__in=segment.static_user_ids, status='active')
-    elif broadcast.target_audience == 'premium':
-        # Legacy: фильтр по аудитории
-        users_query = users_query.filter(subscription_tier__in=['premium', 'basic'])
-    elif broadcast.target_audience == 'free':
-        users_query = users_query.filter(subscription_tier__in=['free', None, ''])
+    try:
+        if broadcast.segment_id:
+            # Материализованный состав (JOIN) или план сегмента, если состав устарел
+            users_query = segment_recipients_queryset(broadcast.segment)
+        elif broadcast.target_audience == 'premium':
+            # Legacy: фильтр по аудитории
+            users_query = users_query.filter(subscription_tier__in=['premium', 'basic'])
+        elif broadcast.target_audience == 'free':
+            users_query = users_query.filter(subscription_tier__in=['free', None, ''])
+    except SegmentRuleError as e:
+        logger.error(f"Broadcast {broadcast_id}: invalid segment rules: {e}")
+        Broadcast.objects.filter(id=broadcast_id).update(
+            status='failed',
+            last_error=f'Некорректные правила сегмента: {e}'
+        )
+        return {'success': False, 'error': str(e)}
     
     recipients = list(users_query.values_list('telegram_id', flat=True))
     total = len(recipients)
@@ -576,9 +432,13 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
     rate_limit = getattr(settings, 'TELEGRAM_RATE_LIMIT', 25)
     rate_limiter = TelegramRateLimiter(rate=rate_limit)
     
+    # HTML разбираем один раз на всю рассылку
+    message = compile_message_html(broadcast.message_text)
+    
     sent_count = 0
     failed_count = 0
     blocked_users = []
+    delivered = []
     last_error = None
     cancelled = False
     
@@ -601,7 +461,8 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
         result = send_telegram_message_sync(
             bot_token=bot_token,
             chat_id=telegram_id,
-            text=broadcast.message_text,
+            text=message.text,
+            entities=message.entities,
             photo_url=broadcast.message_photo_url,
             button_text=broadcast.button_text,
             button_url=broadcast.button_url
@@ -609,6 +470,7 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
         
         if result['success']:
             sent_count += 1
+            delivered.append(telegram_id)
         else:
             failed_count += 1
             last_error = result.get('error')
@@ -656,6 +518,13 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
     
     logger.info(f"Broadcast {broadcast_id} {final_status}: {sent_count} sent, {failed_count} failed")
     
+    # Битмап получателей — для составных сегментов вида "... минус получившие рассылку"
+    try:
+        from core.bitmaps import record_broadcast_delivery
+        record_broadcast_delivery(broadcast_id, delivered)
+    except Exception as e:
+        logger.error(f"Broadcast {broadcast_id}: failed to record delivery bitmap: {e}")
+    
     return {
         'success': True,
         'sent': sent_count,
@@ -665,7 +534,7 @@ def execute_broadcast(self, broadcast_id: str) -> Dict[str, Any]:
     }
 
 
-@shared_task(bind=True)
+@shared_task(bind=True, ignore_result=True)
 def send_single_message(
     self,
     telegram_id: int,
@@ -679,20 +548,25 @@ def send_single_message(
     - Уведомлений
     - Приветственных сообщений
     - Одиночных отправок
+    
+    Результат не сохраняется: при массовых приветствиях каждая задача
+    иначе оставляла бы строку в result backend.
     """
     bot_token = settings.TELEGRAM_BOT_TOKEN
     if not bot_token:
         return {'success': False, 'error': 'No bot token'}
     
+    message = compile_message_html(text)
     return send_telegram_message_sync(
         bot_token=bot_token,
         chat_id=telegram_id,
-        text=text,
+        text=message.text,
+        entities=message.entities,
         photo_url=photo_url
     )
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def scheduled_broadcast_check():
     """
     Периодическая задача для запуска запланированных рассылок.
@@ -713,56 +587,179 @@ def scheduled_broadcast_check():
         execute_broadcast.delay(str(broadcast.id))
 
 
-@shared_task
+@shared_task(ignore_result=True)
 def update_segment_user_counts():
     """
     Пересчитывает количество пользователей в каждом сегменте.
-    Запускается периодически через Celery Beat или вручную.
+    
+    Все сегменты считаются за один проход по users:
+    COUNT(*) FILTER (WHERE <план сегмента>) на каждый сегмент,
+    затем один bulk UPDATE. Запускается через Celery Beat или вручную.
     """
+    from django.db.models import Count
     from core.models import UserSegment, User
     
-    segments = UserSegment.objects.all()
-    updated = 0
+    now = timezone.now()
+    
+    # Подсчёт — с реплики (если настроена), bulk UPDATE — на primary
+    with use_replica():
+        segments = list(UserSegment.objects.all())
+        
+        aggregates = {}
+        for segment in segments:
+            try:
+                aggregates[f'segment_{segment.pk.hex}'] = Count('pk', filter=segment_filter_q(segment, now))
+            except SegmentRuleError as e:
+                logger.error(f"Error updating segment {segment.slug}: {e}")
+        
+        if not aggregates:
+            return {'updated': 0}
+        
+        counts = User.objects.filter(status='active').aggregate(**aggregates)
+    
+    updated_segments = []
+    for segment in segments:
+        key = f'segment_{segment.pk.hex}'
+        if key not in counts:
+            continue
+        segment.cached_user_count = counts[key]
+        segment.cache_updated_at = now
+        updated_segments.append(segment)
+        logger.info(f"Segment {segment.slug}: {counts[key]} users")
+    
+    UserSegment.objects.bulk_update(
+        updated_segments,
+        ['cached_user_count', 'cache_updated_at'],
+        batch_size=len(updated_segments),
+    )
+    
+    return {'updated': len(updated_segments)}
+
+
+@shared_task(ignore_result=True)
+def refresh_all_segment_members():
+    """
+    Обновляет материализованный состав сегментов (segment_members)
+    и их битмапы в Redis. Составные сегменты считаются последними —
+    из уже обновлённых битмапов остальных.
+    Запускается через Celery Beat каждые несколько минут.
+    """
+    from django.db.models import Case, IntegerField, Value, When
+    from admin_panel.utils import get_redis
+    from core.bitmaps import ensure_bitmap_index, segment_bitmap_key, store_segment_bitmap
+    from core.models import UserSegment
+    
+    ensure_bitmap_index()
+    redis = get_redis()
+    
+    segments = UserSegment.objects.annotate(
+        is_composite=Case(
+            When(segment_type='composite', then=Value(1)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    ).order_by('is_composite', 'slug')
     
+    refreshed = 0
     for segment in segments:
         try:
-            users_query = User.objects.filter(status='active')
-            
-            if segment.filter_rules:
-                users_query = apply_segment_filter(users_query, segment.filter_rules)
-                count = users_query.count()
-            elif segment.static_user_ids:
-                count = User.objects.filter(id__in=segment.static_user_ids, status='active').count()
-            elif segment.slug == 'all':
-                count = users_query.count()
-            elif segment.slug == 'premium':
-                count = users_query.filter(subscription_tier__in=['premium', 'basic']).count()
-            elif segment.slug == 'free':
-                count = users_query.filter(subscription_tier__in=['free', None, '']).count()
-            else:
-                count = 0
-            
-            UserSegment.objects.filter(id=segment.id).update(
-                cached_user_count=count,
-                cache_updated_at=timezone.now()
+            stats = refresh_segment_members(segment)
+            if stats['added'] or stats['removed'] or not redis.exists(segment_bitmap_key(segment.id)):
+                store_segment_bitmap(segment)
+            refreshed += 1
+            logger.info(
+                f"Segment {segment.slug} members: {stats['count']} "
+                f"(+{stats['added']} / -{stats['removed']}, {'full' if stats['full'] else 'incremental'})"
             )
-            updated += 1
-            logger.info(f"Segment {segment.slug}: {count} users")
-            
         except Exception as e:
-            logger.error(f"Error updating segment {segment.slug}: {e}")
+            logger.error(f"Error refreshing members of segment {segment.slug}: {e}")
     
-    return {'updated': updated}
+    return {'refreshed': refreshed}
 
 
-@shared_task
+@shared_task(ignore_result=True)
+def update_user_features(full: bool = False):
+    """
+    Обновляет поведенческие признаки пользователей (user_features).
+    Каждые несколько минут — инкрементально, ночью — полный пересчёт.
+    """
+    from core.features import refresh_user_features
+    
+    stats = refresh_user_features(full=full)
+    logger.info(f"User features: {stats['updated']} rows ({'full' if stats['full'] else 'incremental'})")
+    return stats
+
+
+@shared_task(ignore_result=True)
+def update_daily_metrics(days: int = 1):
+    """
+    Пересобирает суточные метрики дашборда (daily_metrics, daily_ai_metrics) за последние days дней.
+    Каждые несколько минут — только сегодня, ночью — последние дни целиком.
+    """
+    from core.rollups import rebuild_recent_daily_metrics
+    
+    stats = rebuild_recent_daily_metrics(days=days)
+    logger.info(f"Daily metrics {stats['first_day']}..{stats['last_day']}: {stats['rows']} rows, {stats['ai_rows']} AI rows")
+    return stats
+
+
+@shared_task(ignore_result=True)
+def recompute_habit_streaks(dry_run: bool = False):
+    """
+    Пересчитывает стрики всех привычек по habit_completions (core.streaks)
+    и исправляет расходящиеся current_streak/longest_streak. Ночью.
+    """
+    from core.streaks import recompute_habit_streaks as recompute
+    
+    stats = recompute(dry_run=dry_run)
+    logger.info(
+        f"Habit streaks: {stats['habits']} habits, {stats['drifted']} drifted, {stats['updated']} updated"
+    )
+    return stats
+
+
+@shared_task(ignore_result=True)
+def update_activity_sketches(backfill_days: Optional[int] = None):
+    """
+    Пополняет HyperLogLog-скетчи активных пользователей по дням (Redis).
+    Раз в минуту — новые записи и выполнения привычек с прошлого прогона.
+    """
+    from core.sketches import feed_activity_sketches
+    
+    stats = feed_activity_sketches(backfill_days=backfill_days)
+    logger.info(f"Activity sketches: {stats}")
+    return stats
+
+
+@shared_task(ignore_result=True)
+def count_segment_preview(filter_rules: Dict) -> None:
+    """
+    Точный размер сегмента для превью в админке.
+    
+    Запускается из segment_preview_api, когда ответ был оценкой;
+    результат кладётся в кэш по хэшу правил, клиент забирает его опросом.
+    """
+    try:
+        plan = compile_segment_rules(filter_rules)
+        count = count_segment_exact(filter_rules)
+    except SegmentRuleError as e:
+        logger.warning(f"Segment preview skipped: {e}")
+        return
+    
+    cache.set(
+        preview_cache_key(plan.rules_hash),
+        {'count': count, 'computed_at': timezone.now().isoformat()},
+        timeout=settings.SEGMENT_PREVIEW_CACHE_TTL,
+    )
+
+
+@shared_task(ignore_result=True)
 def update_traffic_source_stats():
     """
     Пересчитывает статистику для всех источников трафика.
     Запускается периодически через Celery Beat (например, каждый час).
     """
     from core.models import TrafficSource, User
-    from django.db import connection
     from django.db.models import Count, Sum
     
     sources = TrafficSource.objects.filter(is_active=True)
@@ -770,7 +767,8 @@ def update_traffic_source_stats():
     
     for source in sources:
         try:
-            with connection.cursor() as cursor:
+            # Статистика — с реплики (если настроена), UPDATE источника — на primary
+            with use_replica(), reporting_connection().cursor() as cursor:
                 # Пользователи
                 cursor.execute("""
                     SELECT COUNT(*) as total
@@ -804,7 +802,7 @@ def update_traffic_source_stats():
     
     # Также обновим статистику для organic (null referral_source)
     try:
-        with connection.cursor() as cursor:
+        with use_replica(), reporting_connection().cursor() as cursor:
             cursor.execute("""
                 SELECT COUNT(*) as total
                 FROM app.users 
@@ -834,3 +832,31 @@ def update_traffic_source_stats():
         logger.error(f"Error updating organic traffic source: {e}")
     
     return {'updated': updated}
+
+
+@shared_task(ignore_result=True)
+def purge_task_results():
+    """
+    Удаляет старые результаты задач из django_celery_results.
+    
+    Новые результаты живут в Redis с TTL (CELERY_RESULT_EXPIRES),
+    но таблица в PostgreSQL накопила строки от прежнего django-db backend.
+    Запускается ежедневно через Celery Beat.
+    """
+    from django_celery_results.models import TaskResult
+    
+    retention_days = getattr(settings, 'TASK_RESULTS_RETENTION_DAYS', 3)
+    expired = TaskResult.objects.get_all_expired(timedelta(days=retention_days))
+    
+    # Удаляем пачками, чтобы не держать долгую транзакцию на основной БД
+    deleted = 0
+    batch_size = 5000
+    while True:
+        batch_ids = list(expired.values_list('pk', flat=True)[:batch_size])
+        if not batch_ids:
+            break
+        count, _ = TaskResult.objects.filter(pk__in=batch_ids).delete()
+        deleted += count
+    
+    logger.info(f"Purged {deleted} task results older than {retention_days} days")
+    return {'deleted': deleted}
@@ -0,0 +1,272 @@
+"""
+Форматирование текста рассылок для Telegram Bot API.
+
+HTML из редактора рассылок разбирается за один проход в пару
+(plain text, entities) — Telegram принимает её без parse_mode,
+поэтому ошибки разметки больше не ломают отправку.
+
+Особенности:
+- Линейное время: один проход регулярным выражением по тегам
+- Смещения entities в UTF-16 code units (как требует Telegram)
+- Битый HTML не падает: незакрытые теги закрываются в конце текста,
+  лишние закрывающие игнорируются, неизвестные теги вырезаются
+- Сообщение компилируется один раз на рассылку (CompiledMessage)
+"""
+
+import html
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+
+# Тег: <b>, </b>, <a href="...">, <br/>, <span class="tg-spoiler">
+# Всё, что не подходит под грамматику тега, считается обычным текстом ("5 < 6").
+TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)((?:\s+[^<>]*?)?)\s*(/?)>')
+HREF_RE = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+CLASS_RE = re.compile(r'''class\s*=\s*["']([^"']*)["']''', re.IGNORECASE)
+LANGUAGE_RE = re.compile(r'language-([\w+-]+)')
+
+# HTML тег → тип entity в Telegram
+ENTITY_TAGS = {
+    'b': 'bold',
+    'strong': 'bold',
+    'i': 'italic',
+    'em': 'italic',
+    'u': 'underline',
+    'ins': 'underline',
+    's': 'strikethrough',
+    'strike': 'strikethrough',
+    'del': 'strikethrough',
+    'code': 'code',
+    'pre': 'pre',
+    'a': 'text_link',
+    'tg-spoiler': 'spoiler',
+    'blockquote': 'blockquote',
+}
+
+# Теги, которые превращаются в перенос строки
+LINE_BREAK_TAGS = {'br'}
+BLOCK_TAGS = {'p', 'div'}
+
+ALLOWED_URL_PREFIXES = ('http://', 'https://', 'tg://', 'mailto:')
+
+# Маркеры MarkdownV2 для каждого типа entity
+MARKDOWN_V2_MARKERS = {
+    'bold': ('*', '*'),
+    'italic': ('_', '_'),
+    'underline': ('__', '__'),
+    'strikethrough': ('~', '~'),
+    'spoiler': ('||', '||'),
+    'code': ('`', '`'),
+    'pre': ('```\n', '\n```'),
+}
+
+_MARKDOWN_V2_ESCAPE = str.maketrans({char: '\\' + char for char in '\\_*[]()~`>#+-=|{}.!'})
+_MARKDOWN_V2_CODE_ESCAPE = str.maketrans({'\\': '\\\\', '`': '\\`'})
+_MARKDOWN_V2_URL_ESCAPE = str.maketrans({'\\': '\\\\', ')': '\\)'})
+
+
+def escape_markdown_v2(text: str) -> str:
+    """
+    Экранирует специальные символы для MarkdownV2.
+
+    Символы которые нужно экранировать:
+    \\ _ * [ ] ( ) ~ ` > # + - = | { } . !
+    """
+    return text.translate(_MARKDOWN_V2_ESCAPE)
+
+
+def utf16_length(text: str) -> int:
+    """Длина строки в UTF-16 code units (эмодзи занимают 2)."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+@dataclass
+class CompiledMessage:
+    """
+    Результат разбора HTML сообщения.
+
+    text + entities отправляются в Telegram без parse_mode,
+    markdown_v2 — эквивалент для мест, где нужен parse_mode='MarkdownV2'.
+    """
+    text: str
+    entities: List[Dict] = field(default_factory=list)
+    markdown_v2: str = ''
+
+    def as_payload(self, is_caption: bool = False) -> Dict:
+        """Поля для sendMessage / sendPhoto."""
+        text_key, entities_key = ('caption', 'caption_entities') if is_caption else ('text', 'entities')
+        payload = {text_key: self.text}
+        if self.entities:
+            payload[entities_key] = self.entities
+        return payload
+
+
+def _parse_attrs(tag: str, attrs: str) -> Tuple[Optional[str], Dict]:
+    """
+    Определяет тип entity и её доп. поля по тегу и атрибутам.
+    Возвращает (None, {}) если тег не даёт entity.
+    """
+    if tag == 'span':
+        class_match = CLASS_RE.search(attrs)
+        if class_match and 'tg-spoiler' in class_match.group(1).split():
+            return 'spoiler', {}
+        return None, {}
+
+    entity_type = ENTITY_TAGS.get(tag)
+    if entity_type == 'text_link':
+        href_match = HREF_RE.search(attrs)
+        if not href_match:
+            return None, {}
+        url = html.unescape(next(g for g in href_match.groups() if g is not None)).strip()
+        if not url.lower().startswith(ALLOWED_URL_PREFIXES):
+            return None, {}
+        return entity_type, {'url': url}
+
+    if entity_type == 'code':
+        class_match = CLASS_RE.search(attrs)
+        language = LANGUAGE_RE.search(class_match.group(1)) if class_match else None
+        if language:
+            return entity_type, {'language': language.group(1)}
+
+    return entity_type, {}
+
+
+def compile_message_html(source: str) -> CompiledMessage:
+    """
+    Разбирает HTML сообщения в текст + Telegram entities за один проход.
+
+    Поддерживаемые теги:
+    - <b>, <strong> → bold
+    - <i>, <em> → italic
+    - <u>, <ins> → underline
+    - <s>, <strike>, <del> → strikethrough
+    - <code>, <pre> → code / pre
+    - <a href="..."> → text_link
+    - <tg-spoiler>, <span class="tg-spoiler"> → spoiler
+    - <blockquote> → blockquote
+    - <br>, </p>, </div> → перенос строки
+
+    Неизвестные теги вырезаются, их содержимое остаётся.
+    """
+    text_parts: List[str] = []
+    markdown_parts: List[str] = []
+    entities: List[Dict] = []
+    # Стек открытых тегов: (tag, entity_type, offset, extra, markdown_index)
+    stack: List[Tuple[str, Optional[str], int, Dict, int]] = []
+    offset = 0
+    position = 0
+    code_depth = 0
+
+    def append_text(chunk: str):
+        nonlocal offset
+        if not chunk:
+            return
+        chunk = html.unescape(chunk)
+        text_parts.append(chunk)
+        if code_depth:
+            markdown_parts.append(chunk.translate(_MARKDOWN_V2_CODE_ESCAPE))
+        else:
+            markdown_parts.append(chunk.translate(_MARKDOWN_V2_ESCAPE))
+        offset += utf16_length(chunk)
+
+    def close_entry(entry):
+        nonlocal code_depth
+        tag, entity_type, start, extra, markdown_index = entry
+        if entity_type in ('code', 'pre'):
+            code_depth -= 1
+        if entity_type is None:
+            return
+
+        length = offset - start
+        if length > 0:
+            entity = {'type': entity_type, 'offset': start, 'length': length}
+            entity.update(extra)
+            entities.append(entity)
+
+        # MarkdownV2: ссылка открывается "[" и закрывается "](url)"
+        if entity_type == 'text_link':
+            markdown_parts[markdown_index] = '['
+            markdown_parts.append(f"]({extra['url'].translate(_MARKDOWN_V2_URL_ESCAPE)})")
+        elif entity_type in MARKDOWN_V2_MARKERS and length > 0:
+            opening, closing = MARKDOWN_V2_MARKERS[entity_type]
+            markdown_parts[markdown_index] = opening
+            markdown_parts.append(closing)
+
+    for match in TAG_RE.finditer(source):
+        append_text(source[position:match.start()])
+        position = match.end()
+
+        is_closing, tag, attrs, self_closing = match.groups()
+        tag = tag.lower()
+
+        if tag in LINE_BREAK_TAGS:
+            append_text('\n')
+            continue
+
+        if is_closing:
+            # Ищем парный открывающий тег; лишний закрывающий игнорируем
+            for depth in range(len(stack) - 1, -1, -1):
+                if stack[depth][0] == tag:
+                    while len(stack) > depth:
+                        close_entry(stack.pop())
+                    break
+            if tag in BLOCK_TAGS:
+                append_text('\n')
+            continue
+
+        if self_closing:
+            continue
+
+        entity_type, extra = _parse_attrs(tag, attrs)
+        if entity_type is None and tag not in BLOCK_TAGS and tag != 'span':
+            continue
+        if entity_type in ('code', 'pre'):
+            code_depth += 1
+        # Резервируем место под маркер MarkdownV2, заполняется при закрытии
+        markdown_parts.append('')
+        stack.append((tag, entity_type, offset, extra, len(markdown_parts) - 1))
+
+    append_text(source[position:])
+
+    # Незакрытые теги закрываем в конце текста
+    while stack:
+        close_entry(stack.pop())
+
+    # Telegram ожидает entities в порядке смещений
+    entities.sort(key=lambda e: (e['offset'], -e['length']))
+
+    return CompiledMessage(
+        text=''.join(text_parts),
+        entities=entities,
+        markdown_v2=''.join(markdown_parts),
+    )
+
+
+def convert_html_to_markdown_v2(text: str) -> str:
+    """
+    Конвертирует простой HTML в MarkdownV2 формат.
+
+    Поддерживаемые теги:
+    - <b>text</b> → *text*
+    - <i>text</i> → _text_
+    - <code>text</code> → `text`
+    - <s>text</s> → ~text~
+    - <a href="url">text</a> → [text](url)
+    """
+    return compile_message_html(text).markdown_v2
+
+
+def prepare_message_text(text: str) -> tuple:
+    """
+    Подготавливает текст сообщения для отправки в MarkdownV2.
+
+    Если текст содержит HTML теги - конвертирует в MarkdownV2.
+    Иначе просто экранирует специальные символы.
+
+    Returns:
+        (prepared_text, parse_mode)
+    """
+    return compile_message_html(text).markdown_v2, 'MarkdownV2'
@@ -0,0 +1,41 @@
+from django.test import SimpleTestCase
+
+from core.ai_analytics import histogram_percentile
+from core.rollups import LATENCY_BUCKETS_MS
+
+
+class HistogramPercentileTests(SimpleTestCase):
+    """Корзина b (width_bucket) — задержки [LATENCY_BUCKETS_MS[b - 1], LATENCY_BUCKETS_MS[b])."""
+
+    def test_empty_histogram(self):
+        self.assertIsNone(histogram_percentile({}, 0.5))
+        self.assertIsNone(histogram_percentile({3: 0}, 0.5))
+
+    def test_first_bucket_starts_at_zero(self):
+        self.assertEqual(histogram_percentile({0: 10}, 0.5), 50)
+        self.assertEqual(histogram_percentile({0: 10}, 0.99), 99)
+
+    def test_interpolates_inside_bucket(self):
+        # [100, 200): 2 из 4 запросов — середина корзины
+        self.assertEqual(histogram_percentile({1: 4}, 0.5), 150)
+        self.assertEqual(histogram_percentile({1: 4}, 0.25), 125)
+
+    def test_quantile_on_bucket_edge(self):
+        # Ровно половина запросов в первой корзине — её верхняя граница
+        self.assertEqual(histogram_percentile({0: 5, 1: 5}, 0.5), LATENCY_BUCKETS_MS[0])
+        self.assertEqual(histogram_percentile({0: 5, 1: 5}, 1.0), LATENCY_BUCKETS_MS[1])
+
+    def test_skips_to_bucket_with_target(self):
+        self.assertEqual(histogram_percentile({0: 1, 3: 1, 5: 2}, 0.5), LATENCY_BUCKETS_MS[3])
+        self.assertEqual(histogram_percentile({0: 1, 3: 1, 5: 2}, 0.75), 875)
+
+    def test_last_bucket_uses_max_latency(self):
+        last = len(LATENCY_BUCKETS_MS)
+        self.assertEqual(histogram_percentile({last: 2}, 0.5, max_ms=150000), 135000)
+        # Без максимума верхняя граница — нижняя
+        self.assertEqual(histogram_percentile({last: 2}, 0.5), LATENCY_BUCKETS_MS[-1])
+        # Максимум ниже границы корзины — результат всё равно не больше максимума
+        self.assertEqual(histogram_percentile({last: 2}, 0.5, max_ms=100000), 100000)
+
+    def test_clamped_to_max_latency(self):
+        self.assertEqual(histogram_percentile({0: 10}, 0.99, max_ms=90), 90)
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from core.segments import SegmentRuleError, compile_segment_rules
+
+
+class CompileSegmentRulesTests(SimpleTestCase):
+
+    def test_valid_rules(self):
+        plan = compile_segment_rules({
+            'and': [
+                {'subscription_tier': {'in': ['premium', 'basic']}},
+                {'date_created': {'gte': '-7 days'}},
+                {'balance_stars': {'between': [1, 10]}},
+            ],
+        })
+        self.assertTrue(plan.is_time_relative)
+        self.assertFalse(plan.uses_relations)
+        # user_features меняются без users.date_updated — считаются связью
+        self.assertTrue(compile_segment_rules({'features__entries_30d': {'gte': 1}}).uses_relations)
+
+    def test_relative_time_resolves_at_given_moment(self):
+        now = timezone.make_aware(datetime(2026, 10, 18, 12, 0))
+        q = compile_segment_rules({'date_created': {'gte': '-2 days'}}).to_q(now)
+        self.assertEqual(q.children, [('date_created__gte', now - timedelta(days=2))])
+
+    def test_legacy_format_and_relations(self):
+        plan = compile_segment_rules({'status': 'active', 'entries': {'exists': True}})
+        self.assertFalse(plan.is_time_relative)
+        self.assertTrue(plan.uses_relations)
+
+    def test_json_string_and_cache(self):
+        plan = compile_segment_rules('{"status": {"eq": "active"}}')
+        self.assertIs(compile_segment_rules({'status': {'eq': 'active'}}), plan)
+
+    def test_rejects_invalid_rules(self):
+        invalid = {
+            'bad json': '{"status": ',
+            'not an object': ['status'],
+            'unknown field': {'no_such_field': {'eq': 1}},
+            'unknown related field': {'entries__no_such_field': {'eq': 1}},
+            'unknown operator': {'status': {'like': 'act%'}},
+            'empty condition': {'status': {}},
+            'empty and': {'and': []},
+            'or not a list': {'or': {'status': 'active'}},
+            'in not a list': {'status': {'in': 'active'}},
+            'relative time in list': {'date_created': {'in': ['-7 days']}},
+            'relative time in not_in': {'date_created': {'not_in': ['2026-01-01', '-1 day']}},
+            'between one bound': {'balance_stars': {'between': [1]}},
+            'bad relative time': {'date_created': {'gte': '-7 fortnights'}},
+            'bad date': {'date_created': {'gte': '2026-13-45'}},
+            'number as date': {'date_created': {'gte': 20260101}},
+            'bool as number': {'balance_stars': {'gt': True}},
+            'text as number': {'balance_stars': {'gt': 'many'}},
+            'text as bool': {'is_admin': {'eq': 'yes'}},
+            'is_null not bool': {'username': {'is_null': 1}},
+            'exists on field': {'status': {'exists': True}},
+            'exists not bool': {'entries': {'exists': 'yes'}},
+            'relation without field': {'entries': {'eq': 1}},
+        }
+        for name, rules in invalid.items():
+            with self.subTest(name), self.assertRaises(SegmentRuleError):
+                compile_segment_rules(rules)
+
+    def test_rule_error_is_value_error(self):
+        with self.assertRaises(ValueError):
+            compile_segment_rules({'status': {'like': 'x'}})
@@ -0,0 +1,105 @@
+from django.test import SimpleTestCase
+
+from core.telegram_formatting import compile_message_html, utf16_length
+
+
+class Utf16OffsetsTests(SimpleTestCase):
+    """Смещения entities — в UTF-16 code units: эмодзи вне BMP занимают 2."""
+
+    def test_utf16_length(self):
+        self.assertEqual(utf16_length('abc'), 3)
+        self.assertEqual(utf16_length('привет'), 6)
+        self.assertEqual(utf16_length('👍'), 2)
+        self.assertEqual(utf16_length('👨‍👩‍👧'), 8)
+
+    def test_emoji_before_entity_shifts_offset(self):
+        message = compile_message_html('👍 <b>ok</b>')
+        self.assertEqual(message.text, '👍 ok')
+        self.assertEqual(message.entities, [{'type': 'bold', 'offset': 3, 'length': 2}])
+
+    def test_emoji_inside_entity_counts_twice(self):
+        message = compile_message_html('<i>😀😀</i> и <b>ё</b>')
+        self.assertEqual(message.entities, [
+            {'type': 'italic', 'offset': 0, 'length': 4},
+            {'type': 'bold', 'offset': 7, 'length': 1},
+        ])
+
+
+class TagStructureTests(SimpleTestCase):
+
+    def test_nested_tags(self):
+        message = compile_message_html('<b>a<i>b</i>c</b>')
+        self.assertEqual(message.text, 'abc')
+        self.assertEqual(message.entities, [
+            {'type': 'bold', 'offset': 0, 'length': 3},
+            {'type': 'italic', 'offset': 1, 'length': 1},
+        ])
+        self.assertEqual(message.markdown_v2, '*a_b_c*')
+
+    def test_unclosed_tags_close_at_end(self):
+        message = compile_message_html('<b>bold <i>both')
+        self.assertEqual(message.text, 'bold both')
+        self.assertEqual(message.entities, [
+            {'type': 'bold', 'offset': 0, 'length': 9},
+            {'type': 'italic', 'offset': 5, 'length': 4},
+        ])
+        self.assertEqual(message.markdown_v2, '*bold _both_*')
+
+    def test_misnested_closing_tag_closes_inner_ones(self):
+        message = compile_message_html('<b>a<i>b</b>c</i>')
+        self.assertEqual(message.text, 'abc')
+        self.assertEqual(message.entities, [
+            {'type': 'bold', 'offset': 0, 'length': 2},
+            {'type': 'italic', 'offset': 1, 'length': 1},
+        ])
+
+    def test_stray_closing_tag_is_ignored(self):
+        message = compile_message_html('a</b>b')
+        self.assertEqual(message.text, 'ab')
+        self.assertEqual(message.entities, [])
+
+    def test_empty_entity_is_dropped(self):
+        message = compile_message_html('<b></b>text')
+        self.assertEqual(message.entities, [])
+        self.assertEqual(message.markdown_v2, 'text')
+
+    def test_unknown_tags_are_stripped_and_text_kept(self):
+        message = compile_message_html('<font color="red">red</font> <p>para</p>line<br>next')
+        self.assertEqual(message.text, 'red para\nline\nnext')
+        self.assertEqual(message.entities, [])
+
+    def test_less_than_sign_is_text(self):
+        message = compile_message_html('5 < 6 &amp; <b>7</b>')
+        self.assertEqual(message.text, '5 < 6 & 7')
+        self.assertEqual(message.entities, [{'type': 'bold', 'offset': 8, 'length': 1}])
+
+
+class LinkAndCodeTests(SimpleTestCase):
+
+    def test_link(self):
+        message = compile_message_html('<a href="https://example.com/?a=1&amp;b=2">site</a>')
+        self.assertEqual(message.entities, [
+            {'type': 'text_link', 'offset': 0, 'length': 4, 'url': 'https://example.com/?a=1&b=2'},
+        ])
+        self.assertEqual(message.markdown_v2, '[site](https://example.com/?a=1&b=2)')
+
+    def test_disallowed_url_scheme_keeps_text_only(self):
+        message = compile_message_html('<a href="javascript:alert(1)">click</a>')
+        self.assertEqual(message.text, 'click')
+        self.assertEqual(message.entities, [])
+
+    def test_code_language_and_markdown_escaping(self):
+        message = compile_message_html('<code class="language-python">a_b`</code> 1.5')
+        self.assertEqual(message.entities, [
+            {'type': 'code', 'offset': 0, 'length': 4, 'language': 'python'},
+        ])
+        # Внутри code экранируются только \ и `
+        self.assertEqual(message.markdown_v2, '`a_b\\`` 1\\.5')
+
+    def test_caption_payload(self):
+        message = compile_message_html('<b>hi</b>')
+        self.assertEqual(message.as_payload(is_caption=True), {
+            'caption': 'hi',
+            'caption_entities': [{'type': 'bold', 'offset': 0, 'length': 2}],
+        })
+        self.assertEqual(compile_message_html('plain').as_payload(), {'text': 'plain'})
@@ -3,6 +3,7 @@ Dashboard views для Django Admin с Unfold.
 """
 
 import json
+import logging
 from datetime import datetime
 from django.views.generic import TemplateView
 from django.contrib.admin.views.decorators import staff_member_required
@@ -10,54 +11,53 @@ from django.utils.decorators import method_decorator
 from django.http import JsonResponse
 from django.utils import timezone
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
 from django.contrib import messages
 from django.db.models import Sum
 
-from .dashboard import get_dashboard_data, get_date_range
-from .models import Transaction, User, Broadcast
+from .dashboard import DASHBOARD_BLOCKS, get_dashboard_block, get_dashboard_data, get_date_range
+from .models import Broadcast
+
+
+logger = logging.getLogger(__name__)
+
+def _parse_period_params(request):
+    """Период дашборда из GET-параметров: (period, start, end, start_date, end_date)."""
+    period = request.GET.get('period', 'today')
+    start_date = request.GET.get('start_date')
+    end_date = request.GET.get('end_date')
+    
+    # Парсим даты если custom
+    parsed_start = None
+    parsed_end = None
+    if period == 'custom' and start_date and end_date:
+        try:
+            parsed_start = timezone.make_aware(datetime.strptime(start_date, '%Y-%m-%d'))
+            parsed_end = timezone.make_aware(datetime.strptime(end_date, '%Y-%m-%d'))
+        except ValueError:
+            period = 'today'
+    
+    return period, parsed_start, parsed_end, start_date, end_date
 
 
 @method_decorator(staff_member_required, name='dispatch')
 class DashboardView(TemplateView):
+    """
+    Каркас дашборда: страница отдаётся сразу, блоки догружаются
+    параллельно через dashboard_block_api.
+    """
     template_name = 'admin/dashboard.html'
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Получаем период из GET параметров
-        period = self.request.GET.get('period', 'today')
-        start_date = self.request.GET.get('start_date')
-        end_date = self.request.GET.get('end_date')
-        
-        # Парсим даты если custom
-        parsed_start = None
-        parsed_end = None
-        if period == 'custom' and start_date and end_date:
-            try:
-                parsed_start = timezone.make_aware(datetime.strptime(start_date, '%Y-%m-%d'))
-                parsed_end = timezone.make_aware(datetime.strptime(end_date, '%Y-%m-%d'))
-            except ValueError:
-                period = 'today'
-        
-        # Получаем данные дашборда
-        dashboard_data = get_dashboard_data(period, parsed_start, parsed_end)
-        
-        # Последние транзакции
-        recent_transactions = Transaction.objects.select_related('user').filter(
-            is_successful=True
-        ).order_by('-date_created')[:10]
-        
-        # Топ пользователей по записям
-        from django.db.models import Count
-        top_users = User.objects.annotate(
-            entries_count=Count('entries')
-        ).order_by('-entries_count')[:10]
+        period, _, _, start_date, end_date = _parse_period_params(self.request)
+        chart_blocks = [name for name in DASHBOARD_BLOCKS if name.startswith('charts.')]
+        html_blocks = [name for name in DASHBOARD_BLOCKS if name not in chart_blocks]
         
         context.update({
-            'dashboard': dashboard_data,
-            'dashboard_json': json.dumps(dashboard_data, default=str),
-            'recent_transactions': recent_transactions,
-            'top_users': top_users,
+            'html_blocks_json': json.dumps(html_blocks),
+            'chart_blocks_json': json.dumps(chart_blocks),
             'current_period': period,
             'start_date': start_date or '',
             'end_date': end_date or '',
@@ -70,21 +70,54 @@ class DashboardView(TemplateView):
 @staff_member_required
 def dashboard_api(request):
     """API endpoint для получения данных дашборда."""
-    period = request.GET.get('period', 'today')
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
+    period, parsed_start, parsed_end, _, _ = _parse_period_params(request)
+    force_refresh = request.GET.get('refresh') == '1'
+    data = get_dashboard_data(period, parsed_start, parsed_end, force_refresh=force_refresh)
+    return JsonResponse(data)
+
+
+@staff_member_required
+def dashboard_block_api(request, block: str):
+    """
+    API: один блок дашборда.
     
-    parsed_start = None
-    parsed_end = None
-    if period == 'custom' and start_date and end_date:
-        try:
-            parsed_start = timezone.make_aware(datetime.strptime(start_date, '%Y-%m-%d'))
-            parsed_end = timezone.make_aware(datetime.strptime(end_date, '%Y-%m-%d'))
-        except ValueError:
-            period = 'today'
+    Графики ('charts.*') отдаются данными для Chart.js, остальные блоки —
+    ещё и готовым HTML (шаблон admin/dashboard/<block>.html), который
+    страница вставляет как есть.
     
-    data = get_dashboard_data(period, parsed_start, parsed_end)
-    return JsonResponse(data)
+    Returns:
+        {block, data, html, computed_at, computed_at_display, duration_ms, queries, db_ms}
+    """
+    period, parsed_start, parsed_end, _, _ = _parse_period_params(request)
+    force_refresh = request.GET.get('refresh') == '1'
+    
+    if block not in DASHBOARD_BLOCKS:
+        return JsonResponse({'error': 'Unknown block'}, status=404)
+    
+    try:
+        entry = get_dashboard_block(block, period, parsed_start, parsed_end, force_refresh=force_refresh)
+        computed_at = timezone.localtime(entry['computed_at'])
+        response = {
+            'block': block,
+            'computed_at': computed_at.isoformat(),
+            'computed_at_display': computed_at.strftime('%H:%M:%S'),
+            'duration_ms': entry['duration_ms'],
+            'queries': entry.get('queries'),
+            'db_ms': entry.get('db_ms'),
+        }
+        if block.startswith('charts.'):
+            response['data'] = entry['data']
+        else:
+            response['html'] = render_to_string(f'admin/dashboard/{block}.html', {
+                'dashboard': {block: entry['data']},
+                'computed_at': computed_at,
+            }, request=request)
+    except Exception as e:
+        # Как и на странице целиком: упавший блок — заглушка, а не 500
+        logger.error(f"Dashboard block {block} failed: {e}")
+        return JsonResponse({'block': block, 'unavailable': True, 'error': 'Block unavailable'}, status=503)
+    
+    return JsonResponse(response, json_dumps_params={'default': str})
 
 
 @staff_member_required
@@ -519,3 +552,73 @@ def broadcasts_api_upload_image(request):
         'success': True,
         'url': image_url,
     })
+
+
+@staff_member_required
+def segment_preview_api(request):
+    """
+    API: Превью размера сегмента по правилам (без сохранения).
+    
+    Отвечает за миллисекунды: точный результат из кэша, если он уже
+    посчитан, иначе оценка по TABLESAMPLE + фоновый точный COUNT.
+    Клиент повторяет запрос, пока не получит exact=true.
+    
+    POST: filter_rules=<JSON>
+    Returns:
+        {count, exact, method, sample_percent, rules_hash}
+    """
+    from django.conf import settings
+    from django.core.cache import cache
+    from .segments import SegmentRuleError, compile_segment_rules, estimate_segment_size, preview_cache_key
+    from .tasks import count_segment_preview
+    
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    
+    raw_rules = request.POST.get('filter_rules', '').strip() or '{}'
+    try:
+        filter_rules = json.loads(raw_rules)
+        plan = compile_segment_rules(filter_rules)
+    except ValueError as e:
+        # SegmentRuleError тоже ValueError
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    cache_key = preview_cache_key(plan.rules_hash)
+    cached = cache.get(cache_key)
+    if cached:
+        return JsonResponse({
+            'count': cached['count'],
+            'exact': True,
+            'method': 'count',
+            'sample_percent': 100.0,
+            'rules_hash': plan.rules_hash,
+            'computed_at': cached['computed_at'],
+        })
+    
+    # Оценка тоже кэшируется ненадолго: форма опрашивает API, пока не придёт
+    # точный COUNT, и каждый опрос не должен заново сканировать выборку
+    estimate_key = f'{cache_key}:estimate'
+    result = cache.get(estimate_key)
+    if result:
+        result['rules_hash'] = plan.rules_hash
+        return JsonResponse(result)
+    
+    try:
+        result = estimate_segment_size(filter_rules)
+    except SegmentRuleError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if result['exact']:
+        cache.set(
+            cache_key,
+            {'count': result['count'], 'computed_at': timezone.now().isoformat()},
+            timeout=settings.SEGMENT_PREVIEW_CACHE_TTL,
+        )
+    else:
+        cache.set(estimate_key, result, timeout=settings.SEGMENT_PREVIEW_ESTIMATE_TTL)
+        if cache.add(f'{cache_key}:pending', 1, timeout=settings.SEGMENT_PREVIEW_CACHE_TTL):
+            # Один фоновый COUNT на набор правил, сколько бы раз ни опрашивали
+            count_segment_preview.delay(filter_rules)
+    
+    result['rules_hash'] = plan.rules_hash
+    return JsonResponse(result)
@@ -0,0 +1,39 @@
+-- Migration: Materialized segment membership
+-- Date: 2026-10-18
+-- Description: segment_members хранит состав сегментов, обновляется Celery Beat
+-- инкрементально (только пользователи, у которых сдвинулся date_updated).
+-- Рассылки по сегменту становятся индексным JOIN вместо полного прохода по users.
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: Segment members
+-- ============================================
+CREATE TABLE IF NOT EXISTS segment_members (
+    id BIGSERIAL PRIMARY KEY,
+    segment_id UUID NOT NULL REFERENCES user_segments(id) ON DELETE CASCADE,
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    date_added TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    CONSTRAINT segment_members_unique UNIQUE (segment_id, user_id)
+);
+
+-- (segment_id, user_id) покрывается уникальным индексом, нужен обратный
+CREATE INDEX IF NOT EXISTS idx_segment_members_user ON segment_members(user_id);
+
+-- ============================================
+-- Refresh state on user_segments
+-- ============================================
+ALTER TABLE user_segments
+ADD COLUMN IF NOT EXISTS members_refreshed_at TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS members_rules_hash VARCHAR(40);
+
+-- Change set для инкрементального обновления
+CREATE INDEX IF NOT EXISTS idx_users_date_updated ON users(date_updated);
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE segment_members IS 'Материализованный состав сегментов (обновляется Celery)';
+COMMENT ON COLUMN user_segments.members_refreshed_at IS 'Начало последнего обновления segment_members';
+COMMENT ON COLUMN user_segments.members_rules_hash IS 'Хэш правил, по которым построен segment_members';
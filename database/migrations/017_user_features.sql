@@ -0,0 +1,67 @@
+-- Migration: Precomputed per-user behavioural features
+-- Date: 2026-10-18
+-- Description: user_features — одна строка на пользователя с агрегатами по
+-- journal_entries / habits / transactions / usage_logs. Обновляется Celery
+-- инкрементально, сегменты фильтруют по ней через JOIN 1:1 по индексам
+-- вместо EXISTS по большим таблицам.
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: User features
+-- ============================================
+CREATE TABLE IF NOT EXISTS user_features (
+    user_id UUID PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+
+    -- Записи
+    last_entry_at TIMESTAMPTZ,
+    entries_7d INTEGER NOT NULL DEFAULT 0,
+    entries_30d INTEGER NOT NULL DEFAULT 0,
+
+    -- Привычки (активные, не в архиве)
+    active_habits INTEGER NOT NULL DEFAULT 0,
+    max_habit_streak INTEGER NOT NULL DEFAULT 0,
+    last_habit_completion_at TIMESTAMPTZ,
+
+    -- Платежи (успешные, без возвратов)
+    last_payment_at TIMESTAMPTZ,
+    payments_30d INTEGER NOT NULL DEFAULT 0,
+
+    -- AI расходы
+    ai_spend_usd NUMERIC(12, 6) NOT NULL DEFAULT 0,
+    ai_spend_30d_usd NUMERIC(12, 6) NOT NULL DEFAULT 0,
+
+    date_updated TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_features_last_entry ON user_features(last_entry_at);
+CREATE INDEX IF NOT EXISTS idx_user_features_entries_7d ON user_features(entries_7d);
+CREATE INDEX IF NOT EXISTS idx_user_features_entries_30d ON user_features(entries_30d);
+CREATE INDEX IF NOT EXISTS idx_user_features_habit_streak ON user_features(max_habit_streak);
+CREATE INDEX IF NOT EXISTS idx_user_features_last_payment ON user_features(last_payment_at);
+CREATE INDEX IF NOT EXISTS idx_user_features_ai_spend ON user_features(ai_spend_usd);
+
+-- Change set для инкрементального обновления
+CREATE INDEX IF NOT EXISTS idx_entries_user_date ON journal_entries(user_id, date_created DESC);
+CREATE INDEX IF NOT EXISTS idx_entries_date_updated ON journal_entries(date_updated);
+CREATE INDEX IF NOT EXISTS idx_habits_date_updated ON habits(date_updated);
+CREATE INDEX IF NOT EXISTS idx_habit_completions_date_created ON habit_completions(date_created);
+
+-- ============================================
+-- Сегменты неактивных: теперь есть настоящий last_entry_at
+-- (без записей вообще — тоже неактивные)
+-- ============================================
+UPDATE user_segments
+SET filter_rules = '{"or": [{"last_entry_at": {"lt": "-7 days"}}, {"last_entry_at": {"is_null": true}}]}'
+WHERE slug = 'inactive_7d';
+
+UPDATE user_segments
+SET filter_rules = '{"or": [{"last_entry_at": {"lt": "-30 days"}}, {"last_entry_at": {"is_null": true}}]}'
+WHERE slug = 'inactive_30d';
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE user_features IS 'Поведенческие признаки пользователей для сегментации (обновляется Celery)';
+COMMENT ON COLUMN user_features.max_habit_streak IS 'Максимальный current_streak среди активных привычек';
+COMMENT ON COLUMN user_features.payments_30d IS 'Успешные платежи (не refund) за 30 дней';
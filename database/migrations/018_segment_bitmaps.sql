@@ -0,0 +1,48 @@
+-- Migration: Bitmap-backed composite segments
+-- Date: 2026-10-18
+-- Description: Плотный целочисленный индекс пользователей для битмапов в Redis
+-- и составные сегменты (union / intersect / exclude над другими сегментами
+-- и получателями рассылок).
+
+-- Add composite value to segment_type enum
+ALTER TYPE app.segment_type ADD VALUE IF NOT EXISTS 'composite';
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: Dense user index
+-- ============================================
+-- Номер бита пользователя во всех битмапах. Только растёт, не переиспользуется.
+CREATE TABLE IF NOT EXISTS user_bitmap_index (
+    user_id UUID PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    idx BIGINT GENERATED ALWAYS AS IDENTITY (START WITH 0 MINVALUE 0) UNIQUE
+);
+
+INSERT INTO user_bitmap_index (user_id)
+SELECT id FROM users ORDER BY date_created
+ON CONFLICT (user_id) DO NOTHING;
+
+-- ============================================
+-- Composite segments
+-- ============================================
+-- Примеры:
+-- {"intersect": ["premium", "active_writers"]}
+-- {"exclude": [{"intersect": ["premium", "active_writers"]}, {"broadcast": "<uuid>"}]}
+ALTER TABLE user_segments
+ADD COLUMN IF NOT EXISTS set_expression JSONB;
+
+-- Составной сегмент задаётся выражением, без filter_rules / static_user_ids.
+-- ::text — новое значение enum нельзя использовать в той же транзакции, где оно добавлено
+ALTER TABLE user_segments DROP CONSTRAINT IF EXISTS valid_segment;
+ALTER TABLE user_segments ADD CONSTRAINT valid_segment CHECK (
+    (filter_rules IS NOT NULL) OR
+    (static_user_ids IS NOT NULL AND array_length(static_user_ids, 1) > 0) OR
+    (segment_type::text = 'composite' AND set_expression IS NOT NULL) OR
+    (is_system = true)
+);
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE user_bitmap_index IS 'Плотный индекс пользователей для битмапов сегментов в Redis';
+COMMENT ON COLUMN user_segments.set_expression IS 'Выражение над сегментами для segment_type = composite';
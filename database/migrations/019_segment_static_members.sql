@@ -0,0 +1,56 @@
+-- Migration: Static segment membership join table
+-- Date: 2026-10-18
+-- Description: Состав статических сегментов переезжает из массива
+-- user_segments.static_user_ids в таблицу segment_static_members:
+-- строка сегмента больше не растёт с размером списка, рассылка идёт
+-- индексным JOIN вместо гигантского IN (...).
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: Static segment members
+-- ============================================
+CREATE TABLE IF NOT EXISTS segment_static_members (
+    id BIGSERIAL PRIMARY KEY,
+    segment_id UUID NOT NULL REFERENCES user_segments(id) ON DELETE CASCADE,
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    date_added TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    CONSTRAINT segment_static_members_unique UNIQUE (segment_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_segment_static_members_user ON segment_static_members(user_id);
+
+-- ============================================
+-- DATA: переносим массивы
+-- ============================================
+INSERT INTO segment_static_members (segment_id, user_id)
+SELECT s.id, u.id
+FROM user_segments s
+CROSS JOIN LATERAL unnest(s.static_user_ids) AS listed(user_id)
+JOIN users u ON u.id = listed.user_id
+ON CONFLICT (segment_id, user_id) DO NOTHING;
+
+-- Сегменты, заданные только списком, становятся статическими
+UPDATE user_segments
+SET segment_type = 'static'
+WHERE filter_rules IS NULL
+  AND is_system = false
+  AND array_length(static_user_ids, 1) > 0;
+
+-- Статический сегмент теперь может не иметь ни правил, ни массива
+ALTER TABLE user_segments DROP CONSTRAINT IF EXISTS valid_segment;
+ALTER TABLE user_segments ADD CONSTRAINT valid_segment CHECK (
+    (filter_rules IS NOT NULL) OR
+    (segment_type::text = 'static') OR
+    (segment_type::text = 'composite' AND set_expression IS NOT NULL) OR
+    (is_system = true)
+);
+
+UPDATE user_segments SET static_user_ids = NULL WHERE static_user_ids IS NOT NULL;
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE segment_static_members IS 'Состав статических сегментов (ручной список, импорт CSV)';
+COMMENT ON COLUMN user_segments.static_user_ids IS 'Устарело: состав статических сегментов в segment_static_members';
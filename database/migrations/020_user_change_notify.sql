@@ -0,0 +1,34 @@
+-- Migration: NOTIFY on user changes for segment counters
+-- Date: 2026-10-18
+-- Description: Триггер на users шлёт pg_notify('user_changed', <user_id>)
+-- при вставке и изменении строки. Слушатель (manage.py listen_segment_changes)
+-- пересчитывает принадлежность к сегментам только для этих пользователей
+-- и с задержкой обновляет user_segments.cached_user_count.
+
+SET search_path TO app, public;
+
+CREATE OR REPLACE FUNCTION notify_user_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Payload — только id: лимит NOTIFY 8000 байт, одинаковые уведомления
+    -- в одной транзакции Postgres схлопывает сам
+    PERFORM pg_notify('user_changed', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_notify_insert ON users;
+CREATE TRIGGER trg_users_notify_insert
+    AFTER INSERT ON users
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_user_changed();
+
+-- Только реальные изменения (не UPDATE с теми же значениями)
+DROP TRIGGER IF EXISTS trg_users_notify_update ON users;
+CREATE TRIGGER trg_users_notify_update
+    AFTER UPDATE ON users
+    FOR EACH ROW
+    WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION notify_user_changed();
+
+COMMENT ON FUNCTION notify_user_changed() IS 'pg_notify(user_changed, id) для слушателя счётчиков сегментов';
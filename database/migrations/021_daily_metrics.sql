@@ -0,0 +1,53 @@
+-- Migration: Daily metrics rollup
+-- Date: 2026-10-18
+-- Description: daily_metrics — суточные агрегаты (день по Europe/Moscow × источник
+-- трафика) для дашборда. Ночью Celery пересобирает последние дни, сегодняшний
+-- день обновляется каждые 5 минут. Дашборд суммирует сотни строк вместо
+-- сканирования journal_entries / transactions / usage_logs.
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: Daily metrics
+-- ============================================
+CREATE TABLE IF NOT EXISTS daily_metrics (
+    id BIGSERIAL PRIMARY KEY,
+    day DATE NOT NULL,
+    -- '' — пользователи без источника
+    referral_source VARCHAR(100) NOT NULL DEFAULT '',
+
+    signups INTEGER NOT NULL DEFAULT 0,
+    -- Уникальные авторы записей за день (суммировать можно только по источникам одного дня)
+    active_users INTEGER NOT NULL DEFAULT 0,
+    entries_text INTEGER NOT NULL DEFAULT 0,
+    entries_voice INTEGER NOT NULL DEFAULT 0,
+
+    -- Успешные транзакции
+    transactions INTEGER NOT NULL DEFAULT 0,
+    revenue_usd NUMERIC(14, 4) NOT NULL DEFAULT 0,
+    revenue_stars BIGINT NOT NULL DEFAULT 0,
+
+    ai_requests INTEGER NOT NULL DEFAULT 0,
+    ai_tokens BIGINT NOT NULL DEFAULT 0,
+    ai_cost_usd NUMERIC(14, 6) NOT NULL DEFAULT 0,
+
+    habit_completions INTEGER NOT NULL DEFAULT 0,
+
+    date_updated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    CONSTRAINT daily_metrics_unique UNIQUE (day, referral_source)
+);
+
+-- Источники пересборки: диапазоны по date_created
+CREATE INDEX IF NOT EXISTS idx_users_date_created ON users(date_created);
+CREATE INDEX IF NOT EXISTS idx_entries_date_created ON journal_entries(date_created);
+CREATE INDEX IF NOT EXISTS idx_transactions_date_created ON transactions(date_created);
+CREATE INDEX IF NOT EXISTS idx_usage_logs_date_created ON usage_logs(date_created);
+CREATE INDEX IF NOT EXISTS idx_habit_completions_completed_date ON habit_completions(completed_date);
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE daily_metrics IS 'Суточные метрики дашборда по источникам (обновляется Celery)';
+COMMENT ON COLUMN daily_metrics.day IS 'День по часовому поясу проекта (Europe/Moscow)';
+COMMENT ON COLUMN daily_metrics.active_users IS 'Уникальные пользователи с записями за день';
@@ -0,0 +1,41 @@
+-- Migration: Daily AI metrics rollup
+-- Date: 2026-10-18
+-- Description: daily_ai_metrics — суточные агрегаты usage_logs (день по Europe/Moscow ×
+-- сервис × модель): запросы, токены, стоимость и гистограмма задержек. По ней
+-- дашборд считает перцентили задержки для длинных периодов, не сортируя
+-- миллионы строк usage_logs. Пересобирается вместе с daily_metrics.
+
+SET search_path TO app, public;
+
+-- ============================================
+-- TABLE: Daily AI metrics
+-- ============================================
+CREATE TABLE IF NOT EXISTS daily_ai_metrics (
+    id BIGSERIAL PRIMARY KEY,
+    day DATE NOT NULL,
+    service_type VARCHAR(50) NOT NULL,
+    model_name VARCHAR(50) NOT NULL,
+
+    requests INTEGER NOT NULL DEFAULT 0,
+    input_tokens BIGINT NOT NULL DEFAULT 0,
+    output_tokens BIGINT NOT NULL DEFAULT 0,
+    cost_usd NUMERIC(14, 6) NOT NULL DEFAULT 0,
+
+    -- Задержка: только запросы с latency_ms IS NOT NULL
+    latency_count INTEGER NOT NULL DEFAULT 0,
+    latency_sum_ms BIGINT NOT NULL DEFAULT 0,
+    latency_max_ms INTEGER,
+    -- {"<номер корзины width_bucket>": число запросов}, границы — core/rollups.py LATENCY_BUCKETS_MS
+    latency_histogram JSONB NOT NULL DEFAULT '{}',
+
+    date_updated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    CONSTRAINT daily_ai_metrics_unique UNIQUE (day, service_type, model_name)
+);
+
+-- ============================================
+-- COMMENTS
+-- ============================================
+COMMENT ON TABLE daily_ai_metrics IS 'Суточные AI-метрики по сервису и модели (обновляется Celery)';
+COMMENT ON COLUMN daily_ai_metrics.day IS 'День по часовому поясу проекта (Europe/Moscow)';
+COMMENT ON COLUMN daily_ai_metrics.latency_histogram IS 'Гистограмма latency_ms по корзинам width_bucket (границы в LATENCY_BUCKETS_MS)';